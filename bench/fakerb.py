@@ -0,0 +1,1092 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#   fakerb.py
+#
+#   Headless stand-ins for the Rhythmbox, GObject and Gtk APIs used by the
+#   RatingFilters plugin, for benchmarking the plugin outside Rhythmbox.
+#   Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Stand-ins for the parts of gi.repository (GObject, GLib, Gio, Gtk, Peas,
+PeasGtk and RB) and the rb module that the RatingFilters plugin uses. They
+model behaviour (signals, query models, entry views, settings, idle
+sources) closely enough to drive every release of the plugin, and count
+the expensive operations the real ones would perform. Works with Python 2
+and Python 3, since the older releases of the plugin are Python 2 only.
+'''
+from __future__ import print_function
+
+import ast
+import collections
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+import weakref
+import xml.etree.ElementTree as ElementTree
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMON_PATH = os.path.join(ROOT_PATH, 'common')
+SCHEMA_ID = 'org.gnome.rhythmbox.plugins.rating_filters'
+SCHEMA_PATH = os.path.join(
+    COMMON_PATH, 'org.gnome.rhythmbox.plugins.rating_filters.gschema.xml'
+    )
+
+timer = getattr(time, 'perf_counter', time.time)
+handler_ids = itertools.count(1)
+source_ids = itertools.count(1)
+
+
+class Props(object):
+    '''
+    Holds GObject properties as plain attributes.
+    '''
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Signals(object):
+    '''
+    Minimal GObject signal support: handlers are called with the emitting
+    object, the signal arguments and any extra connect arguments.
+    '''
+    live = weakref.WeakSet()
+
+    def __init__(self, **kwargs):
+        self.handlers = collections.OrderedDict()
+        self.props = Props(**kwargs)
+        Signals.live.add(self)
+
+    def connect(self, name, callback, *args):
+        handler_id = next(handler_ids)
+        self.handlers[handler_id] = (name, callback, args)
+        return handler_id
+
+    def disconnect(self, handler_id):
+        del self.handlers[handler_id]
+
+    def emit(self, name, *args):
+        for handler_name, callback, extra in list(self.handlers.values()):
+            if handler_name == name:
+                callback(self, *(args + extra))
+
+    def handler_count(self, name=None):
+        return len([
+            handler for handler in self.handlers.values()
+            if name is None or handler[0] == name
+            ])
+
+
+# GObject
+
+class GObjectObject(Signals):
+    def do_dispose(self):
+        pass
+
+
+def gobject_property(**kwargs):
+    return None
+
+
+# GLib
+
+class Variant(object):
+    '''
+    Immutable, hashable GLib.Variant stand-in.
+    '''
+    def __init__(self, type_string, value):
+        self.type_string = type_string
+        self.value = value
+
+    @staticmethod
+    def new_string(value):
+        return Variant('s', value)
+
+    @staticmethod
+    def new_boolean(value):
+        return Variant('b', bool(value))
+
+    def unpack(self):
+        return self.value
+
+    def get_string(self):
+        return self.value
+
+    def get_boolean(self):
+        return self.value
+
+    def __eq__(self, other):
+        return (isinstance(other, Variant) and
+                (self.type_string, self.value) ==
+                (other.type_string, other.value))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.type_string, self.value))
+
+
+class VariantType(object):
+    @staticmethod
+    def new(type_string):
+        return type_string
+
+
+class MainContext(object):
+    '''
+    Runs idle and timeout sources when the harness asks it to.
+    '''
+    def __init__(self):
+        self.sources = collections.OrderedDict()
+
+    def idle_add(self, callback, *args):
+        return self.add(0, callback, args)
+
+    def timeout_add(self, interval, callback, *args):
+        return self.add(interval / 1000.0, callback, args)
+
+    def timeout_add_seconds(self, interval, callback, *args):
+        return self.add(interval, callback, args)
+
+    def add(self, interval, callback, args):
+        source_id = next(source_ids)
+        self.sources[source_id] = [timer() + interval, interval, callback, args]
+        return source_id
+
+    def source_remove(self, source_id):
+        return self.sources.pop(source_id, None) is not None
+
+    def iteration(self):
+        '''
+        Dispatches every source that is due once. Returns the number of
+        sources dispatched.
+        '''
+        now = timer()
+        dispatched = 0
+        for source_id, source in list(self.sources.items()):
+            if source_id not in self.sources or source[0] > now:
+                continue
+            dispatched += 1
+            if source[2](*source[3]):
+                source[0] = now + source[1]
+            else:
+                self.sources.pop(source_id, None)
+        return dispatched
+
+    def drain(self, limit=100000):
+        '''
+        Dispatches idle sources until none are left (timeouts that are not
+        yet due are left alone).
+        '''
+        for _ in range(limit):
+            if not self.iteration():
+                return
+
+
+main_context = MainContext()
+
+
+# Gio
+
+class Settings(Signals):
+    '''
+    GSettings stand-in, with defaults read from the plugin's schema.
+    '''
+    stores = {}
+
+    def __init__(self, schema_id):
+        Signals.__init__(self)
+        if schema_id not in Settings.stores:
+            Settings.stores[schema_id] = load_schema_defaults()
+        self.values = Settings.stores[schema_id]
+        Settings.instances.append(self)
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+        for settings in Settings.instances:
+            if settings.values is self.values:
+                settings.emit('changed::' + key, key)
+                settings.emit('changed', key)
+
+    def get_string(self, key):
+        return self.values[key]
+
+    def get_int(self, key):
+        return self.values[key]
+
+    def get_boolean(self, key):
+        return self.values[key]
+
+    def list_keys(self):
+        return sorted(self.values)
+
+Settings.instances = []
+
+
+def load_schema_defaults():
+    '''
+    Returns the default value of every key in the plugin's schema.
+    '''
+    values = {}
+    for key in ElementTree.parse(SCHEMA_PATH).getroot().iter('key'):
+        default = key.find('default').text.strip()
+        if key.get('type') == 'b':
+            values[key.get('name')] = default == 'true'
+        else:
+            values[key.get('name')] = ast.literal_eval(default)
+    return values
+
+
+class SimpleAction(Signals):
+    def __init__(self, name, parameter_type, state):
+        Signals.__init__(self)
+        self.name = name
+        self.parameter_type = parameter_type
+        self.state = state
+
+    @staticmethod
+    def new_stateful(name, parameter_type, state):
+        return SimpleAction(name, parameter_type, state)
+
+    @staticmethod
+    def new(name, parameter_type):
+        return SimpleAction(name, parameter_type, None)
+
+    def get_name(self):
+        return self.name
+
+    def get_state(self):
+        return self.state
+
+    def set_state(self, state):
+        self.state = state
+
+    def change_state(self, value):
+        if self.handler_count('change-state'):
+            self.emit('change-state', value)
+        else:
+            self.set_state(value)
+
+    def set_enabled(self, enabled):
+        pass
+
+    def activate(self, parameter=None):
+        self.emit('activate', parameter)
+
+
+class MenuItem(object):
+    def __init__(self):
+        self.attributes = {}
+
+    @staticmethod
+    def new(label, detailed_action):
+        item = MenuItem()
+        item.set_label(label)
+        item.set_detailed_action(detailed_action)
+        return item
+
+    def copy(self):
+        item = MenuItem()
+        item.attributes = dict(self.attributes)
+        return item
+
+    def set_label(self, label):
+        self.attributes['label'] = label
+
+    def set_detailed_action(self, action):
+        self.attributes['action'] = action
+
+    def set_action_and_target_value(self, action, target_value):
+        self.attributes['action'] = action
+        self.attributes['target'] = target_value
+
+    def set_submenu(self, submenu):
+        self.attributes['submenu'] = submenu
+
+    def set_attribute_value(self, name, value):
+        self.attributes[name] = value
+
+    def set_section(self, section):
+        self.attributes['section'] = section
+
+
+class Menu(object):
+    def __init__(self):
+        self.items = []
+        self.changes = 0
+
+    def get_n_items(self):
+        return len(self.items)
+
+    def append_item(self, item):
+        self.insert_item(len(self.items), item)
+
+    def insert_item(self, position, item):
+        self.items.insert(position, item.copy())
+        self.changes += 1
+
+    def append(self, label, detailed_action):
+        self.append_item(MenuItem.new(label, detailed_action))
+
+    def append_section(self, label, section):
+        item = MenuItem()
+        if label is not None:
+            item.set_label(label)
+        item.set_section(section)
+        self.append_item(item)
+
+    def remove(self, position):
+        del self.items[position]
+        self.changes += 1
+
+    def remove_all(self):
+        self.items = []
+        self.changes += 1
+
+
+class Application(Signals):
+    default = None
+
+    def __init__(self):
+        Signals.__init__(self)
+        self.actions = {}
+        self.plugin_menu_items = {}
+
+    @staticmethod
+    def get_default():
+        if Application.default is None:
+            Application.default = Application()
+        return Application.default
+
+    def add_action(self, action):
+        self.actions[action.get_name()] = action
+
+    def remove_action(self, name):
+        self.actions.pop(name, None)
+
+    def lookup_action(self, name):
+        return self.actions.get(name)
+
+    def add_plugin_menu_item(self, menu, item_id, item):
+        self.plugin_menu_items[(menu, item_id)] = item
+
+    def remove_plugin_menu_item(self, menu, item_id):
+        return self.plugin_menu_items.pop((menu, item_id), None) is not None
+
+
+# Gtk (used by the 2.97 and 2.98 releases)
+
+class RadioAction(Signals):
+    def __init__(self, name, label, tooltip, stock_id, value):
+        Signals.__init__(self)
+        self.name = name
+        self.value = value
+        self.group = {'members': [self], 'current': self}
+
+    def join_group(self, other):
+        self.group['members'].remove(self)
+        self.group = other.group
+        self.group['members'].append(self)
+
+    def set_active(self, active):
+        if active and self.group['current'] is not self:
+            self.group['current'] = self
+            for member in list(self.group['members']):
+                member.emit('changed', self)
+
+    def get_active(self):
+        return self.group['current'] is self
+
+    def get_current_value(self):
+        return self.group['current'].value
+
+
+class ActionGroup(object):
+    def __init__(self, name):
+        self.name = name
+        self.actions = []
+
+    def add_action(self, action):
+        self.actions.append(action)
+
+
+class UIManager(object):
+    def __init__(self):
+        self.action_groups = []
+        self.ui_ids = itertools.count(1)
+
+    def insert_action_group(self, action_group, position):
+        self.action_groups.insert(position, action_group)
+
+    def remove_action_group(self, action_group):
+        self.action_groups.remove(action_group)
+
+    def add_ui_from_string(self, ui_string):
+        return next(self.ui_ids)
+
+    def remove_ui(self, ui_id):
+        pass
+
+    def ensure_update(self):
+        pass
+
+
+# Peas and PeasGtk
+
+class Activatable(object):
+    pass
+
+
+class Configurable(object):
+    pass
+
+
+# RB
+
+class RhythmDBPropType(object):
+    ENTRY_ID = 0
+    TITLE = 1
+    GENRE = 2
+    ARTIST = 3
+    ALBUM = 4
+    LOCATION = 5
+    DURATION = 6
+    RATING = 7
+    PLAY_COUNT = 8
+    LAST_PLAYED = 9
+    ALBUM_ARTIST = 10
+
+    doubles = (RATING,)
+    ulongs = (ENTRY_ID, DURATION, PLAY_COUNT, LAST_PLAYED)
+
+
+class RhythmDBEntry(object):
+    __slots__ = ['values']
+
+    def __init__(self, values):
+        self.values = values
+
+    def get_double(self, prop):
+        return self.values[prop]
+
+    def get_ulong(self, prop):
+        return self.values[prop]
+
+    def get_string(self, prop):
+        return self.values[prop]
+
+
+class RhythmDBEntryChange(object):
+    def __init__(self, prop, old, new):
+        self.prop = prop
+        self.old = old
+        self.new = new
+
+
+class RhythmDBEntryChanges(list):
+    '''
+    The changes passed with entry-changed. The 2.97 and 2.98 releases read
+    the first change from the values attribute.
+    '''
+    @property
+    def values(self):
+        return self[0]
+
+
+class RhythmDB(Signals):
+    def __init__(self):
+        Signals.__init__(self)
+        self.entries = collections.OrderedDict()
+
+    def add(self, entry):
+        self.entries[entry.values[RhythmDBPropType.ENTRY_ID]] = entry
+        self.emit('entry-added', entry)
+
+    def delete(self, entry):
+        del self.entries[entry.values[RhythmDBPropType.ENTRY_ID]]
+        self.emit('entry-deleted', entry)
+
+    def set(self, entry, prop, value):
+        old = entry.values[prop]
+        entry.values[prop] = value
+        self.emit(
+            'entry-changed', entry,
+            RhythmDBEntryChanges([RhythmDBEntryChange(prop, old, value)])
+            )
+
+    def entry_lookup_by_id(self, entry_id):
+        return self.entries.get(entry_id)
+
+    def entry_foreach(self, func, data=None):
+        for entry in list(self.entries.values()):
+            func(entry, data)
+
+    def commit(self):
+        pass
+
+
+class TreeIter(object):
+    __slots__ = ['entry', 'rows', 'index']
+
+    def __init__(self, entry, rows=None, index=0):
+        self.entry = entry
+        self.rows = rows
+        self.index = index
+
+
+class TreePath(object):
+    __slots__ = ['index']
+
+    def __init__(self, index):
+        self.index = index
+
+    def get_indices(self):
+        return [self.index]
+
+
+class TreeModelRow(object):
+    __slots__ = ['entry']
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    def __getitem__(self, column):
+        if column == 0:
+            return self.entry
+        raise IndexError(column)
+
+
+class RhythmDBQueryModel(Signals):
+    '''
+    Query model stand-in. Entries are kept in row order, and inserted at the
+    index given to add_entry as the real model does when it isn't sorted;
+    every insert and removal emits the same signals as the real model. The
+    rows are held in small blocks, with a Fenwick tree of the block sizes to
+    find the block a row is in, so that as in the balanced tree behind the
+    real model a row can be inserted or removed anywhere cheaply.
+    '''
+    block_size = 128
+
+    def __init__(self, db):
+        Signals.__init__(self, db=db)
+        self.set_rows([])
+        self.rows_inserted = 0
+
+    def set_rows(self, rows):
+        size = self.block_size
+        self.blocks = [rows[i:i + size] for i in range(0, len(rows), size)]
+        if not self.blocks:
+            self.blocks = [[]]
+        self.block_of = {}
+        for block in self.blocks:
+            self.block_of.update(dict.fromkeys(block, block))
+        self.length = len(rows)
+        self.tree = None
+        self.rows = None
+
+    def build_tree(self):
+        '''
+        Builds the tree of block sizes, which is only needed once rows are
+        inserted anywhere but the end.
+        '''
+        self.positions = dict(
+            (id(block), position) for position, block in enumerate(self.blocks)
+            )
+        tree = [0] * (len(self.blocks) + 1)
+        for position, block in enumerate(self.blocks):
+            node = position + 1
+            tree[node] += len(block)
+            parent = node + (node & -node)
+            if parent < len(tree):
+                tree[parent] += tree[node]
+        self.tree = tree
+
+    def resize(self, position, delta):
+        tree = self.tree
+        if tree is None:
+            return
+        node = position + 1
+        while node < len(tree):
+            tree[node] += delta
+            node += node & -node
+
+    def find_row(self, index):
+        '''
+        Returns the block a row is in and its offset in the block.
+        '''
+        if self.tree is None:
+            self.build_tree()
+        tree = self.tree
+        node = 0
+        step = 1 << (len(tree).bit_length() - 1)
+        while step:
+            child = node + step
+            if child < len(tree) and tree[child] <= index:
+                node = child
+                index -= tree[child]
+            step >>= 1
+        return node, index
+
+    def get_rows(self):
+        '''
+        Returns the entries as a list, built again whenever the entries have
+        changed.
+        '''
+        if self.rows is None:
+            self.rows = list(itertools.chain.from_iterable(self.blocks))
+        return self.rows
+
+    @property
+    def entries(self):
+        return collections.OrderedDict.fromkeys(self.get_rows())
+
+    @entries.setter
+    def entries(self, entries):
+        self.set_rows(list(entries))
+
+    @staticmethod
+    def new_empty(db):
+        return RhythmDBQueryModel(db)
+
+    def __iter__(self):
+        for entry in self.get_rows():
+            yield TreeModelRow(entry)
+
+    def __len__(self):
+        return self.length
+
+    def iter_n_children(self, tree_iter):
+        return self.length
+
+    def iter_to_entry(self, tree_iter):
+        return tree_iter.entry
+
+    def get_iter_first(self):
+        return self.iter_nth_child(None, 0)
+
+    def iter_nth_child(self, tree_iter, n):
+        if n >= self.length:
+            return None
+        rows = self.get_rows()
+        return TreeIter(rows[n], rows, n)
+
+    def iter_next(self, tree_iter):
+        index = tree_iter.index + 1
+        if index >= len(tree_iter.rows):
+            return None
+        return TreeIter(tree_iter.rows[index], tree_iter.rows, index)
+
+    def add_entry(self, entry, index):
+        if entry in self.block_of:
+            return
+        if 0 <= index < self.length:
+            position, offset = self.find_row(index)
+        else:
+            index = self.length
+            position = len(self.blocks) - 1
+            offset = len(self.blocks[position])
+        block = self.blocks[position]
+        block.insert(offset, entry)
+        self.block_of[entry] = block
+        self.length += 1
+        if len(block) > 2 * self.block_size:
+            tail = block[self.block_size:]
+            del block[self.block_size:]
+            self.blocks.insert(position + 1, tail)
+            self.block_of.update(dict.fromkeys(tail, tail))
+            self.tree = None
+        else:
+            self.resize(position, 1)
+        self.rows = None
+        self.rows_inserted += 1
+        self.emit('row-inserted', TreePath(index), TreeIter(entry))
+
+    def remove_entry(self, entry):
+        block = self.block_of.pop(entry, None)
+        if block is None:
+            return False
+        block.remove(entry)
+        self.length -= 1
+        if self.tree is not None:
+            self.resize(self.positions[id(block)], -1)
+        self.rows = None
+        self.emit('entry-removed', entry)
+        return True
+
+    def has_entry(self, entry):
+        return entry in self.block_of
+
+
+class EntryView(Signals):
+    def __init__(self, model):
+        Signals.__init__(self, model=model)
+        self.sorting_type = 'Artist,ascending'
+        self.models_set = 0
+        self.sorts = 0
+
+    def set_model(self, model):
+        self.props.model = model
+        self.models_set += 1
+
+    def get_sorting_type(self):
+        return self.sorting_type
+
+    def set_sorting_type(self, sorting_type):
+        self.sorting_type = sorting_type
+        self.sorts += 1
+
+
+class DisplayPage(Signals):
+    pass
+
+
+class Source(DisplayPage):
+    def __init__(self, name, query_model):
+        DisplayPage.__init__(
+            self, name=name, query_model=query_model,
+            base_query_model=query_model
+            )
+        self.entry_view = EntryView(query_model)
+
+    def get_entry_view(self):
+        return self.entry_view
+
+
+class BrowserSource(Source):
+    pass
+
+
+class LibrarySource(BrowserSource):
+    pass
+
+
+class PlaylistSource(Source):
+    pass
+
+
+class StaticPlaylistSource(PlaylistSource):
+    pass
+
+
+class AutoPlaylistSource(PlaylistSource):
+    pass
+
+
+class PlayOrder(GObjectObject):
+    __gtype__ = None
+
+    def __init__(self, **kwargs):
+        GObjectObject.__init__(self, **kwargs)
+        self.playing_entry = None
+
+    def get_db(self):
+        return self.props.player.props.db
+
+    def get_query_model(self):
+        return getattr(self.props, 'query_model', None)
+
+    def get_playing_entry(self):
+        return self.playing_entry
+
+    def set_playing_entry(self, entry):
+        self.playing_entry = entry
+
+
+class ShellPlayer(Signals):
+    def __init__(self, db):
+        Signals.__init__(self, db=db)
+        self.play_orders = {}
+
+    def add_play_order(self, name, description, order_type, hidden):
+        self.play_orders[name] = (description, order_type, hidden)
+
+    def remove_play_order(self, name):
+        self.play_orders.pop(name, None)
+
+
+class PlaylistManager(object):
+    def __init__(self):
+        self.playlists = []
+
+    def get_playlists(self):
+        return list(self.playlists)
+
+
+class Shell(Signals):
+    def __init__(self, db, library_source):
+        Signals.__init__(
+            self, db=db, library_source=library_source,
+            selected_page=library_source,
+            display_page_tree=Signals(),
+            shell_player=ShellPlayer(db),
+            playlist_manager=PlaylistManager(),
+            ui_manager=UIManager()
+            )
+        self.data = {}
+
+    def set_data(self, key, value):
+        self.data[key] = value
+
+    def get_data(self, key):
+        return self.data.get(key)
+
+    def select(self, page):
+        '''
+        Selects a page, as clicking it in the display page tree would.
+        '''
+        self.props.selected_page = page
+        self.props.display_page_tree.emit('selected', page)
+
+
+def user_cache_dir():
+    '''
+    Returns the folder the harness keeps Rhythmbox's cache in, which is
+    $FAKERB_CACHE_DIR if it is set.
+    '''
+    return os.environ.get(
+        'FAKERB_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'fakerb-cache')
+        )
+
+
+# rb
+
+def find_plugin_file(plugin, filename):
+    return os.path.join(COMMON_PATH, filename)
+
+
+def make_module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    '''
+    Installs the stand-ins as gi.repository.* and rb in sys.modules.
+    '''
+    gi = make_module('gi', require_version=lambda name, version: None)
+    repository = make_module('gi.repository')
+    gi.repository = repository
+    repository.GObject = make_module(
+        'gi.repository.GObject', Object=GObjectObject,
+        property=gobject_property
+        )
+    repository.GLib = make_module(
+        'gi.repository.GLib', Variant=Variant, VariantType=VariantType,
+        idle_add=main_context.idle_add,
+        timeout_add=main_context.timeout_add,
+        timeout_add_seconds=main_context.timeout_add_seconds,
+        source_remove=main_context.source_remove,
+        PRIORITY_DEFAULT=0, PRIORITY_DEFAULT_IDLE=200, PRIORITY_LOW=300
+        )
+    repository.Gio = make_module(
+        'gi.repository.Gio', Settings=Settings, SimpleAction=SimpleAction,
+        Menu=Menu, MenuItem=MenuItem, Application=Application
+        )
+    repository.Gtk = make_module(
+        'gi.repository.Gtk', RadioAction=RadioAction,
+        ActionGroup=ActionGroup
+        )
+    repository.Peas = make_module(
+        'gi.repository.Peas', Activatable=Activatable
+        )
+    repository.PeasGtk = make_module(
+        'gi.repository.PeasGtk', Configurable=Configurable
+        )
+    repository.RB = make_module(
+        'gi.repository.RB', RhythmDBPropType=RhythmDBPropType,
+        RhythmDB=RhythmDB, RhythmDBQueryModel=RhythmDBQueryModel,
+        DisplayPage=DisplayPage, Source=Source, BrowserSource=BrowserSource,
+        LibrarySource=LibrarySource, PlaylistSource=PlaylistSource,
+        StaticPlaylistSource=StaticPlaylistSource,
+        AutoPlaylistSource=AutoPlaylistSource, PlayOrder=PlayOrder,
+        EntryView=EntryView, user_cache_dir=user_cache_dir
+        )
+    make_module('rb', find_plugin_file=find_plugin_file)
+    return repository
+
+
+def load_plugin(plugin_path, module_name='RatingFilters'):
+    '''
+    Imports a plugin module from a plugin directory, after installing the
+    stand-ins. The common directory is also put on the path, as it is in
+    an installed plugin.
+    '''
+    install()
+    for path in [COMMON_PATH, plugin_path]:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    path = os.path.join(plugin_path, module_name + '.py')
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        import imp
+        return imp.load_source(module_name, path)
+    spec = spec_from_file_location(module_name, path)
+    module = module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_entry(entry_id, rng):
+    '''
+    Returns a library entry with a plausible rating and play history.
+    '''
+    rating = rng.choice([0.0, 0.0, 0.0, 1.0, 2.0, 3.0, 3.0, 4.0, 4.0, 5.0])
+    if rng.random() < 0.05:
+        rating = rng.choice([0.5, 2.5, 3.5, 4.5])
+    artist = 'Artist %d' % rng.randrange(max(1, entry_id // 40 + 1))
+    return RhythmDBEntry({
+        RhythmDBPropType.ENTRY_ID: entry_id,
+        RhythmDBPropType.TITLE: 'Track %d' % entry_id,
+        RhythmDBPropType.GENRE: 'Genre %d' % rng.randrange(20),
+        RhythmDBPropType.ARTIST: artist,
+        RhythmDBPropType.ALBUM_ARTIST: '',
+        RhythmDBPropType.ALBUM: 'Album %d' % (entry_id // 12),
+        RhythmDBPropType.LOCATION: 'file:///music/%d.ogg' % entry_id,
+        RhythmDBPropType.DURATION: rng.randrange(60, 600),
+        RhythmDBPropType.RATING: rating,
+        RhythmDBPropType.PLAY_COUNT: rng.choice([0, 0, 1, 2, 5, 8, 20, 60]),
+        RhythmDBPropType.LAST_PLAYED: rng.choice([
+            0, int(time.time()) - rng.randrange(365 * 24 * 60 * 60)
+            ])
+        })
+
+
+def make_shell(entries=5000, static_playlists=5, auto_playlists=5,
+               playlist_size=500, seed=0):
+    '''
+    Returns a shell with a library of the given size and some static and
+    automatic playlists drawn from it.
+    '''
+    rng = random.Random(seed)
+    db = RhythmDB()
+    library_model = RhythmDBQueryModel(db)
+    for entry_id in range(1, entries + 1):
+        entry = make_entry(entry_id, rng)
+        db.add(entry)
+        library_model.add_entry(entry, -1)
+    library_source = LibrarySource('Music', library_model)
+    shell = Shell(db, library_source)
+    library = list(db.entries.values())
+    for i in range(static_playlists + auto_playlists):
+        model = RhythmDBQueryModel(db)
+        if i < static_playlists:
+            for entry in rng.sample(library, min(playlist_size, len(library))):
+                model.add_entry(entry, -1)
+            playlist = StaticPlaylistSource('Playlist %d' % i, model)
+        else:
+            genre = 'Genre %d' % rng.randrange(20)
+            for entry in library:
+                if entry.values[RhythmDBPropType.GENRE] == genre:
+                    model.add_entry(entry, -1)
+            playlist = AutoPlaylistSource('Auto Playlist %d' % i, model)
+        shell.props.playlist_manager.playlists.append(playlist)
+    return shell
+
+
+def activate_plugin(module, shell, settings=None):
+    '''
+    Creates and activates the plugin against the shell, with any settings
+    given in place of the schema defaults.
+    '''
+    Application.default = None
+    Settings.stores = {}
+    Settings.instances = []
+    if settings:
+        values = load_schema_defaults()
+        values.update(
+            (key, value) for key, value in settings.items() if key in values
+            )
+        Settings.stores[SCHEMA_ID] = values
+    plugin = module.RatingFiltersPlugin()
+    plugin.object = shell
+    plugin.do_activate()
+    return plugin
+
+
+class Driver(object):
+    '''
+    Drives the plugin the way a user would, hiding the differences between
+    the Gtk.RadioAction UI of the 2.97 and 2.98 releases and the Gio menu
+    of later releases.
+    '''
+    filter_names = {
+        'all': ('All', 'All Ratings'),
+        'favourites': ('Favourites', 'Favourites'),
+        'unrated': ('Unrated', 'Unrated')
+        }
+
+    def __init__(self, plugin, shell):
+        self.plugin = plugin
+        self.shell = shell
+
+    def pages(self):
+        return ([self.shell.props.library_source] +
+                self.shell.props.playlist_manager.get_playlists())
+
+    def select_page(self, page):
+        self.shell.select(page)
+
+    def open_filter_menu(self):
+        '''
+        Opens and closes the Filter menu, setting the state of its
+        submenu-action as GTK does. Does nothing for releases whose menu
+        has none.
+        '''
+        app = Application.get_default()
+        for item in app.plugin_menu_items.values():
+            detailed_action = item.attributes.get('submenu-action')
+            if detailed_action is not None:
+                action = app.lookup_action(
+                    detailed_action.get_string().split('.', 1)[1]
+                    )
+                action.change_state(Variant.new_boolean(True))
+                action.change_state(Variant.new_boolean(False))
+                return
+
+    def select_filter(self, name):
+        old_name, new_name = self.filter_names.get(name, (name, name))
+        if hasattr(self.plugin, 'radioactions'):
+            self.plugin.radioactions[old_name].set_active(True)
+        else:
+            self.plugin.action.activate(self.plugin.target_values[new_name])
+
+    def rate(self, entry, rating):
+        self.shell.props.db.set(entry, RhythmDBPropType.RATING, rating)
+
+    def play(self, entry):
+        db = self.shell.props.db
+        db.set(
+            entry, RhythmDBPropType.PLAY_COUNT,
+            entry.values[RhythmDBPropType.PLAY_COUNT] + 1
+            )
+        db.set(entry, RhythmDBPropType.LAST_PLAYED, int(time.time()))
+
+    def set_threshold(self, threshold):
+        self.plugin.settings['favourites-threshold'] = threshold
+
+    def idle(self):
+        main_context.drain()
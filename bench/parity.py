@@ -0,0 +1,312 @@
+#!/usr/bin/python
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#   parity.py
+#
+#   Cross-release performance parity benchmark for RatingFilters.
+#   Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Replays identical workloads (page switches, filter toggles, rating storms,
+threshold changes and deactivation) against every release of the plugin
+and prints a side-by-side latency and memory report.
+
+Each release is run in its own interpreter, chosen from the Loader line of
+its .plugin file, since the 2.97 and 2.98 releases are Python 2 only:
+
+    python3 bench/parity.py --entries 20000 --python2 python2.7
+'''
+from __future__ import print_function
+
+from argparse import ArgumentParser, SUPPRESS
+from collections import OrderedDict
+import glob
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakerb
+
+WORKLOADS = ['activate', 'page switches', 'filter toggles', 'rating storm',
+             'threshold changes', 'deactivate']
+
+
+def get_plugin_paths():
+    '''
+    Returns the release directories, oldest first, followed by dev.
+    '''
+    def version_key(path):
+        return [int(part) for part in os.path.basename(path).split('.')]
+
+    releases = sorted(
+        glob.glob(os.path.join(fakerb.ROOT_PATH, 'release', '*')),
+        key=version_key
+        )
+    return releases + [os.path.join(fakerb.ROOT_PATH, 'dev')]
+
+
+def get_loader(plugin_path):
+    '''
+    Returns the Peas loader named in the plugin's .plugin file.
+    '''
+    for path in glob.glob(os.path.join(plugin_path, '*.plugin')):
+        with open(path) as plugin_file:
+            for line in plugin_file:
+                if line.startswith('Loader='):
+                    return line.split('=', 1)[1].strip()
+    return 'python'
+
+
+def measure(latencies, function, *args):
+    '''
+    Calls a function and records how long it took.
+    '''
+    start = fakerb.timer()
+    function(*args)
+    latencies.append(fakerb.timer() - start)
+
+
+def get_memory():
+    '''
+    Returns the peak memory use of the process in KiB, preferring traced
+    Python allocations where tracemalloc is available.
+    '''
+    try:
+        import tracemalloc
+        return tracemalloc.get_traced_memory()[1] // 1024
+    except ImportError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_workloads(plugin_path, options):
+    '''
+    Runs every workload against one plugin and returns the results.
+    '''
+    try:
+        import tracemalloc
+        tracemalloc.start()
+    except ImportError:
+        pass
+
+    module = fakerb.load_plugin(plugin_path)
+    shell = fakerb.make_shell(
+        entries=options.entries, static_playlists=options.playlists,
+        auto_playlists=options.playlists, seed=options.seed
+        )
+    rng = random.Random(options.seed)
+    latencies = dict((workload, []) for workload in WORKLOADS)
+    memory = {}
+
+    baseline = get_memory()
+    plugin = [None]
+
+    def activate():
+        plugin[0] = fakerb.activate_plugin(module, shell)
+
+    measure(latencies['activate'], activate)
+    memory['activate'] = get_memory() - baseline
+    driver = fakerb.Driver(plugin[0], shell)
+    pages = driver.pages()
+    library = list(shell.props.db.entries.values())
+
+    # The first filter change on a page sets up the plugin's callbacks.
+    driver.select_filter('all')
+
+    for _ in range(options.rounds):
+        for page in pages:
+            measure(latencies['page switches'], driver.select_page, page)
+    memory['page switches'] = get_memory() - baseline
+
+    for _ in range(options.rounds):
+        for page in pages:
+            driver.select_page(page)
+            for name in ['favourites', 'unrated', 'all', 'favourites']:
+                measure(latencies['filter toggles'], driver.select_filter, name)
+    memory['filter toggles'] = get_memory() - baseline
+
+    driver.select_page(shell.props.library_source)
+    driver.select_filter('favourites')
+    for _ in range(options.ratings):
+        entry = rng.choice(library)
+        rating = float(rng.randrange(6))
+        measure(latencies['rating storm'], driver.rate, entry, rating)
+    driver.idle()
+    memory['rating storm'] = get_memory() - baseline
+
+    for threshold in [3, 5, 2, 4] * options.rounds:
+        measure(latencies['threshold changes'], driver.set_threshold, threshold)
+    memory['threshold changes'] = get_memory() - baseline
+
+    measure(latencies['deactivate'], plugin[0].do_deactivate)
+    memory['deactivate'] = get_memory() - baseline
+
+    views = [page.get_entry_view() for page in pages]
+    return {
+        'latencies': latencies,
+        'memory': memory,
+        'models_set': sum(view.models_set for view in views),
+        'sorts': sum(view.sorts for view in views)
+        }
+
+
+def run_worker(plugin_path, output_path, options):
+    '''
+    Runs the workloads in this process and writes the results as JSON. The
+    plugin's own logging is discarded.
+    '''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        results = run_workloads(plugin_path, options)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    with open(output_path, 'w') as output_file:
+        json.dump(results, output_file)
+
+
+def run_release(plugin_path, options):
+    '''
+    Runs the workloads against a release in a subprocess using the matching
+    interpreter. Returns the results, or an error string.
+    '''
+    if get_loader(plugin_path) == 'python3':
+        interpreter = options.python3
+    else:
+        interpreter = options.python2
+    handle, output_path = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    command = [
+        interpreter, os.path.abspath(__file__), '--worker', plugin_path,
+        '--output', output_path, '--entries', str(options.entries),
+        '--playlists', str(options.playlists), '--ratings',
+        str(options.ratings), '--rounds', str(options.rounds),
+        '--seed', str(options.seed)
+        ]
+    try:
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+        _, error = process.communicate()
+        if process.returncode != 0:
+            lines = error.decode('utf-8', 'replace').strip().splitlines()
+            return 'failed: ' + (lines[-1] if lines else 'no output')
+        with open(output_path) as output_file:
+            return json.load(output_file)
+    except OSError as e:
+        return 'skipped: cannot run %s (%s)' % (interpreter, e)
+    finally:
+        os.remove(output_path)
+
+
+def percentile(values, fraction):
+    '''
+    Returns the value at a fraction of the way through the sorted values.
+    '''
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def print_report(results):
+    '''
+    Prints latency and memory side by side for every release.
+    '''
+    names = [os.path.basename(path) for path in results]
+    width = max([12] + [len(name) for name in names]) + 2
+    header = '%-34s' % '' + ''.join(name.rjust(width) for name in names)
+
+    def row(label, cell):
+        cells = []
+        for path in results:
+            result = results[path]
+            cells.append(
+                ('-' if isinstance(result, str) else cell(result)).rjust(width)
+                )
+        print('%-34s' % label + ''.join(cells))
+
+    print(header)
+    for workload in WORKLOADS:
+        for label, fraction in [('median', 0.5), ('p95', 0.95), ('max', 1.0)]:
+            row(
+                '%s %s (ms)' % (workload, label),
+                lambda result: '%.3f' % (1000 * percentile(
+                    result['latencies'][workload], fraction
+                    ))
+                )
+        row(
+            '%s total (ms)' % workload,
+            lambda result: '%.1f' % (1000 * sum(result['latencies'][workload]))
+            )
+        row(
+            '%s memory (KiB)' % workload,
+            lambda result: str(result['memory'][workload])
+            )
+    row('entry view models set', lambda result: str(result['models_set']))
+    row('entry view re-sorts', lambda result: str(result['sorts']))
+    print('\nMemory is the growth in peak traced allocations under Python 3, '
+          'or in peak RSS\nunder Python 2.')
+    for path in results:
+        if isinstance(results[path], str):
+            print('%s: %s' % (os.path.basename(path), results[path]))
+
+
+def main():
+    parser = ArgumentParser(
+        description='Compares the performance of every RatingFilters '
+                    'release under identical workloads.')
+    parser.add_argument('--entries', type=int, default=5000,
+                        help='number of tracks in the library')
+    parser.add_argument('--playlists', type=int, default=5,
+                        help='number of static and of automatic playlists')
+    parser.add_argument('--ratings', type=int, default=200,
+                        help='number of rating changes in the rating storm')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='number of times to repeat each workload')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the library and workloads')
+    parser.add_argument('--python2', default='python2',
+                        help='interpreter for Python 2 releases')
+    parser.add_argument('--python3', default=sys.executable,
+                        help='interpreter for Python 3 releases')
+    parser.add_argument('--release', action='append',
+                        help='only run the named release (e.g. 3.0 or dev)')
+    parser.add_argument('--worker', help=SUPPRESS)
+    parser.add_argument('--output', help=SUPPRESS)
+    options = parser.parse_args()
+
+    if options.worker:
+        run_worker(options.worker, options.output, options)
+        return
+
+    results = OrderedDict()
+    paths = get_plugin_paths()
+    if options.release:
+        paths = [p for p in paths if os.path.basename(p) in options.release]
+    for path in paths:
+        sys.stderr.write('Benchmarking %s...\n' % os.path.basename(path))
+        results[path] = run_release(path, options)
+    print_report(results)
+
+
+if __name__ == '__main__':
+    main()
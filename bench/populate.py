@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#   populate.py
+#
+#   Query model population benchmark for RatingFilters.
+#   Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Measures how many source rows per second a release of the plugin gets
+through when it starts tracking a page and when it fills rating filtered
+models from it, using the release's own PageFilters class:
+
+    python3 bench/populate.py --entries 50000 --release 3.0 --release dev
+
+Only Python 3 releases with a PageFilters class can be measured. The
+stand-in rows are much cheaper than Gtk.TreeModelRow, so the gain from not
+creating them is understated here.
+'''
+from __future__ import print_function
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakerb
+import parity
+
+STAGES = ['track page', 'fill Favourites', 'fill Unrated', 'fill 5 Stars']
+
+
+def best(function, runs):
+    '''
+    Returns the shortest time taken by a function over a number of runs,
+    and its last result.
+    '''
+    times = []
+    for _ in range(runs):
+        start = fakerb.timer()
+        result = function()
+        times.append(fakerb.timer() - start)
+    return min(times), result
+
+
+def run_release(plugin_path, options):
+    '''
+    Returns the rows per second of each stage for a release, or an error
+    string.
+    '''
+    module = fakerb.load_plugin(plugin_path)
+    if not hasattr(module, 'PageFilters'):
+        return 'skipped: no PageFilters class'
+    from RatingFiltersCore import compile_rating_range, RatingIndex
+    shell = fakerb.make_shell(
+        entries=options.entries, static_playlists=0, auto_playlists=0,
+        seed=0
+        )
+    db = shell.props.db
+    query_model = shell.props.library_source.props.base_query_model
+    rows = len(query_model)
+    tables = {
+        'fill Favourites': compile_rating_range(4.0, 5.0),
+        'fill Unrated': compile_rating_range(0.0, 0.0),
+        'fill 5 Stars': compile_rating_range(5.0, 5.0)
+        }
+
+    def track():
+        return module.PageFilters(query_model, RatingIndex())
+
+    results = {}
+    elapsed, page_filters = best(track, options.runs)
+    results['track page'] = rows / elapsed
+    for stage in STAGES[1:]:
+        def fill():
+            new_query_model = fakerb.RhythmDBQueryModel.new_empty(db)
+            page_filters.add_filter(stage, tables[stage], new_query_model)
+            page_filters.remove_filter(stage)
+        elapsed, _ = best(fill, options.runs)
+        results[stage] = rows / elapsed
+    page_filters.stop()
+    return results
+
+
+def main():
+    parser = ArgumentParser(
+        description='Measures how fast each release fills rating filtered '
+                    'query models.')
+    parser.add_argument('--entries', type=int, default=50000,
+                        help='number of tracks in the library')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='number of runs per stage (the best is shown)')
+    parser.add_argument('--release', action='append',
+                        help='only run the named release (e.g. 3.0 or dev)')
+    options = parser.parse_args()
+
+    paths = parity.get_plugin_paths()
+    if options.release:
+        paths = [p for p in paths if os.path.basename(p) in options.release]
+    results = OrderedDict()
+    for path in paths:
+        if parity.get_loader(path) != 'python3':
+            continue
+        sys.stderr.write('Benchmarking %s...\n' % os.path.basename(path))
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            results[path] = run_release(path, options)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        for name in ['RatingFilters', 'RatingFiltersCore',
+                     'RatingFiltersPages']:
+            sys.modules.pop(name, None)
+        if path in sys.path:
+            sys.path.remove(path)
+
+    names = [os.path.basename(path) for path in results]
+    width = max([12] + [len(name) for name in names]) + 2
+    print('%-26s' % '' + ''.join(name.rjust(width) for name in names))
+    for stage in STAGES:
+        cells = []
+        for path in results:
+            result = results[path]
+            if isinstance(result, str):
+                cells.append('-'.rjust(width))
+            else:
+                cells.append(('%.0f' % result[stage]).rjust(width))
+        print('%-26s' % (stage + ' (rows/s)') + ''.join(cells))
+    for path in results:
+        if isinstance(results[path], str):
+            print('%s: %s' % (os.path.basename(path), results[path]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#   profiles.py
+#
+#   Filter profile check for RatingFilters.
+#   Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Checks that filter profiles whose names are used twice, or clash with a
+built in filter, are skipped: the first profile with a name wins, and the
+Filter menu never shows two items with the same name. The profiles are
+loaded at activation and again after the filter-profiles setting changes:
+
+    python3 bench/profiles.py --release dev
+
+Exits with status 1 if any check fails. Only releases with filter
+profiles can be checked.
+'''
+from __future__ import print_function
+
+from argparse import ArgumentParser
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakerb
+import parity
+
+PROFILES = [
+    [('Gems', 4.5, 5.0), ('Gems', 1.0, 2.0), ('Favourites', 1.0, 1.0),
+     ('Five Stars', 5.0, 5.0)],
+    [('Half', 0.5, 2.5), ('Top Tracks', 4.0, 5.0), ('Half', 3.0, 3.0),
+     ('Half', 4.0, 4.0)]
+    ]
+
+
+def get_expected(profiles, filter_names):
+    '''
+    Returns the names and rating ranges of the profiles that should be
+    loaded: the first of each name that isn't a built in filter.
+    '''
+    expected = []
+    for name, minimum, maximum in profiles:
+        if name not in filter_names and name not in dict(expected):
+            expected.append((name, (minimum, maximum)))
+    return expected
+
+
+def check_plugin(plugin, profiles, compile_rating_range):
+    '''
+    Returns a description of each way the loaded profiles are wrong.
+    '''
+    failures = []
+    expected = get_expected(profiles, plugin.filter_names)
+    if plugin.profile_names != [name for name, _ in expected]:
+        failures.append('loaded profiles %r, expected %r' % (
+            plugin.profile_names, [name for name, _ in expected]
+            ))
+    for name, (minimum, maximum) in expected:
+        if (plugin.rating_tables.get(name) !=
+                compile_rating_range(minimum, maximum)):
+            failures.append("'%s' doesn't use its first rating range" % name)
+    labels = []
+    for section, _ in plugin.menu_sections:
+        labels += [item.attributes['label'] for item in section.items]
+    for label in sorted(set(labels)):
+        if labels.count(label) > 1:
+            failures.append("the Filter menu shows '%s' %d times" % (
+                label, labels.count(label)
+                ))
+    targets = [value.get_string() for value in plugin.target_values.values()]
+    if len(set(targets)) != len(targets):
+        failures.append('two filters share an action target')
+    return failures
+
+
+def main():
+    parser = ArgumentParser(
+        description='Checks that RatingFilters skips filter profiles with '
+                    'duplicate names.')
+    parser.add_argument('--release', default='dev',
+                        help='release to check (e.g. dev)')
+    options = parser.parse_args()
+
+    paths = [path for path in parity.get_plugin_paths()
+             if os.path.basename(path) == options.release]
+    if not paths:
+        parser.error('no release named %s' % options.release)
+    if parity.get_loader(paths[0]) != 'python3':
+        parser.error('only Python 3 releases can be checked')
+
+    module = fakerb.load_plugin(paths[0])
+    from RatingFiltersCore import compile_rating_range
+    shell = fakerb.make_shell(
+        entries=500, static_playlists=1, auto_playlists=0, seed=0
+        )
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    failures = []
+    try:
+        plugin = fakerb.activate_plugin(
+            module, shell, settings={'filter-profiles': PROFILES[0]}
+            )
+        if not hasattr(plugin, 'profile_names'):
+            sys.stdout = stdout
+            parser.error('%s has no filter profiles' % options.release)
+        failures += check_plugin(plugin, PROFILES[0], compile_rating_range)
+        plugin.settings['filter-profiles'] = PROFILES[1]
+        failures += check_plugin(plugin, PROFILES[1], compile_rating_range)
+        plugin.do_deactivate()
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    for failure in failures:
+        print('FAIL: ' + failure)
+    if failures:
+        sys.exit(1)
+    print('PASS: %d profile lists' % len(PROFILES))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#   replay.py
+#
+#   Signal trace replayer for RatingFilters.
+#   Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Plays a trace recorded by the plugin (see the trace-recording setting) back
+into a release of the plugin running against the headless stand-ins, and
+reports the latency of every kind of event. The library and pages are
+rebuilt from the entry IDs and ratings in the trace:
+
+    python3 bench/replay.py ~/.cache/rhythmbox/rating-filters/trace-*.jsonl
+
+By default events are replayed as fast as possible; --speed 1 keeps the
+original timing and --speed 10 replays ten times faster. Timeouts and idle
+callbacks run between events as they come due, and their cost is reported
+as main loop work.
+'''
+from __future__ import print_function
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakerb
+import parity
+
+PAGE_TYPES = {
+    'library': fakerb.LibrarySource,
+    'static': fakerb.StaticPlaylistSource,
+    'auto': fakerb.AutoPlaylistSource,
+    'other': fakerb.Source
+    }
+
+
+def load_trace(path):
+    '''
+    Returns the settings, library and events of a trace.
+    '''
+    with open(path) as trace_file:
+        header = json.loads(trace_file.readline())
+        if header[0] != 'trace' or header[2] != 1:
+            raise ValueError('%s is not a version 1 trace' % path)
+        events = [json.loads(line) for line in trace_file if line.strip()]
+    settings = header[3]
+    settings['trace-recording'] = False
+    return settings, header[4], events
+
+
+def make_model(db, entry_ids):
+    '''
+    Returns a query model holding the entries with the given IDs that are
+    in the database.
+    '''
+    model = fakerb.RhythmDBQueryModel(db)
+    for entry_id in entry_ids:
+        entry = db.entry_lookup_by_id(entry_id)
+        if entry is not None:
+            model.add_entry(entry, -1)
+    return model
+
+
+def make_shell(library, events, seed=0):
+    '''
+    Returns a shell holding the traced library and a page for every page
+    in the trace, and the pages by ID. Track metadata the trace leaves out
+    is made up.
+    '''
+    rng = random.Random(seed)
+    db = fakerb.RhythmDB()
+    for entry_id, rating in library:
+        entry = fakerb.make_entry(entry_id, rng)
+        entry.values[fakerb.RhythmDBPropType.RATING] = rating
+        db.add(entry)
+    library_source = fakerb.LibrarySource(
+        'Music', make_model(db, [entry_id for entry_id, _ in library])
+        )
+    shell = fakerb.Shell(db, library_source)
+    pages = {}
+    for event in events:
+        if event[0] != 'page':
+            continue
+        _, _, page_id, kind, entry_ids = event
+        if kind == 'library':
+            page = library_source
+            if len(entry_ids) != len(library):
+                page.get_entry_view().props.model = make_model(db, entry_ids)
+        else:
+            page = PAGE_TYPES[kind](
+                'Page %d' % page_id, make_model(db, entry_ids)
+                )
+            if kind != 'other':
+                shell.props.playlist_manager.playlists.append(page)
+        pages[page_id] = page
+    return shell, pages
+
+
+class Replayer(object):
+    '''
+    Applies trace events to the shell and the plugin.
+    '''
+    def __init__(self, plugin, shell, pages):
+        self.plugin = plugin
+        self.shell = shell
+        self.pages = pages
+        self.driver = fakerb.Driver(plugin, shell)
+        self.filter_names = dict(
+            (new_name, name)
+            for name, (_, new_name) in fakerb.Driver.filter_names.items()
+            )
+
+    def dispatch(self, event):
+        '''
+        Applies an event. Returns False if it could not be applied.
+        '''
+        handler = getattr(self, 'on_' + event[0], None)
+        if handler is None:
+            return False
+        return handler(*event[2:]) is not False
+
+    def on_page(self, page_id, kind, entry_ids):
+        pass
+
+    def on_select(self, page_id):
+        self.shell.select(self.pages[page_id])
+
+    def on_browse(self, page_id, entry_ids):
+        page = self.pages[page_id]
+        page.get_entry_view().props.model = make_model(
+            self.shell.props.db, entry_ids
+            )
+        page.emit('filter-changed')
+
+    def on_filter(self, filter_name):
+        try:
+            self.driver.select_filter(
+                self.filter_names.get(filter_name, filter_name)
+                )
+        except KeyError:
+            return False
+
+    def on_entry(self, entry_id, rating):
+        db = self.shell.props.db
+        entry = db.entry_lookup_by_id(entry_id)
+        if entry is None:
+            return False
+        db.set(entry, fakerb.RhythmDBPropType.RATING, rating)
+
+    def on_delete(self, entry_id):
+        db = self.shell.props.db
+        entry = db.entry_lookup_by_id(entry_id)
+        if entry is None:
+            return False
+        db.delete(entry)
+        for page in [self.shell.props.library_source] + list(
+            self.pages.values()):
+            page.props.base_query_model.remove_entry(entry)
+            page.get_entry_view().props.model.remove_entry(entry)
+
+    def on_setting(self, key, value):
+        if key not in self.plugin.settings.values:
+            return False
+        self.plugin.settings[key] = value
+
+
+def replay(plugin_path, trace_path, options):
+    '''
+    Replays a trace against a plugin and returns the latency of each
+    event as (index, event type, trace time, seconds), the main loop
+    latencies and the number of events that could not be applied.
+    '''
+    settings, library, events = load_trace(trace_path)
+    module = fakerb.load_plugin(plugin_path)
+    shell, pages = make_shell(library, events, options.seed)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        plugin = fakerb.activate_plugin(module, shell, settings)
+        replayer = Replayer(plugin, shell, pages)
+        latencies = []
+        main_loop = []
+        skipped = 0
+        start = fakerb.timer()
+        for index, event in enumerate(events):
+            if event[0] == 'page':
+                continue
+            if options.speed > 0:
+                due = start + event[1] / 1000.0 / options.speed
+                while fakerb.timer() < due:
+                    fakerb.main_context.iteration()
+                    time.sleep(max(0, min(0.001, due - fakerb.timer())))
+            t0 = fakerb.timer()
+            applied = replayer.dispatch(event)
+            t1 = fakerb.timer()
+            if applied:
+                latencies.append((index, event[0], event[1], t1 - t0))
+            else:
+                skipped += 1
+            if fakerb.main_context.iteration():
+                main_loop.append(fakerb.timer() - t1)
+        fakerb.main_context.drain()
+        plugin.do_deactivate()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return latencies, main_loop, skipped
+
+
+def print_report(latencies, main_loop, skipped, slowest):
+    '''
+    Prints latency by event type and the slowest events.
+    '''
+    by_type = OrderedDict()
+    for _, event_type, _, seconds in latencies:
+        by_type.setdefault(event_type, []).append(seconds)
+    by_type['main loop'] = main_loop
+    print('%-12s%10s%14s%14s%14s%14s' % (
+        '', 'events', 'median (ms)', 'p95 (ms)', 'max (ms)', 'total (ms)'
+        ))
+    for event_type, values in by_type.items():
+        if not values:
+            continue
+        print('%-12s%10d%14.3f%14.3f%14.3f%14.1f' % (
+            event_type, len(values),
+            1000 * parity.percentile(values, 0.5),
+            1000 * parity.percentile(values, 0.95),
+            1000 * max(values), 1000 * sum(values)
+            ))
+    if slowest:
+        print('\nSlowest events:')
+        for index, event_type, t, seconds in sorted(
+            latencies, key=lambda latency: -latency[3])[:slowest]:
+            print('  line %-8d %-8s at %8.3fs %10.3f ms' % (
+                index + 2, event_type, t / 1000.0, 1000 * seconds
+                ))
+    if skipped:
+        print('\n%d events could not be applied to this release.' % skipped)
+
+
+def main():
+    parser = ArgumentParser(
+        description='Replays a recorded RatingFilters signal trace against '
+                    'the plugin and reports per-event latency.')
+    parser.add_argument('trace', help='trace file written by the plugin')
+    parser.add_argument('--release', default='dev',
+                        help='release to replay against (e.g. 3.0 or dev)')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='replay speed relative to the recording, or 0 '
+                             'to replay as fast as possible')
+    parser.add_argument('--slowest', type=int, default=10,
+                        help='number of slowest events to list')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the made up track metadata')
+    options = parser.parse_args()
+
+    paths = [path for path in parity.get_plugin_paths()
+             if os.path.basename(path) == options.release]
+    if not paths:
+        parser.error('no release named %s' % options.release)
+    latencies, main_loop, skipped = replay(paths[0], options.trace, options)
+    print_report(latencies, main_loop, skipped, options.slowest)
+
+
+if __name__ == '__main__':
+    main()
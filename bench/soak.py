@@ -0,0 +1,378 @@
+#!/usr/bin/python
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#   soak.py
+#
+#   Soak and stress test harness for RatingFilters.
+#   Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Drives a release of the plugin against the headless stand-ins for a long
+time: a sustained storm of rating changes, playlists being created and
+deleted, rapid page switches and filter changes, and a favourites threshold
+that keeps moving. Every interval it prints memory use, live signal
+handlers and query models, stale cache entries and operation latency, and
+at the end it fails (with exit status 1) if any sample after warming up,
+by which time most pages have a cached model for most filters, has grown
+beyond its bounds since the first such sample, or kept up with too small a
+fraction of the requested rating rate:
+
+    python3 bench/soak.py --duration 3600 --ratings 5000
+
+Run it with the interpreter the release needs (python2 for 2.97 and 2.98).
+'''
+from __future__ import print_function
+
+from argparse import ArgumentParser
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakerb
+import parity
+
+OPERATIONS = ['rating', 'page switch', 'filter', 'create playlist',
+              'delete playlist', 'threshold']
+
+
+def get_memory():
+    '''
+    Returns the memory in use in KiB: traced Python allocations where
+    tracemalloc is available, or else peak RSS.
+    '''
+    try:
+        import tracemalloc
+        return tracemalloc.get_traced_memory()[0] // 1024
+    except ImportError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_handler_count():
+    '''
+    Returns the number of signal handlers connected to live objects.
+    '''
+    return sum(len(gobject.handlers) for gobject in list(fakerb.Signals.live))
+
+
+def get_model_count():
+    '''
+    Returns the number of live query models.
+    '''
+    return len([
+        gobject for gobject in list(fakerb.Signals.live)
+        if isinstance(gobject, fakerb.RhythmDBQueryModel)
+        ])
+
+
+def get_stale_count(plugin, pages, db):
+    '''
+    Returns the number of cache entries the plugin holds for pages, query
+    models or entries that no longer exist. Caches a release doesn't have
+    are skipped.
+    '''
+    visited_pages = getattr(plugin, 'visited_pages', {})
+    stale = len([page for page in visited_pages if page not in pages])
+    models = set()
+    for page in visited_pages:
+        if page in pages:
+            models.update(visited_pages[page][1].values())
+    for name in ['streams', 'rating_models', 'page_filters']:
+        stale += len([
+            model for model in getattr(plugin, name, {}) if model not in models
+            ])
+    stale += len([
+        page for page in getattr(plugin, 'active_filter', {})
+        if page not in pages
+        ])
+    rating_index = getattr(plugin, 'rating_index', None)
+    if rating_index is not None:
+        stale += len([
+            entry_id for entry_id in rating_index.buckets
+            if db.entry_lookup_by_id(entry_id) is None
+            ])
+    return stale
+
+
+class Soak(object):
+    '''
+    Runs the operations at their target rates and keeps the latencies of
+    those run since the last sample.
+    '''
+    def __init__(self, plugin, shell, options):
+        self.plugin = plugin
+        self.shell = shell
+        self.driver = fakerb.Driver(plugin, shell)
+        self.rng = random.Random(options.seed)
+        self.library = list(shell.props.db.entries.values())
+        self.filter_names = list(
+            getattr(plugin, 'target_values', None) or fakerb.Driver.filter_names
+            )
+        self.playlists = 0
+        self.options = options
+        self.rates = {
+            'rating': options.ratings,
+            'page switch': options.page_switches,
+            'filter': options.filters,
+            'create playlist': options.playlists,
+            'delete playlist': options.playlists,
+            'threshold': options.thresholds
+            }
+        self.latencies = dict((operation, []) for operation in OPERATIONS)
+
+    def rating(self):
+        self.driver.rate(
+            self.rng.choice(self.library), float(self.rng.randrange(6))
+            )
+
+    def page_switch(self):
+        self.driver.select_page(self.rng.choice(self.driver.pages()))
+        if self.rng.random() < 0.5:
+            self.driver.open_filter_menu()
+
+    def filter(self):
+        self.driver.select_filter(self.rng.choice(self.filter_names))
+
+    def create_playlist(self):
+        self.playlists += 1
+        model = fakerb.RhythmDBQueryModel(self.shell.props.db)
+        for entry in self.rng.sample(
+            self.library, min(self.options.playlist_size, len(self.library))):
+            model.add_entry(entry, -1)
+        page = fakerb.StaticPlaylistSource(
+            'Soak Playlist %d' % self.playlists, model
+            )
+        self.shell.props.playlist_manager.playlists.append(page)
+        self.driver.select_page(page)
+
+    def delete_playlist(self):
+        '''
+        Deletes a playlist, as Rhythmbox does: the library is selected if
+        the playlist was, and the page emits deleted.
+        '''
+        playlists = self.shell.props.playlist_manager.playlists
+        if len(playlists) <= self.options.min_playlists:
+            return
+        page = playlists.pop(self.rng.randrange(len(playlists)))
+        if self.shell.props.selected_page is page:
+            self.driver.select_page(self.shell.props.library_source)
+        page.emit('deleted')
+
+    def threshold(self):
+        self.driver.set_threshold(self.rng.randrange(1, 6))
+
+    def run(self, duration):
+        '''
+        Runs the operations for a number of seconds, dispatching due
+        timeouts and idle callbacks in between.
+        '''
+        start = fakerb.timer()
+        due = dict((operation, start) for operation in OPERATIONS)
+        end = start + duration
+        while True:
+            now = fakerb.timer()
+            if now >= end:
+                break
+            ran = False
+            for operation in OPERATIONS:
+                rate = self.rates[operation]
+                if rate <= 0 or due[operation] > now:
+                    continue
+                # Don't try to catch up on more than a second of backlog.
+                due[operation] = max(due[operation], now - 1) + 1.0 / rate
+                t0 = fakerb.timer()
+                getattr(self, operation.replace(' ', '_'))()
+                self.latencies[operation].append(fakerb.timer() - t0)
+                ran = True
+            fakerb.main_context.iteration()
+            if not ran:
+                time.sleep(max(0, min(0.001, min(due.values()) - now)))
+
+    def sample(self):
+        '''
+        Returns the operation latencies since the last sample and starts
+        collecting them afresh.
+        '''
+        latencies = self.latencies
+        self.latencies = dict((operation, []) for operation in OPERATIONS)
+        return latencies
+
+
+def take_sample(soak, elapsed, interval):
+    '''
+    Returns the state of the plugin and the stand-ins.
+    '''
+    shell = soak.shell
+    pages = set(soak.driver.pages())
+    latencies = soak.sample()
+    return {
+        'elapsed': elapsed,
+        'interval': interval,
+        'memory': get_memory(),
+        'handlers': get_handler_count(),
+        'models': get_model_count(),
+        'stale': get_stale_count(soak.plugin, pages, shell.props.db),
+        'operations': sum(len(values) for values in latencies.values()),
+        'ratings': len(latencies['rating']),
+        'rating p95': parity.percentile(latencies['rating'], 0.95),
+        'max': max([0] + [max(values) for values in latencies.values() if values])
+        }
+
+
+def check(baseline, last, options):
+    '''
+    Returns a description of each bound a sample exceeds.
+    '''
+    failures = []
+    rate = last['ratings'] / last['interval']
+    if rate < options.min_rating_rate * options.ratings:
+        failures.append('%.0f ratings/s (bound %.0f ratings/s)' % (
+            rate, options.min_rating_rate * options.ratings
+            ))
+    growth = last['memory'] - baseline['memory']
+    if growth > options.max_memory_growth:
+        failures.append('memory grew by %d KiB (bound %d KiB)' % (
+            growth, options.max_memory_growth
+            ))
+    for name in ['handlers', 'models']:
+        growth = last[name] - baseline[name]
+        if growth > options.max_handler_growth:
+            failures.append('live %s grew by %d (bound %d)' % (
+                name, growth, options.max_handler_growth
+                ))
+    drift = last['rating p95'] / max(baseline['rating p95'], 1e-5)
+    if drift > options.max_latency_drift:
+        failures.append('rating p95 latency drifted %.1fx (bound %.1fx)' % (
+            drift, options.max_latency_drift
+            ))
+    if last['stale'] > options.max_stale:
+        failures.append('%d stale cache entries (bound %d)' % (
+            last['stale'], options.max_stale
+            ))
+    return failures
+
+
+def main():
+    parser = ArgumentParser(
+        description='Soak tests a RatingFilters release under sustained '
+                    'load and fails if it leaks or slows down.')
+    parser.add_argument('--release', default='dev',
+                        help='release to test (e.g. 3.0 or dev)')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='seconds to run for')
+    parser.add_argument('--interval', type=float, default=10,
+                        help='seconds between samples')
+    parser.add_argument('--warmup', type=float, default=30,
+                        help='seconds before the baseline sample')
+    parser.add_argument('--entries', type=int, default=20000,
+                        help='number of tracks in the library')
+    parser.add_argument('--playlist-size', type=int, default=500,
+                        help='number of tracks in each new playlist')
+    parser.add_argument('--min-playlists', type=int, default=5,
+                        help='number of playlists never deleted below')
+    parser.add_argument('--ratings', type=float, default=2000,
+                        help='rating changes per second')
+    parser.add_argument('--page-switches', type=float, default=20,
+                        help='page switches per second')
+    parser.add_argument('--filters', type=float, default=10,
+                        help='filter changes per second')
+    parser.add_argument('--playlists', type=float, default=2,
+                        help='playlists created, and deleted, per second')
+    parser.add_argument('--thresholds', type=float, default=0.5,
+                        help='favourites threshold changes per second')
+    parser.add_argument('--max-memory-growth', type=int, default=8192,
+                        help='allowed memory growth in KiB')
+    parser.add_argument('--max-handler-growth', type=int, default=100,
+                        help='allowed growth in live signal handlers and in '
+                             'live query models')
+    parser.add_argument('--max-latency-drift', type=float, default=3.0,
+                        help='allowed ratio of the last to the baseline '
+                             'sample\'s p95 rating latency')
+    parser.add_argument('--max-stale', type=int, default=0,
+                        help='allowed stale cache entries')
+    parser.add_argument('--min-rating-rate', type=float, default=0.9,
+                        help='fraction of --ratings that must be achieved '
+                             'in every sample')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the library and operations')
+    options = parser.parse_args()
+
+    paths = [path for path in parity.get_plugin_paths()
+             if os.path.basename(path) == options.release]
+    if not paths:
+        parser.error('no release named %s' % options.release)
+
+    try:
+        import tracemalloc
+        tracemalloc.start()
+    except ImportError:
+        pass
+
+    module = fakerb.load_plugin(paths[0])
+    shell = fakerb.make_shell(
+        entries=options.entries, static_playlists=options.min_playlists,
+        auto_playlists=options.min_playlists,
+        playlist_size=options.playlist_size, seed=options.seed
+        )
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    samples = []
+    try:
+        plugin = fakerb.activate_plugin(module, shell)
+        soak = Soak(plugin, shell, options)
+        soak.driver.select_filter('all')
+        elapsed = 0.0
+        while elapsed < options.duration:
+            interval = min(options.interval, options.duration - elapsed)
+            soak.run(interval)
+            elapsed += interval
+            sample = take_sample(soak, elapsed, interval)
+            samples.append(sample)
+            stdout.write(
+                '%7.0fs %8d KiB %6d handlers %5d models %4d stale '
+                '%7.0f ratings/s  rating p95 %6.3f ms  max %7.3f ms%s\n' % (
+                    elapsed, sample['memory'], sample['handlers'],
+                    sample['models'], sample['stale'],
+                    sample['ratings'] / interval, 1000 * sample['rating p95'],
+                    1000 * sample['max'],
+                    '' if elapsed < options.warmup else ' *'
+                    ))
+            stdout.flush()
+        plugin.do_deactivate()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    checked = [
+        sample for sample in samples if sample['elapsed'] >= options.warmup
+        ] or samples[-1:]
+    failures = []
+    for sample in checked:
+        failures += [
+            '%.0fs: %s' % (sample['elapsed'], failure)
+            for failure in check(checked[0], sample, options)
+            ]
+    for failure in failures:
+        print('FAIL: ' + failure)
+    if failures:
+        sys.exit(1)
+    print('PASS')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+#!/usr/bin/python
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#   startup.py
+#
+#   Plugin startup benchmark for RatingFilters.
+#   Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Measures how long each release of the plugin takes to import and activate
+in a fresh interpreter, installed as source only and installed with the
+bytecode the installer precompiles. Bytecode writing is disabled in both
+cases, as it is when the plugin folder isn't writable, so the source only
+install is compiled on every start:
+
+    python3 bench/startup.py --runs 20 --python2 python2.7
+'''
+from __future__ import print_function
+
+from argparse import ArgumentParser, SUPPRESS
+from collections import OrderedDict
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakerb
+import parity
+
+sys.path.insert(0, fakerb.ROOT_PATH)
+from rbpi import RBPluginInstaller
+
+MODES = ['source only', 'precompiled']
+
+
+def install_plugin(plugin_path, install_path):
+    '''
+    Copies a plugin and the common files into an install folder, as the
+    installer does, leaving out any bytecode.
+    '''
+    sources = glob.glob(os.path.join(plugin_path, '*'))
+    sources += glob.glob(os.path.join(fakerb.COMMON_PATH, '*.py'))
+    sources += glob.glob(os.path.join(fakerb.COMMON_PATH, '*.ui'))
+    for path in sources:
+        if os.path.isfile(path) and not path.endswith(('.pyc', '.pyo')):
+            shutil.copy(path, install_path)
+
+
+def run_worker(install_path, output_path, options):
+    '''
+    Imports and activates the installed plugin in this process and writes
+    the timings as JSON. The plugin's own logging is discarded.
+    '''
+    shell = fakerb.make_shell(
+        entries=options.entries, static_playlists=1, auto_playlists=1,
+        seed=0
+        )
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = fakerb.timer()
+        module = fakerb.load_plugin(install_path)
+        imported = fakerb.timer()
+        fakerb.activate_plugin(module, shell)
+        activated = fakerb.timer()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    with open(output_path, 'w') as output_file:
+        json.dump({
+            'import': imported - start,
+            'activate': activated - imported
+            }, output_file)
+
+
+def run_once(interpreter, install_path, options):
+    '''
+    Starts a fresh interpreter that imports and activates the plugin once,
+    and returns its timings.
+    '''
+    handle, output_path = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    command = [
+        interpreter, os.path.abspath(__file__), '--worker', install_path,
+        '--output', output_path, '--entries', str(options.entries)
+        ]
+    try:
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env
+            )
+        _, error = process.communicate()
+        if process.returncode != 0:
+            lines = error.decode('utf-8', 'replace').strip().splitlines()
+            raise RuntimeError(lines[-1] if lines else 'no output')
+        with open(output_path) as output_file:
+            return json.load(output_file)
+    finally:
+        os.remove(output_path)
+
+
+def run_release(plugin_path, options):
+    '''
+    Benchmarks a release installed without and then with bytecode. Returns
+    the timings by mode, or an error string.
+    '''
+    if parity.get_loader(plugin_path) == 'python3':
+        interpreter = options.python3
+    else:
+        interpreter = options.python2
+    install_path = tempfile.mkdtemp()
+    results = {}
+    try:
+        install_plugin(plugin_path, install_path)
+        for mode in MODES:
+            if mode == 'precompiled':
+                if not RBPluginInstaller.compile_bytecode(
+                    install_path, interpreter):
+                    return 'failed: bytecode would not be used'
+            results[mode] = [
+                run_once(interpreter, install_path, options)
+                for _ in range(options.runs)
+                ]
+        return results
+    except (OSError, RuntimeError) as e:
+        return 'failed: %s (%s)' % (interpreter, e)
+    finally:
+        shutil.rmtree(install_path)
+
+
+def print_report(results):
+    '''
+    Prints median import and activation times for every release.
+    '''
+    names = [os.path.basename(path) for path in results]
+    width = max([12] + [len(name) for name in names]) + 2
+    print('%-34s' % '' + ''.join(name.rjust(width) for name in names))
+
+    def median(values):
+        values = sorted(values)
+        return values[len(values) // 2]
+
+    def row(label, cell):
+        cells = []
+        for path in results:
+            result = results[path]
+            cells.append(
+                ('-' if isinstance(result, str) else cell(result)).rjust(width)
+                )
+        print('%-34s' % label + ''.join(cells))
+
+    for mode in MODES:
+        for stage in ['import', 'activate']:
+            row(
+                '%s %s (ms)' % (mode, stage),
+                lambda result: '%.2f' % (1000 * median(
+                    [run[stage] for run in result[mode]]
+                    ))
+                )
+    row(
+        'import speedup',
+        lambda result: '%.1fx' % (
+            median([run['import'] for run in result['source only']]) /
+            median([run['import'] for run in result['precompiled']])
+            )
+        )
+    print('\nTimes are medians over fresh interpreters with bytecode '
+          'writing disabled.')
+    for path in results:
+        if isinstance(results[path], str):
+            print('%s: %s' % (os.path.basename(path), results[path]))
+
+
+def main():
+    parser = ArgumentParser(
+        description='Compares plugin startup time with and without '
+                    'precompiled bytecode.')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='number of fresh interpreters per release '
+                             'and mode')
+    parser.add_argument('--entries', type=int, default=1000,
+                        help='number of tracks in the library')
+    parser.add_argument('--python2', default='python2',
+                        help='interpreter for Python 2 releases')
+    parser.add_argument('--python3', default=sys.executable,
+                        help='interpreter for Python 3 releases')
+    parser.add_argument('--release', action='append',
+                        help='only run the named release (e.g. 3.0 or dev)')
+    parser.add_argument('--worker', help=SUPPRESS)
+    parser.add_argument('--output', help=SUPPRESS)
+    options = parser.parse_args()
+
+    if options.worker:
+        run_worker(options.worker, options.output, options)
+        return
+
+    results = OrderedDict()
+    paths = parity.get_plugin_paths()
+    if options.release:
+        paths = [p for p in paths if os.path.basename(p) in options.release]
+    for path in paths:
+        sys.stderr.write('Benchmarking %s...\n' % os.path.basename(path))
+        results[path] = run_release(path, options)
+    print_report(results)
+
+
+if __name__ == '__main__':
+    main()
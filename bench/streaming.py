@@ -0,0 +1,298 @@
+#!/usr/bin/python
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#   streaming.py
+#
+#   Streaming correctness check for RatingFilters.
+#   Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Checks that filtered views stay correct while their sources are still
+loading. Every page starts with only a few of its tracks, as the library
+and automatic playlists do while Rhythmbox loads them, and every filter is
+applied to every page. The rest of the tracks then stream in a chunk at a
+time (into the middle of the static playlists, as when tracks are dropped
+into a playlist), some leave their playlists, and tracks are rated at
+random along the way. Each cached filtered model is then compared with
+what the filter should show, worked out from scratch, and rating filters
+must show their tracks in the order of their source:
+
+    python3 bench/streaming.py --release dev --entries 5000 --ratings 3000
+
+Exits with status 1 if any model is wrong. Only releases with a
+filter_names list (2.99 and later) can be checked.
+'''
+from __future__ import print_function
+
+from argparse import ArgumentParser
+import collections
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakerb
+import parity
+
+RATING = fakerb.RhythmDBPropType.RATING
+PLAY_COUNT = fakerb.RhythmDBPropType.PLAY_COUNT
+LAST_PLAYED = fakerb.RhythmDBPropType.LAST_PLAYED
+
+
+def get_bucket(entry):
+    '''
+    Returns the rating bucket of an entry, in half star steps.
+    '''
+    return min(max(int(entry.values[RATING] * 2 + 0.5), 0), 10)
+
+
+def get_album(entry):
+    values = entry.values
+    return (values[fakerb.RhythmDBPropType.ALBUM_ARTIST] or
+            values[fakerb.RhythmDBPropType.ARTIST],
+            values[fakerb.RhythmDBPropType.ALBUM])
+
+
+def get_artist(entry):
+    return entry.values[fakerb.RhythmDBPropType.ARTIST]
+
+
+def get_favourite_groups(library, get_group, threshold, mode):
+    '''
+    Returns the groups of library entries whose average (or minimum)
+    rating, over their rated entries, is at least the threshold.
+    '''
+    ratings = collections.defaultdict(list)
+    for entry in library:
+        bucket = get_bucket(entry)
+        if bucket:
+            ratings[get_group(entry)].append(bucket / 2.0)
+    if mode == 'minimum':
+        return set(group for group, values in ratings.items()
+                   if min(values) >= threshold)
+    return set(group for group, values in ratings.items()
+               if sum(values) / len(values) >= threshold)
+
+
+def check_model(plugin, library, source, filter_name, model):
+    '''
+    Returns a description of what is wrong with a filtered model, or None
+    if it holds what the filter should show of its source.
+    '''
+    settings = plugin.settings
+    shown = set(model.entries)
+    source = list(source.entries)
+    rating_filters = set(['Favourites', 'Unrated'])
+    rating_filters.update(getattr(plugin, 'rating_tables', ()))
+    if filter_name == 'All Ratings':
+        expected = set(source)
+    elif filter_name in rating_filters:
+        table = plugin.get_rating_table(filter_name)
+        expected = set(entry for entry in source if table[get_bucket(entry)])
+    elif filter_name == 'Top Tracks':
+        # Compare sort keys, so that ties may be broken either way.
+        def sort_key(entry):
+            return (entry.values[RATING], entry.values[PLAY_COUNT],
+                    entry.values[LAST_PLAYED])
+        expected_keys = sorted(
+            (sort_key(entry) for entry in source), reverse=True
+            )[:settings['top-tracks-size']]
+        shown_keys = sorted((sort_key(entry) for entry in shown), reverse=True)
+        if shown_keys != expected_keys or not shown <= set(source):
+            return 'shows %d tracks, not the best %d' % (
+                len(shown), len(expected_keys)
+                )
+        return None
+    elif filter_name == 'Discover':
+        unrated = set(entry for entry in source if get_bucket(entry) == 0)
+        size = min(settings['discover-size'], len(unrated))
+        if len(shown) != size or not shown <= unrated:
+            return 'shows %d tracks (%d unrated), not a sample of %d' % (
+                len(shown), len(shown & unrated), size
+                )
+        return None
+    elif filter_name in ('Favourite Albums', 'Favourite Artists'):
+        get_group = get_album if filter_name == 'Favourite Albums' else \
+                    get_artist
+        groups = get_favourite_groups(
+            library, get_group, settings['favourites-threshold'],
+            settings['favourite-groups-mode']
+            )
+        expected = set(entry for entry in source if get_group(entry) in groups)
+    elif filter_name == 'Forgotten Favourites':
+        table = plugin.get_rating_table('Favourites')
+        played_before = time.time() - settings['forgotten-days'] * 24 * 60 * 60
+        expected = set(
+            entry for entry in source
+            if table[get_bucket(entry)] and
+            entry.values[LAST_PLAYED] < played_before
+            )
+    elif filter_name == 'Overplayed Unrated':
+        expected = set(
+            entry for entry in source
+            if get_bucket(entry) == 0 and
+            entry.values[PLAY_COUNT] > settings['overplayed-count']
+            )
+    else:
+        return None
+    if shown != expected:
+        return 'shows %d tracks, expected %d (%d missing, %d extra)' % (
+            len(shown), len(expected), len(expected - shown),
+            len(shown - expected)
+            )
+    if (filter_name in rating_filters and
+            list(model.entries) != [e for e in source if e in expected]):
+        return 'shows its tracks out of source order'
+    return None
+
+
+def check_plugin(plugin, shell):
+    '''
+    Returns a description of each cached filtered model that is wrong.
+    '''
+    library = list(shell.props.library_source.props.base_query_model.entries)
+    failures = []
+    for page, (_, query_models, _) in plugin.visited_pages.items():
+        source = query_models['All Ratings']
+        for filter_name, model in sorted(query_models.items()):
+            failure = check_model(plugin, library, source, filter_name, model)
+            if failure is not None:
+                failures.append('%s, %s: %s' % (
+                    page.props.name, filter_name, failure
+                    ))
+    return failures
+
+
+def hold_back(shell, fraction, rng):
+    '''
+    Empties each page's model down to a fraction of its tracks, without
+    emitting signals, and returns the tracks still to load by model.
+    '''
+    pending = collections.OrderedDict()
+    models = [shell.props.library_source.props.base_query_model] + [
+        page.props.base_query_model
+        for page in shell.props.playlist_manager.get_playlists()
+        ]
+    for model in models:
+        entries = list(model.entries)
+        rng.shuffle(entries)
+        kept = int(len(entries) * fraction)
+        model.entries = collections.OrderedDict(
+            (entry, None) for entry in entries[:kept]
+            )
+        pending[model] = entries[kept:]
+    return pending
+
+
+def main():
+    parser = ArgumentParser(
+        description='Checks that RatingFilters keeps filtered views correct '
+                    'while their sources load and tracks are rated.')
+    parser.add_argument('--release', default='dev',
+                        help='release to check (e.g. 3.0 or dev)')
+    parser.add_argument('--entries', type=int, default=5000,
+                        help='number of tracks in the library')
+    parser.add_argument('--loaded', type=float, default=0.1,
+                        help='fraction of each page loaded before the '
+                             'filters are applied')
+    parser.add_argument('--chunk', type=int, default=50,
+                        help='number of tracks loaded into a page at a time')
+    parser.add_argument('--ratings', type=int, default=3000,
+                        help='number of random rating changes')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the library and operations')
+    options = parser.parse_args()
+
+    paths = [path for path in parity.get_plugin_paths()
+             if os.path.basename(path) == options.release]
+    if not paths:
+        parser.error('no release named %s' % options.release)
+    if parity.get_loader(paths[0]) != 'python3':
+        parser.error('only 2.99 and later can be checked')
+
+    rng = random.Random(options.seed)
+    module = fakerb.load_plugin(paths[0])
+    shell = fakerb.make_shell(
+        entries=options.entries, static_playlists=3, auto_playlists=2,
+        seed=options.seed
+        )
+    library = list(shell.props.db.entries.values())
+    pending = hold_back(shell, options.loaded, rng)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        plugin = fakerb.activate_plugin(module, shell)
+        if not hasattr(plugin, 'filter_names'):
+            sys.stdout = stdout
+            parser.error('%s has no filter_names list' % options.release)
+        driver = fakerb.Driver(plugin, shell)
+        filter_names = list(plugin.filter_names) + list(
+            getattr(plugin, 'profile_names', [])
+            )
+        for page in driver.pages():
+            driver.select_page(page)
+            for filter_name in filter_names:
+                driver.select_filter(filter_name)
+
+        # Load the rest of each page a chunk at a time, rating tracks and
+        # taking tracks out of the static playlists in between.
+        ratings = options.ratings
+        rounds = sum(
+            (len(entries) + options.chunk - 1) // options.chunk
+            for entries in pending.values()
+            )
+        per_round = ratings // (2 * max(1, rounds))
+        playlists = [page.props.base_query_model for page in driver.pages()
+                     if isinstance(page, fakerb.StaticPlaylistSource)]
+        while any(pending.values()):
+            for model, entries in pending.items():
+                for entry in entries[:options.chunk]:
+                    if model in playlists:
+                        model.add_entry(
+                            entry, rng.randrange(len(model) + 1)
+                            )
+                    else:
+                        model.add_entry(entry, -1)
+                del entries[:options.chunk]
+            for _ in range(per_round):
+                driver.rate(rng.choice(library), float(rng.randrange(6)))
+                ratings -= 1
+            if rng.random() < 0.2 and playlists:
+                model = rng.choice(playlists)
+                if model.entries:
+                    model.remove_entry(rng.choice(list(model.entries)))
+            fakerb.main_context.iteration()
+        for _ in range(ratings):
+            driver.rate(rng.choice(library), float(rng.randrange(6)))
+        fakerb.main_context.drain()
+        failures = check_plugin(plugin, shell)
+        pages = len(plugin.visited_pages)
+        plugin.do_deactivate()
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    for failure in failures:
+        print('FAIL: ' + failure)
+    if failures:
+        sys.exit(1)
+    print('PASS: %d pages, %d filters' % (pages, len(filter_names)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#   typelib.py
+#
+#   Rhythmbox version detection check for the installer.
+#   Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+'''
+Checks that the installer reads the Rhythmbox version from the RB typelib
+correctly. A typelib is written for each version probe, and for typelibs
+whose string tables also hold newer probe names that belong elsewhere:
+imported from another namespace, as a method of another class, or in a
+typelib for another namespace altogether. Only the RB namespace's own
+entries and methods may give the version:
+
+    python3 bench/typelib.py
+
+Exits with status 1 if any check fails.
+'''
+from __future__ import print_function
+
+import logging
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fakerb
+
+sys.path.insert(0, fakerb.ROOT_PATH)
+from rbpi import RBPluginInstaller
+
+HEADER = '=16sBBHHHIIIIIIIII18H'
+HEADER_SIZE = 112
+BLOB_SIZES = (12, 20, 12, 16, 20, 16, 16, 16, 12, 12, 24, 16, 8, 24, 32, 60,
+              40, 40)
+ENTRY_SIZE, FUNCTION_SIZE = BLOB_SIZES[:2]
+OBJECT_SIZE, INTERFACE_SIZE = BLOB_SIZES[15:17]
+FUNCTION, OBJECT, INTERFACE = 1, 7, 8
+
+
+def make_typelib(path, namespace, entries, imports=()):
+    '''
+    Writes a typelib for a namespace. Its own entries are given as (name,
+    blob type, method names) and the entries it imports from other
+    namespaces as (namespace, name).
+    '''
+    data = bytearray(HEADER_SIZE + ENTRY_SIZE * (len(entries) + len(imports)))
+    strings = {}
+
+    def string(text):
+        if text not in strings:
+            strings[text] = len(data)
+            data.extend(text.encode('utf-8') + b'\0')
+            data.extend(b'\0' * (-len(data) % 4))
+        return strings[text]
+
+    directory = []
+    for name, blob_type, methods in entries:
+        name_offset = string(name)
+        offset = len(data)
+        if blob_type == OBJECT:
+            data.extend(struct.pack('=HHIII10H', blob_type, 0, name_offset,
+                                    0, 0, 0, 0, 0, 0, 0, len(methods), 0, 0,
+                                    0, 0))
+            data.extend(b'\0' * (offset + OBJECT_SIZE - len(data)))
+        elif blob_type == INTERFACE:
+            data.extend(struct.pack('=HHIII4H', blob_type, 0, name_offset,
+                                    0, 0, 0, 0, 0, len(methods)))
+            data.extend(b'\0' * (offset + INTERFACE_SIZE - len(data)))
+        else:
+            data.extend(struct.pack('=HHII', blob_type, 0, name_offset, 0))
+        start = len(data)
+        data.extend(b'\0' * (FUNCTION_SIZE * len(methods)))
+        for i, method in enumerate(methods):
+            struct.pack_into('=HHII', data, start + i * FUNCTION_SIZE,
+                             FUNCTION, 0, string(method), 0)
+        directory.append((blob_type, 1, name_offset, offset))
+    for other_namespace, name in imports:
+        directory.append((OBJECT, 0, string(name), string(other_namespace)))
+    for i, entry in enumerate(directory):
+        struct.pack_into('=HHII', data, HEADER_SIZE + i * ENTRY_SIZE, *entry)
+    struct.pack_into(HEADER, data, 0, b'GOBJ\nMETADATA\r\n\x1a', 4, 0, 0,
+                     len(directory), len(entries), HEADER_SIZE, 0, 0, 0,
+                     len(data), string(namespace), string('3.0'), 0, 0,
+                     *BLOB_SIZES)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def get_probe_entries(version):
+    '''
+    Returns the RB entries of a typelib for a version: the probe names of
+    that version and every older one.
+    '''
+    entries = {'Shell': (OBJECT, [])}
+    probes = RBPluginInstaller.VERSION_PROBES
+    versions = [probe[0] for probe in probes]
+    for _, class_name, name in probes[versions.index(version):]:
+        if class_name:
+            blob_type, methods = entries.get(class_name, (OBJECT, []))
+            entries[class_name] = (blob_type, methods + [name])
+        else:
+            entries[name] = (OBJECT, [])
+    if 'DeviceSource' in entries:
+        entries['DeviceSource'] = (INTERFACE, entries['DeviceSource'][1])
+    return [(name, blob_type, methods)
+            for name, (blob_type, methods) in sorted(entries.items())]
+
+
+def get_cases():
+    '''
+    Returns (description, namespace, entries, imports, expected version)
+    for each typelib to check.
+    '''
+    cases = []
+    for version, _, _ in RBPluginInstaller.VERSION_PROBES:
+        cases.append(('%s probes' % version, 'RB', get_probe_entries(version),
+                      [], version))
+    cases.append(('2.99 importing Gio.ListModel', 'RB',
+                  get_probe_entries('2.99'),
+                  [('Gio', 'ListModel')], '2.99'))
+    entries = [(name, blob_type, methods + ['default_eject', 'get_processed'])
+               for name, blob_type, methods in get_probe_entries('2.97')]
+    cases.append(('2.97 with newer method names on other classes', 'RB',
+                  entries, [], '2.97'))
+    cases.append(('a Gio typelib', 'Gio', get_probe_entries('3.0.1'), [],
+                  None))
+    return cases
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    installer = RBPluginInstaller('RatingFilters', {}, parse_args=False)
+    installer.TYPELIB_PATHS = []
+    folder = tempfile.mkdtemp()
+    typelib_path = os.environ.get('GI_TYPELIB_PATH')
+    os.environ['GI_TYPELIB_PATH'] = folder
+    failures = []
+    cases = get_cases()
+    try:
+        for description, namespace, entries, imports, expected in cases:
+            make_typelib(os.path.join(folder, 'RB-3.0.typelib'), namespace,
+                         entries, imports)
+            version = installer.guess_rb_version_from_typelib()
+            if version != expected:
+                failures.append('%s: found %s, expected %s' % (
+                    description, version, expected
+                    ))
+    finally:
+        shutil.rmtree(folder)
+        if typelib_path is None:
+            del os.environ['GI_TYPELIB_PATH']
+        else:
+            os.environ['GI_TYPELIB_PATH'] = typelib_path
+
+    for failure in failures:
+        print('FAIL: ' + failure)
+    if failures:
+        sys.exit(1)
+    print('PASS: %d typelibs' % len(cases))
+
+
+if __name__ == '__main__':
+    main()
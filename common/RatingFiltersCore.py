@@ -0,0 +1,815 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#   RatingFiltersCore.py
+#
+#   Rating filter engine shared by every release of RatingFilters.
+#   Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Rating buckets, filter tables and the incremental data structures behind 
+the rating filters. Entries are identified by plain keys (Rhythmbox entry 
+IDs in the plugin) and described by their rating and play history, so 
+this module has no dependency on Rhythmbox or GObject and can be used and 
+benchmarked outside Rhythmbox, under Python 2 or 3.
+'''
+
+import bisect
+import heapq
+import random
+
+RATING_BUCKETS = 11
+
+def get_rating_bucket(rating):
+    '''
+    Maps a rating in stars to a bucket in half star steps, from 0 (unrated) 
+    to 10 (five stars), so that fractional ratings from imported tags are 
+    matched by range rather than by exact value.
+    '''
+    return min(max(int(rating * 2 + 0.5), 0), RATING_BUCKETS - 1)
+
+def compile_rating_range(minimum, maximum):
+    '''
+    Compiles an inclusive range of ratings in stars into a table, indexed 
+    by rating bucket, of whether a rating is in the range.
+    '''
+    low = get_rating_bucket(minimum)
+    high = get_rating_bucket(maximum)
+    return tuple(low <= bucket <= high for bucket in range(RATING_BUCKETS))
+
+class RatingIndex(object):
+    '''
+    The rating bucket of every entry seen so far. Turns entry changes into 
+    rating deltas, so that changes which leave an entry in the same bucket 
+    (play counts, tags, sub-bucket rating changes) cost a dictionary lookup.
+    '''
+    def __init__(self):
+        self.buckets = {}
+
+    def __contains__(self, key):
+        return key in self.buckets
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def get(self, key):
+        '''
+        Returns the rating bucket of an entry, or None if it is unknown.
+        '''
+        return self.buckets.get(key)
+
+    def update(self, key, rating):
+        '''
+        Records the rating of an entry. Returns its old and new rating 
+        buckets if it has moved between buckets, or None if it has not. The 
+        old bucket is None for an entry seen for the first time.
+        '''
+        bucket = get_rating_bucket(rating)
+        old_bucket = self.buckets.get(key)
+        if old_bucket == bucket:
+            return None
+        self.buckets[key] = bucket
+        return (old_bucket, bucket)
+
+    def remove(self, key):
+        '''
+        Forgets an entry.
+        '''
+        self.buckets.pop(key, None)
+
+
+class PageCache(object):
+    '''
+    The entries on a page, with a histogram of their rating buckets, and 
+    the rating tables of the filtered results cached for it. Works out 
+    which cached results an entry joins or leaves when it arrives on the 
+    page or its rating changes, so that the results can be updated in 
+    place rather than rebuilt from the whole page. The histogram gives the 
+    size of any rating filter's result on the page without building it, and 
+    the entries are also kept by bucket, so building a result visits only 
+    the buckets that pass. Each entry has a place in the page's order, 
+    which is the order they were added in unless a place is given.
+    '''
+    def __init__(self):
+        self.members = {}
+        self.buckets = [{} for _ in range(RATING_BUCKETS)]
+        self.histogram = [0] * RATING_BUCKETS
+        self.tables = {}
+        self.added = 0
+
+    def __contains__(self, key):
+        return key in self.members
+
+    def __len__(self):
+        return len(self.members)
+
+    def cache(self, name, table):
+        '''
+        Starts tracking a filtered result, replacing any previous one with 
+        the same name.
+        '''
+        self.tables[name] = table
+
+    def forget(self, name):
+        '''
+        Stops tracking a filtered result.
+        '''
+        self.tables.pop(name, None)
+
+    def add(self, key, bucket, order=None):
+        '''
+        Adds an entry to the page, after the entries already on it or at a 
+        given place in their order. Returns the names of the cached results 
+        it belongs in.
+        '''
+        if key in self.members:
+            old_bucket = self.members[key]
+            old_order = self.buckets[old_bucket].pop(key)
+            self.histogram[old_bucket] -= 1
+            if order is None:
+                order = old_order
+        elif order is None:
+            order = self.added
+            self.added += 1
+        self.members[key] = bucket
+        self.buckets[bucket][key] = order
+        self.histogram[bucket] += 1
+        return [name for name, table in self.tables.items() if table[bucket]]
+
+    def discard(self, key):
+        '''
+        Removes an entry from the page. Returns the names of the cached 
+        results it was in.
+        '''
+        if key not in self.members:
+            return []
+        bucket = self.members.pop(key)
+        del self.buckets[bucket][key]
+        self.histogram[bucket] -= 1
+        return [name for name, table in self.tables.items() if table[bucket]]
+
+    def get_order(self, key):
+        '''
+        Returns the place of an entry in the page's order.
+        '''
+        return self.buckets[self.members[key]][key]
+
+    def renumber(self, keys):
+        '''
+        Sets the places of the entries on the page from their positions in a 
+        sequence of keys. Keys that aren't on the page are skipped, but 
+        still take up a position.
+        '''
+        for order, key in enumerate(keys):
+            bucket = self.members.get(key)
+            if bucket is not None:
+                self.buckets[bucket][key] = order
+        self.added = max(self.added, len(keys))
+
+    def apply(self, key, bucket):
+        '''
+        Applies a change to an entry's rating bucket. Returns a list of 
+        (name, joined) pairs for the cached results that the entry joins 
+        (True) or leaves (False). Entries that are not on the page, and 
+        changes that do not cross a table boundary, give an empty list.
+        '''
+        old_bucket = self.members.get(key)
+        if old_bucket is None or old_bucket == bucket:
+            return []
+        self.members[key] = bucket
+        self.buckets[bucket][key] = self.buckets[old_bucket].pop(key)
+        self.histogram[old_bucket] -= 1
+        self.histogram[bucket] += 1
+        return [(name, table[bucket]) for name, table in self.tables.items() 
+                if table[old_bucket] != table[bucket]]
+
+    def count(self, table):
+        '''
+        Returns the number of entries on the page that pass a rating table.
+        '''
+        return sum(n for n, passes in zip(self.histogram, table) if passes)
+
+    def select(self, table):
+        '''
+        Returns the keys on the page that pass a rating table, in the page's 
+        order. Only the buckets that pass are visited.
+        '''
+        keys = []
+        for bucket, passes in enumerate(table):
+            if passes:
+                keys.extend(
+                    (order, key) for key, order in self.buckets[bucket].items()
+                    )
+        keys.sort()
+        return [key for _, key in keys]
+
+
+class CompositeIndex(object):
+    '''
+    Secondary indexes over rating and play history: entries grouped by 
+    rating bucket and play count band, and entries in each rating bucket 
+    sorted by last played time. Updates find an entry's place in its 
+    bucket's sorted list by binary search, but inserting into or deleting 
+    from the list moves the entries after it, so they take O(n) time in the 
+    worst case (a single memmove, which is fast for any realistic library). 
+    Queries only visit the index cells that can match.
+    '''
+    play_count_bands = [0, 1, 2, 6, 11, 21, 51]
+
+    def __init__(self):
+        self.entries = {}
+        self.by_play_count = {}
+        self.by_last_played = [[] for _ in range(RATING_BUCKETS)]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get_band(self, play_count):
+        '''
+        Returns the play count band that a play count falls in.
+        '''
+        return bisect.bisect_right(self.play_count_bands, play_count) - 1
+
+    def update(self, key, bucket, play_count, last_played):
+        '''
+        Sets the rating bucket, play count and last played time of an entry.
+        '''
+        record = (bucket, play_count, last_played)
+        if self.entries.get(key) == record:
+            return
+        self.remove(key)
+        self.entries[key] = record
+        cell = (bucket, self.get_band(play_count))
+        self.by_play_count.setdefault(cell, set()).add(key)
+        bisect.insort(self.by_last_played[bucket], (last_played, key))
+
+    def remove(self, key):
+        '''
+        Removes an entry.
+        '''
+        if key not in self.entries:
+            return
+        bucket, play_count, last_played = self.entries.pop(key)
+        self.by_play_count[(bucket, self.get_band(play_count))].discard(key)
+        by_last_played = self.by_last_played[bucket]
+        del by_last_played[bisect.bisect_left(
+            by_last_played, (last_played, key)
+            )]
+
+    def matches(self, key, buckets, more_plays_than=None, 
+                played_before=None):
+        '''
+        Returns True if an entry matches a query.
+        '''
+        if key not in self.entries:
+            return False
+        bucket, play_count, last_played = self.entries[key]
+        return (bucket in buckets and 
+                (more_plays_than is None or play_count > more_plays_than) and 
+                (played_before is None or last_played < played_before))
+
+    def select(self, buckets, more_plays_than=None, played_before=None):
+        '''
+        Yields the entries with a rating bucket in buckets that were played 
+        more than more_plays_than times and last played before the 
+        played_before time, if given. Entries that have never been played 
+        count as played before any time.
+        '''
+        if played_before is not None:
+            for bucket in buckets:
+                by_last_played = self.by_last_played[bucket]
+                end = bisect.bisect_left(by_last_played, (played_before,))
+                for i in range(end):
+                    key = by_last_played[i][1]
+                    if (more_plays_than is None or 
+                        self.entries[key][1] > more_plays_than):
+                        yield key
+            return
+        bands = self.play_count_bands
+        for band in range(len(bands)):
+            if more_plays_than is None:
+                check = False
+            elif (band + 1 < len(bands) and 
+                  bands[band + 1] <= more_plays_than + 1):
+                continue
+            else:
+                check = bands[band] <= more_plays_than
+            for bucket in buckets:
+                for key in self.by_play_count.get((bucket, band), ()):
+                    if not check or self.entries[key][1] > more_plays_than:
+                        yield key
+
+
+class GroupRatings(object):
+    '''
+    Keeps a rating histogram for each group of entries (e.g. each album or 
+    artist). The sum, count and minimum of a group's ratings can be read 
+    from its histogram, and a rating change applied to it, in O(1) time.
+    Ratings are rating buckets, with 0 meaning unrated.
+    '''
+    def __init__(self):
+        self.histograms = {}
+        self.members = {}
+        self.entries = {}
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get_group(self, key):
+        '''
+        Returns the group of an entry, or None if it isn't known.
+        '''
+        if key in self.entries:
+            return self.entries[key][0]
+        return None
+
+    def get_members(self, group):
+        '''
+        Returns the keys of the entries in a group.
+        '''
+        return self.members.get(group, ())
+
+    def update(self, key, group, rating, threshold=None, mode='average'):
+        '''
+        Sets the group and rating of an entry. If a threshold is given, 
+        returns the groups that crossed it as a result.
+        '''
+        old = self.entries.get(key)
+        if old == (group, rating):
+            return []
+        groups = [group]
+        if old is not None and old[0] != group:
+            groups.append(old[0])
+        qualified = self.get_qualified(groups, threshold, mode)
+        if old is not None:
+            self.discard(key)
+        self.entries[key] = (group, rating)
+        if group not in self.histograms:
+            self.histograms[group] = [0] * RATING_BUCKETS
+            self.members[group] = set()
+        self.histograms[group][rating] += 1
+        self.members[group].add(key)
+        return self.get_flipped(groups, qualified, threshold, mode)
+
+    def remove(self, key, threshold=None, mode='average'):
+        '''
+        Removes an entry. If a threshold is given, returns the groups that 
+        crossed it as a result.
+        '''
+        if key not in self.entries:
+            return []
+        groups = [self.entries[key][0]]
+        qualified = self.get_qualified(groups, threshold, mode)
+        self.discard(key)
+        return self.get_flipped(groups, qualified, threshold, mode)
+
+    def discard(self, key):
+        '''
+        Takes an entry out of its group's histogram.
+        '''
+        group, rating = self.entries.pop(key)
+        self.histograms[group][rating] -= 1
+        self.members[group].discard(key)
+        if not self.members[group]:
+            del self.histograms[group]
+            del self.members[group]
+
+    def get_qualified(self, groups, threshold, mode):
+        '''
+        Returns whether each of the groups meets the threshold, or nothing 
+        if there is no threshold.
+        '''
+        if threshold is None:
+            return []
+        return [self.qualifies(group, threshold, mode) for group in groups]
+
+    def get_flipped(self, groups, qualified, threshold, mode):
+        '''
+        Returns the groups whose qualification differs from before.
+        '''
+        return [
+            group for group, before in zip(groups, qualified)
+            if self.qualifies(group, threshold, mode) != before
+            ]
+
+    def average(self, group):
+        '''
+        Returns the average rating in stars of the rated entries in a group, 
+        or None if none of them are rated.
+        '''
+        histogram = self.histograms.get(group)
+        if histogram is None:
+            return None
+        count = sum(histogram[1:])
+        if count == 0:
+            return None
+        total = sum(
+            bucket * histogram[bucket] for bucket in range(1, RATING_BUCKETS)
+            )
+        return total / 2.0 / count
+
+    def minimum(self, group):
+        '''
+        Returns the lowest rating in stars of the rated entries in a group, 
+        or None if none of them are rated.
+        '''
+        histogram = self.histograms.get(group)
+        if histogram is not None:
+            for bucket in range(1, RATING_BUCKETS):
+                if histogram[bucket]:
+                    return bucket / 2.0
+        return None
+
+    def qualifies(self, group, threshold, mode='average'):
+        '''
+        Returns True if the group's average (or minimum) rating is at least 
+        the threshold.
+        '''
+        if mode == 'minimum':
+            rating = self.minimum(group)
+        else:
+            rating = self.average(group)
+        return rating is not None and rating >= threshold
+
+
+class Reservoir(object):
+    '''
+    Keeps a uniform random sample of k keys from a pool that is read in a 
+    single pass, along with a reserve of spare keys that replace sampled 
+    keys as they leave the pool. Memory use is O(k + reserve).
+    '''
+    def __init__(self, k, reserve=None, rng=random):
+        self.k = k
+        self.capacity = k + (k if reserve is None else reserve)
+        self.rng = rng
+        self.build([])
+
+    def __contains__(self, key):
+        return key in self.sample or key in self.spare_set
+
+    def build(self, keys):
+        '''
+        Samples an iterable of keys using reservoir sampling.
+        '''
+        chosen = []
+        seen = 0
+        for key in keys:
+            seen += 1
+            if len(chosen) < self.capacity:
+                chosen.append(key)
+            else:
+                i = self.rng.randrange(seen)
+                if i < self.capacity:
+                    chosen[i] = key
+        self.rng.shuffle(chosen)
+        self.sample = set(chosen[:self.k])
+        self.spares = chosen[self.k:]
+        self.spare_set = set(self.spares)
+        self.seen = seen
+        self.complete = seen <= self.capacity
+
+    def needs_rebuild(self):
+        '''
+        Returns True if the sample is short and the pool may hold keys that 
+        were not kept.
+        '''
+        return (len(self.sample) < self.k and not self.spares and 
+                not self.complete)
+
+    def offer(self, key):
+        '''
+        Offers a key that has joined the pool. Returns True if the key was 
+        added to the sample.
+        '''
+        if key in self:
+            return False
+        self.seen += 1
+        if len(self.sample) < self.k:
+            self.sample.add(key)
+            return True
+        if len(self.spares) < self.capacity - self.k:
+            self.spares.append(key)
+            self.spare_set.add(key)
+            return False
+        self.complete = False
+        i = self.rng.randrange(self.seen)
+        if i < len(self.spares):
+            self.spare_set.discard(self.spares[i])
+            self.spares[i] = key
+            self.spare_set.add(key)
+        return False
+
+    def discard(self, key):
+        '''
+        Removes a key that has left the pool. Returns the spare key that 
+        took its place in the sample, if any.
+        '''
+        if key in self.spare_set:
+            self.spare_set.remove(key)
+            self.spares.remove(key)
+        elif key in self.sample:
+            self.sample.remove(key)
+            if self.spares:
+                spare = self.spares.pop()
+                self.spare_set.remove(spare)
+                self.sample.add(spare)
+                return spare
+        return None
+
+
+class TopN(object):
+    '''
+    Tracks the n items with the largest sort keys in a changing collection 
+    without sorting the whole collection. A bounded min-heap holds the best 
+    n + slack items; every item outside it is known to rank no higher than 
+    floor, a (sort key, key) record. The collection only has to be 
+    rescanned when items drop out of the heap faster than better ones 
+    arrive, which needs_rebuild reports.
+    '''
+    def __init__(self, n, slack=None):
+        self.n = n
+        self.capacity = n + (n if slack is None else slack)
+        self.build([])
+
+    def build(self, items):
+        '''
+        Selects the best items from an iterable of (key, sort key) pairs in 
+        O(N log(n + slack)) time.
+        '''
+        heap = []
+        floor = None
+        size = 0
+        for key, sort_key in items:
+            size += 1
+            if len(heap) < self.capacity:
+                heapq.heappush(heap, (sort_key, key))
+            elif (sort_key, key) > heap[0]:
+                dropped = heapq.heapreplace(heap, (sort_key, key))
+                floor = dropped if floor is None else max(floor, dropped)
+            else:
+                record = (sort_key, key)
+                floor = record if floor is None else max(floor, record)
+        self.heap = heap
+        self.members = dict((key, sort_key) for sort_key, key in heap)
+        self.floor = floor
+        self.size = size
+        self.visible = set()
+        self.threshold = None
+
+    def needs_rebuild(self):
+        '''
+        Returns True if too few items are known to be among the best for 
+        top() to be correct.
+        '''
+        return len(self.members) < min(self.n, self.size)
+
+    def top(self):
+        '''
+        Returns the keys of the best n items, breaking ties on the key as 
+        admit does. The result is remembered, so that add, remove and 
+        update can tell whether a change can alter it.
+        '''
+        if len(self.members) <= self.n:
+            self.visible = set(self.members)
+            self.threshold = None
+        else:
+            best = heapq.nlargest(
+                self.n,
+                ((sort_key, key) for key, sort_key in self.members.items())
+                )
+            self.visible = set(key for _, key in best)
+            self.threshold = best[-1]
+        return set(self.visible)
+
+    def reaches_top(self, key, sort_key, was_visible):
+        '''
+        Returns True if a change to an item can have altered the result of 
+        the last call to top(). Every member outside that result ranks 
+        below threshold and every member in it ranks at or above it.
+        '''
+        if self.threshold is None:
+            return True
+        if was_visible:
+            return key not in self.members or \
+                (sort_key, key) < self.threshold
+        return key in self.members and (sort_key, key) > self.threshold
+
+    def lowest_member(self):
+        '''
+        Returns the (sort key, key) record of the lowest ranked member, 
+        discarding stale heap records.
+        '''
+        heap = self.heap
+        while heap and self.members.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def raise_floor(self, record):
+        '''
+        Records that the item with the given (sort key, key) record is not 
+        a member.
+        '''
+        if self.floor is None or record > self.floor:
+            self.floor = record
+
+    def admit(self, key, sort_key):
+        '''
+        Considers a non-member for membership.
+        '''
+        record = (sort_key, key)
+        if len(self.members) < self.capacity:
+            if self.floor is None or record > self.floor:
+                self.members[key] = sort_key
+                self.push(key, sort_key)
+            else:
+                self.raise_floor(record)
+            return
+        lowest = self.lowest_member()
+        if lowest is not None and record > lowest:
+            heapq.heapreplace(self.heap, record)
+            del self.members[lowest[1]]
+            self.members[key] = sort_key
+            self.raise_floor(lowest)
+        else:
+            self.raise_floor(record)
+
+    def add(self, key, sort_key):
+        '''
+        Adds an item to the collection. Returns True if top() can have 
+        changed.
+        '''
+        self.size += 1
+        self.admit(key, sort_key)
+        return self.reaches_top(key, sort_key, False)
+
+    def remove(self, key):
+        '''
+        Removes an item from the collection. Returns True if top() can 
+        have changed.
+        '''
+        self.size -= 1
+        self.members.pop(key, None)
+        return key in self.visible
+
+    def update(self, key, sort_key):
+        '''
+        Changes the sort key of an item in the collection. Returns True if 
+        top() can have changed.
+        '''
+        was_visible = key in self.visible
+        if key not in self.members:
+            self.admit(key, sort_key)
+        elif self.floor is not None and (sort_key, key) < self.floor:
+            del self.members[key]
+        else:
+            self.members[key] = sort_key
+            self.push(key, sort_key)
+        return self.reaches_top(key, sort_key, was_visible)
+
+    def push(self, key, sort_key):
+        '''
+        Pushes a member's record onto the heap, compacting the heap if 
+        stale records have built up.
+        '''
+        heapq.heappush(self.heap, (sort_key, key))
+        if len(self.heap) > 2 * self.capacity:
+            self.heap = [
+                (member_sort_key, member)
+                for member, member_sort_key in self.members.items()
+                ]
+            heapq.heapify(self.heap)
+
+
+class WeightedSampler(object):
+    '''
+    Draws keys at random with probability proportional to their integer 
+    weights. The weights are held in a Fenwick tree, so adding, removing 
+    or reweighting a key and drawing a key all take O(log n) time.
+    '''
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def clear(self):
+        '''
+        Removes all keys.
+        '''
+        self.slots = {}
+        self.keys = [None]
+        self.weights = [0]
+        self.free_slots = []
+        self.tree = [0, 0]
+        self.total = 0
+
+    def rebuild(self, items):
+        '''
+        Replaces the contents of the sampler with the supplied (key, weight) 
+        pairs in O(n) time.
+        '''
+        self.clear()
+        for key, weight in items:
+            self.slots[key] = len(self.keys)
+            self.keys.append(key)
+            self.weights.append(weight)
+        self.build_tree(len(self.keys))
+
+    def build_tree(self, capacity):
+        '''
+        Builds the Fenwick tree in place with room for at least the given 
+        number of slots.
+        '''
+        size = 1
+        while size < capacity:
+            size *= 2
+        tree = self.weights + [0] * (size + 1 - len(self.weights))
+        tree[0] = 0
+        for i in range(1, size + 1):
+            j = i + (i & -i)
+            if j <= size:
+                tree[j] += tree[i]
+        self.tree = tree
+        self.total = sum(self.weights)
+
+    def add_to_slot(self, slot, delta):
+        '''
+        Adds delta to the weight of a slot.
+        '''
+        self.weights[slot] += delta
+        self.total += delta
+        size = len(self.tree) - 1
+        while slot <= size:
+            self.tree[slot] += delta
+            slot += slot & -slot
+
+    def get_weight(self, key):
+        '''
+        Returns the weight of a key, or None if it isn't in the sampler.
+        '''
+        slot = self.slots.get(key)
+        if slot is None:
+            return None
+        return self.weights[slot]
+
+    def set_weight(self, key, weight):
+        '''
+        Adds a key, or changes its weight if it is already present.
+        '''
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.keys[slot] = key
+            else:
+                slot = len(self.keys)
+                self.keys.append(key)
+                self.weights.append(0)
+                if slot >= len(self.tree):
+                    self.build_tree(2 * slot)
+            self.slots[key] = slot
+        if weight != self.weights[slot]:
+            self.add_to_slot(slot, weight - self.weights[slot])
+
+    def remove(self, key):
+        '''
+        Removes a key, if present.
+        '''
+        slot = self.slots.pop(key, None)
+        if slot is not None:
+            self.add_to_slot(slot, -self.weights[slot])
+            self.keys[slot] = None
+            self.free_slots.append(slot)
+
+    def sample(self, rng=random):
+        '''
+        Returns a key chosen with probability proportional to its weight, 
+        or None if all weights are zero.
+        '''
+        if self.total <= 0:
+            return None
+        r = rng.randrange(self.total)
+        size = len(self.tree) - 1
+        slot = 0
+        step = size
+        while step:
+            i = slot + step
+            if i <= size and self.tree[i] <= r:
+                slot = i
+                r -= self.tree[i]
+            step //= 2
+        return self.keys[slot + 1]
@@ -0,0 +1,234 @@
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#   RatingFiltersPages.py
+#
+#   Rhythmbox side of the rating filters, shared by every release.
+#   Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+Connects the data structures in RatingFiltersCore to Rhythmbox query 
+models. Only calls that every supported Rhythmbox version provides are 
+used here, under Python 2 or 3, so each release keeps just the code that 
+differs between versions (menus, actions and preferences).
+'''
+
+from gi.repository import RB
+
+import bisect
+
+from RatingFiltersCore import PageCache
+
+def get_entries(query_model):
+    '''
+    Returns the entries in a query model as a list. The model is walked 
+    with tree iters, which avoids creating a Gtk.TreeModelRow and boxing a 
+    GValue for every row as iterating over the model does.
+    '''
+    entries = []
+    append = entries.append
+    iter_to_entry = query_model.iter_to_entry
+    iter_next = query_model.iter_next
+    tree_iter = query_model.get_iter_first()
+    while tree_iter is not None:
+        append(iter_to_entry(tree_iter))
+        tree_iter = iter_next(tree_iter)
+    return entries
+
+
+class PageFilters(object):
+    '''
+    Keeps the rating filtered query models built from one query model in 
+    step with it and with rating changes. The core PageCache decides which 
+    models an entry joins or leaves, so an entry arriving, leaving or being 
+    rated touches only the models it affects and nothing is rebuilt. The 
+    changed callback is called whenever the page's rating histogram changes.
+
+    The source's entries are kept by ID, so a new filtered model is filled 
+    from the histogram buckets without walking the source, and while it is 
+    filled it isn't yet shown, so nothing is listening to its rows.
+
+    Filtered models keep the order of the source, so a filtered playlist is 
+    shown in playlist order. The cache holds each entry's place in the 
+    source, and each filtered model the sorted places of its entries, so an 
+    entry that passes a filter again after being rated, or arrives in the 
+    middle of the source, is inserted on the right row by binary search.
+    '''
+    def __init__(self, query_model, rating_index, changed=None):
+        self.query_model = query_model
+        self.rating_index = rating_index
+        self.changed = changed or (lambda: None)
+        self.cache = PageCache()
+        self.entries = {}
+        self.new_query_models = {}
+        self.orders = {}
+        self.add_entries(get_entries(query_model))
+        self.handler_ids = [
+            query_model.connect('row-inserted', self.on_row_inserted),
+            query_model.connect('entry-removed', self.on_entry_removed)
+            ]
+
+    def add_entries(self, entries):
+        '''
+        Adds entries at the end of the source to the filtered models they 
+        pass.
+        '''
+        for entry in entries:
+            self.add_entry(entry)
+        self.changed()
+
+    def add_entry(self, entry, order=None):
+        '''
+        Adds an entry in the source to the page's cache, at the end of the 
+        source or at a given place, and to the filtered models it passes. 
+        The rating index is shared by every page and kept up to date as 
+        entries change, so only entries it hasn't seen yet have their rating 
+        read.
+        '''
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        bucket = self.rating_index.get(entry_id)
+        if bucket is None:
+            self.rating_index.update(
+                entry_id, entry.get_double(RB.RhythmDBPropType.RATING)
+                )
+            bucket = self.rating_index.get(entry_id)
+        self.entries[entry_id] = entry
+        filter_names = self.cache.add(entry_id, bucket, order)
+        order = self.cache.get_order(entry_id)
+        for filter_name in filter_names:
+            self.insert_entry(filter_name, entry, order)
+
+    def insert_entry(self, filter_name, entry, order):
+        '''
+        Adds an entry to a filtered model on the row its place calls for.
+        '''
+        orders = self.orders[filter_name]
+        index = bisect.bisect(orders, order)
+        orders.insert(index, order)
+        self.new_query_models[filter_name].add_entry(entry, index)
+
+    def delete_entry(self, filter_name, entry, order):
+        '''
+        Removes an entry from a filtered model.
+        '''
+        orders = self.orders[filter_name]
+        del orders[bisect.bisect_left(orders, order)]
+        self.new_query_models[filter_name].remove_entry(entry)
+
+    def get_order_at(self, position):
+        '''
+        Returns the place of the entry on a row of the source.
+        '''
+        query_model = self.query_model
+        entry = query_model.iter_to_entry(
+            query_model.iter_nth_child(None, position)
+            )
+        return self.cache.get_order(
+            entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+            )
+
+    def get_order_between(self, position):
+        '''
+        Returns a place for an entry arriving on a row in the middle of the 
+        source, between the places of the entries either side of it. When 
+        there is no room left between them, every entry is given its row as 
+        its place instead.
+        '''
+        after = self.get_order_at(position + 1)
+        if position > 0:
+            before = self.get_order_at(position - 1)
+        else:
+            before = after - 1
+        order = (before + after) / 2.0
+        if before < order < after:
+            return order
+        self.cache.renumber([
+            entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID) 
+            for entry in get_entries(self.query_model)
+            ])
+        for filter_name, table in self.cache.tables.items():
+            self.orders[filter_name] = [
+                self.cache.get_order(entry_id) 
+                for entry_id in self.cache.select(table)
+                ]
+        return position
+
+    def add_filter(self, filter_name, table, new_query_model):
+        '''
+        Fills a filtered model with the entries in the source that pass a 
+        rating table, and keeps it up to date from then on.
+        '''
+        entries = self.entries
+        entry_ids = self.cache.select(table)
+        add_entry = new_query_model.add_entry
+        for entry_id in entry_ids:
+            add_entry(entries[entry_id], -1)
+        self.cache.cache(filter_name, table)
+        self.new_query_models[filter_name] = new_query_model
+        self.orders[filter_name] = [
+            self.cache.get_order(entry_id) for entry_id in entry_ids
+            ]
+
+    def remove_filter(self, filter_name):
+        '''
+        Stops keeping a filtered model up to date.
+        '''
+        self.cache.forget(filter_name)
+        del self.new_query_models[filter_name]
+        del self.orders[filter_name]
+
+    def entry_changed(self, entry, entry_id, delta):
+        '''
+        Applies a rating delta from the rating index to the filtered models.
+        '''
+        if entry_id not in self.cache:
+            return
+        order = self.cache.get_order(entry_id)
+        for filter_name, joined in self.cache.apply(entry_id, delta[1]):
+            if joined:
+                self.insert_entry(filter_name, entry, order)
+            else:
+                self.delete_entry(filter_name, entry, order)
+        self.changed()
+
+    def on_row_inserted(self, query_model, path, tree_iter):
+        entry = query_model.iter_to_entry(tree_iter)
+        if entry is None:
+            return
+        if entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID) in self.cache:
+            return
+        position = path.get_indices()[0]
+        order = None
+        if position + 1 < query_model.iter_n_children(None):
+            order = self.get_order_between(position)
+        self.add_entry(entry, order)
+        self.changed()
+
+    def on_entry_removed(self, query_model, entry):
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        if entry_id not in self.cache:
+            return
+        order = self.cache.get_order(entry_id)
+        for filter_name in self.cache.discard(entry_id):
+            self.delete_entry(filter_name, entry, order)
+        del self.entries[entry_id]
+        self.changed()
+
+    def stop(self):
+        '''
+        Disconnects from the source query model.
+        '''
+        for handler_id in self.handler_ids:
+            self.query_model.disconnect(handler_id)
+        self.handler_ids = []
@@ -33,6 +33,32 @@ from gi.repository import Gio
 from gi.repository import PeasGtk
 
 import rb
+import cProfile
+import collections
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+from RatingFiltersCore import RATING_BUCKETS, get_rating_bucket, \
+    compile_rating_range, RatingIndex, CompositeIndex, GroupRatings, \
+    Reservoir, TopN, WeightedSampler
+from RatingFiltersPages import get_entries, PageFilters
+
+def get_plugin_files():
+    '''
+    Returns the source files of the plugin's modules, as recorded in their 
+    code objects, for telling plugin frames and allocations from others.
+    '''
+    return [
+        get_plugin_files.__code__.co_filename, 
+        compile_rating_range.__code__.co_filename, 
+        get_entries.__code__.co_filename
+        ]
 
 class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
     '''
@@ -64,46 +90,159 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
         self.settings = Gio.Settings(
             'org.gnome.rhythmbox.plugins.rating_filters'
             )
-        self.settings.connect(
-            'changed::favourites-threshold', 
-            self.on_favourites_threshold_changed
-            )
+        self.settings_handler_ids = [
+            self.settings.connect(
+                'changed::favourites-threshold', 
+                self.on_favourites_threshold_changed
+                )
+            ]
+        self.filter_settings = {
+            'top-tracks-size': ['Top Tracks'],
+            'discover-size': ['Discover'],
+            'favourite-groups-mode': ['Favourite Albums', 'Favourite Artists'],
+            'forgotten-days': ['Forgotten Favourites'],
+            'overplayed-count': ['Overplayed Unrated']
+            }
+        for key in self.filter_settings:
+            self.settings_handler_ids.append(self.settings.connect(
+                'changed::' + key, self.on_filter_setting_changed
+                ))
+        self.settings_handler_ids += [
+            self.settings.connect(
+                'changed::filter-profiles', self.on_filter_profiles_changed
+                ),
+            self.settings.connect(
+                'changed::apply-to-all-pages', self.on_global_filter_changed
+                ),
+            self.settings.connect(
+                'changed::global-filter', self.on_global_filter_changed
+                ),
+            self.settings.connect(
+                'changed::stall-threshold', self.on_stall_threshold_changed
+                ),
+            self.settings.connect(
+                'changed::trace-recording', self.on_trace_recording_changed
+                )
+            ]
+        for key in ['metrics-interval', 'metrics-file']:
+            self.settings_handler_ids.append(self.settings.connect(
+                'changed::' + key, self.on_metrics_settings_changed
+                ))
         
-        app = Gio.Application.get_default()
         self.app_id = 'rating-filters'
-        self.filter_names = ['All Ratings', 'Favourites', 'Unrated']
+        self.filter_names = [
+            'All Ratings', 'Favourites', 'Unrated', 'Top Tracks', 'Discover',
+            'Favourite Albums', 'Favourite Artists', 'Forgotten Favourites', 
+            'Overplayed Unrated'
+            ]
         self.target_values = {
             'All Ratings': GLib.Variant.new_string('rating-filters-all-ratings'),
             'Favourites': GLib.Variant.new_string('rating-filters-favourites'),
-            'Unrated': GLib.Variant.new_string('rating-filters-unrated')
+            'Unrated': GLib.Variant.new_string('rating-filters-unrated'),
+            'Top Tracks': GLib.Variant.new_string('rating-filters-top-tracks'),
+            'Discover': GLib.Variant.new_string('rating-filters-discover'),
+            'Favourite Albums': GLib.Variant.new_string(
+                'rating-filters-favourite-albums'
+                ),
+            'Favourite Artists': GLib.Variant.new_string(
+                'rating-filters-favourite-artists'
+                ),
+            'Forgotten Favourites': GLib.Variant.new_string(
+                'rating-filters-forgotten-favourites'
+                ),
+            'Overplayed Unrated': GLib.Variant.new_string(
+                'rating-filters-overplayed-unrated'
+                )
             }
-        self.locations = ['library-toolbar', 'playlist-toolbar']
+        self.threshold_filters = [
+            'Favourites', 'Favourite Albums', 'Favourite Artists', 
+            'Forgotten Favourites'
+            ]
+        self.group_filters = {
+            'Favourite Albums': self.get_album_key,
+            'Favourite Artists': self.get_artist_key
+            }
+        self.group_ratings = {}
+        self.composite_filters = ['Forgotten Favourites', 'Overplayed Unrated']
+        self.composite_index = None
+        self.rating_tables = {}
+        self.locations = [
+            'library-toolbar', 'playlist-toolbar', 'podcast-toolbar',
+            'generic-player-toolbar', 'ipod-toolbar', 'mtp-toolbar',
+            'daap-toolbar'
+            ]
         self.visited_pages = {}
         self.active_filter = {}
+        self.handler_ids = []
+        self.streams = {}
+        self.rating_index = RatingIndex()
+        self.page_filters = {}
+        self.rating_models = {}
+        self.menu_sections = []
+        self.menu_labels = {}
+        self.menu_counts_source_id = None
+        self.global_queue = []
+        self.global_source_id = None
+        self.play_orders = [
+            RatingShufflePlayOrder, FavouritesShufflePlayOrder
+            ]
+        self.load_filter_profiles()
         
-        action_name = 'rating-filters'
+        app = Gio.Application.get_default()
+        self.action_name = 'rating-filters'
         self.action = Gio.SimpleAction.new_stateful(
-            action_name, GLib.VariantType.new('s'),
+            self.action_name, GLib.VariantType.new('s'),
             self.target_values['All Ratings']
             )
         self.action.connect("activate", self.filter_change_cb)
         app.add_action(self.action)
+
+        self.global_action = Gio.SimpleAction.new_stateful(
+            'rating-filters-apply-to-all-pages', None,
+            GLib.Variant.new_boolean(self.settings['apply-to-all-pages'])
+            )
+        self.global_action.connect('activate', self.global_filter_toggle_cb)
+        app.add_action(self.global_action)
+
+        self.menu_action = Gio.SimpleAction.new_stateful(
+            'rating-filters-menu-shown', None, GLib.Variant.new_boolean(False)
+            )
+        self.menu_action.connect('change-state', self.filter_menu_cb)
+        app.add_action(self.menu_action)
+
+        self.profiler = None
+        self.profile_action = Gio.SimpleAction.new_stateful(
+            'rating-filters-profile', None, GLib.Variant.new_boolean(False)
+            )
+        self.profile_action.connect('activate', self.profile_toggle_cb)
+        app.add_action(self.profile_action)
+
+        self.watchdog = None
+        self.dump_stalls_action = Gio.SimpleAction.new(
+            'rating-filters-dump-stalls', None
+            )
+        self.dump_stalls_action.connect('activate', self.dump_stalls_cb)
+        app.add_action(self.dump_stalls_action)
+        self.on_stall_threshold_changed(self.settings, 'stall-threshold')
+
+        self.recorder = None
+        self.on_trace_recording_changed(self.settings, 'trace-recording')
+
+        self.metrics = Metrics()
+        self.metrics_source_id = None
+        self.on_metrics_settings_changed(self.settings, 'metrics-interval')
         
-        menu_item = Gio.MenuItem()
-        section = Gio.Menu()
-        menu = Gio.Menu()
-        toolbar_item = Gio.MenuItem()
-        for filter_name in self.filter_names:
-            menu_item.set_label(filter_name)
-            menu_item.set_action_and_target_value(
-                'app.' + action_name, self.target_values[filter_name]
+        self.build_menu()
+
+        player = self.object.props.shell_player
+        for play_order in self.play_orders:
+            player.add_play_order(
+                play_order.name, play_order.description, 
+                play_order.__gtype__, False
                 )
-            section.append_item(menu_item)
-        menu.append_section(None, section)
-        toolbar_item.set_label('Filter')
-        toolbar_item.set_submenu(menu)
-        for location in self.locations:
-            app.add_plugin_menu_item(location, self.app_id, toolbar_item)
+
+        if self.get_global_filter():
+            GLib.idle_add(self.apply_global_filter)
 
     def do_deactivate(self):
         '''
@@ -111,14 +250,243 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
         '''
         self.log(self.do_deactivate.__name__, 'Deactivating plugin...')
         
-        for page in self.visited_pages:
-            [_, query_models, t] = self.visited_pages[page]
-            self.visited_pages[page] = ['All Ratings', query_models, t]
-            self.refresh(page)
+        for handler_id in self.settings_handler_ids:
+            self.settings.disconnect(handler_id)
+        self.settings_handler_ids = []
+
+        self.restore_pages()
+        self.release_caches()
+
+        if self.menu_counts_source_id is not None:
+            GLib.source_remove(self.menu_counts_source_id)
+            self.menu_counts_source_id = None
+
+        if self.global_source_id is not None:
+            GLib.source_remove(self.global_source_id)
+            self.global_source_id = None
+
+        if self.watchdog is not None:
+            self.watchdog.stop()
+            self.watchdog = None
+
+        if self.recorder is not None:
+            self.recorder.stop()
+            self.recorder = None
+
+        if self.profiler is not None:
+            self.stop_profiling()
+
+        if self.metrics_source_id is not None:
+            GLib.source_remove(self.metrics_source_id)
+            self.metrics_source_id = None
+
+        app = Gio.Application.get_default()
+        app.remove_action(self.action.get_name())
+        app.remove_action(self.global_action.get_name())
+        app.remove_action(self.menu_action.get_name())
+        app.remove_action(self.dump_stalls_action.get_name())
+        app.remove_action(self.profile_action.get_name())
+        for location in self.locations:
+            app.remove_plugin_menu_item(location, self.app_id)
+
+        player = self.object.props.shell_player
+        for play_order in self.play_orders:
+            player.remove_play_order(play_order.name)
+
+    def restore_pages(self):
+        '''
+        Puts every visited page back on its unfiltered query model. Pages 
+        already showing it are left alone, and only the selected page is 
+        refreshed; the others just have their model swapped, without 
+        restoring their sort order, since the unfiltered model is still in 
+        the order the view was sorted by.
+        '''
+        selected_page = self.object.props.selected_page
+        for page, (_, query_models, t) in self.visited_pages.items():
+            query_model = query_models['All Ratings']
+            entry_view = page.get_entry_view()
+            if entry_view.props.model is query_model:
+                continue
+            if page is selected_page:
+                self.visited_pages[page] = ['All Ratings', query_models, t]
+                self.refresh(page)
+            else:
+                entry_view.props.model = query_model
+                page.props.query_model = query_model
+
+    def release_caches(self):
+        '''
+        Disconnects the plugin's signal handlers and drops every cached 
+        query model and index in one go, instead of taking each filter 
+        apart in turn.
+        '''
+        for gobject, handler_id in self.handler_ids:
+            gobject.disconnect(handler_id)
+        for stream in self.streams.values():
+            stream.stop()
+        for page_filters in self.page_filters.values():
+            page_filters.stop()
+        self.handler_ids = []
+        self.visited_pages = {}
+        self.active_filter = {}
+        self.streams = {}
+        self.page_filters = {}
+        self.rating_models = {}
+        self.rating_index = RatingIndex()
+        self.group_ratings = {}
+        self.composite_index = None
+        self.global_queue = []
+
+    def load_filter_profiles(self):
+        '''
+        Compiles the rating filter for Unrated and for each named filter 
+        profile in the settings. Profiles whose names clash with another 
+        filter are skipped.
+        '''
+        self.rating_tables = {'Unrated': compile_rating_range(0.0, 0.0)}
+        self.profile_names = []
+        for name, minimum, maximum in self.settings['filter-profiles']:
+            if name in self.target_values or name in self.profile_names:
+                self.log(
+                    self.load_filter_profiles.__name__, 
+                    "Skipping duplicate filter profile '" + name + "'", 
+                    error=True
+                    )
+                continue
+            self.profile_names.append(name)
+            self.target_values[name] = GLib.Variant.new_string(
+                'rating-filters-profile-' + name
+                )
+            self.rating_tables[name] = compile_rating_range(minimum, maximum)
 
+    def build_menu(self):
+        '''
+        Builds the Filter menu and adds it to the source toolbars, replacing 
+        any previous version of it.
+        '''
         app = Gio.Application.get_default()
+        menu = Gio.Menu()
+        toolbar_item = Gio.MenuItem()
+        self.menu_sections = []
+        self.menu_labels = {}
+        for filter_names in [self.filter_names, self.profile_names]:
+            if not filter_names:
+                continue
+            section = Gio.Menu()
+            for filter_name in filter_names:
+                section.append_item(self.get_menu_item(filter_name))
+                self.menu_labels[filter_name] = filter_name
+            menu.append_section(None, section)
+            self.menu_sections.append((section, list(filter_names)))
+        section = Gio.Menu()
+        section.append(
+            'Apply to All Pages', 'app.rating-filters-apply-to-all-pages'
+            )
+        section.append('Profile Filters', 'app.rating-filters-profile')
+        menu.append_section(None, section)
+        toolbar_item.set_label('Filter')
+        toolbar_item.set_submenu(menu)
+        toolbar_item.set_attribute_value(
+            'submenu-action', 
+            GLib.Variant.new_string('app.' + self.menu_action.get_name())
+            )
         for location in self.locations:
             app.remove_plugin_menu_item(location, self.app_id)
+            app.add_plugin_menu_item(location, self.app_id, toolbar_item)
+
+    def get_menu_item(self, filter_name, label=None):
+        '''
+        Returns a Filter menu item for a filter.
+        '''
+        menu_item = Gio.MenuItem()
+        menu_item.set_label(label or filter_name)
+        menu_item.set_action_and_target_value(
+            'app.' + self.action_name, self.target_values[filter_name]
+            )
+        return menu_item
+
+    def get_menu_label(self, filter_name, page_filters):
+        '''
+        Returns the Filter menu label for a filter, with the number of 
+        entries it shows on a page if that is known without building it.
+        '''
+        if page_filters is None:
+            return filter_name
+        if filter_name == 'All Ratings':
+            count = len(page_filters.cache)
+        elif self.is_rating_filter(filter_name):
+            count = page_filters.cache.count(self.get_rating_table(filter_name))
+        else:
+            return filter_name
+        return '{0} ({1:,})'.format(filter_name, count)
+
+    def filter_menu_cb(self, action, value):
+        '''
+        Called when the Filter menu is opened or closed. The selected page's 
+        rating histogram is built the first time the menu is opened on it, 
+        rather than on every page switch, so that its counts can be shown.
+        '''
+        action.set_state(value)
+        page = self.object.props.selected_page
+        if not value.get_boolean() or not self.is_filterable(page):
+            return
+        if len(self.visited_pages) == 0:
+            self.set_callbacks() # set callbacks on first run
+        if page not in self.visited_pages:
+            self.prepare_page(page, 'All Ratings')
+        self.get_page_filters(self.visited_pages[page][1]['All Ratings'])
+        self.update_menu_counts()
+
+    def schedule_menu_counts(self):
+        '''
+        Arranges for the counts in the Filter menu to be updated shortly, so 
+        that a burst of changes causes a single update.
+        '''
+        if self.menu_counts_source_id is None:
+            self.menu_counts_source_id = GLib.timeout_add(
+                500, self.update_menu_counts
+                )
+
+    def update_menu_counts(self):
+        '''
+        Shows the size of each rating filter on the selected page in the 
+        Filter menu. Sizes come from the page's rating histogram, and only 
+        the items whose labels have changed are replaced.
+        '''
+        if self.menu_counts_source_id is not None:
+            GLib.source_remove(self.menu_counts_source_id)
+            self.menu_counts_source_id = None
+
+        page = self.object.props.selected_page
+        page_filters = None
+        if page in self.visited_pages:
+            query_model = self.visited_pages[page][1]['All Ratings']
+            page_filters = self.page_filters.get(query_model)
+
+        for section, filter_names in self.menu_sections:
+            for position, filter_name in enumerate(filter_names):
+                label = self.get_menu_label(filter_name, page_filters)
+                if self.menu_labels.get(filter_name) != label:
+                    section.remove(position)
+                    section.insert_item(
+                        position, self.get_menu_item(filter_name, label)
+                        )
+                    self.menu_labels[filter_name] = label
+        return False
+
+    def is_rating_filter(self, filter_name):
+        '''
+        Returns True if the filter keeps entries by rating alone.
+        '''
+        return filter_name == 'Favourites' or filter_name in self.rating_tables
+
+    def get_rating_table(self, filter_name):
+        '''
+        Returns the compiled rating table for a rating filter.
+        '''
+        if filter_name == 'Favourites':
+            return compile_rating_range(self.get_favourites_threshold(), 5.0)
+        return self.rating_tables[filter_name]
 
     def target_value_to_filter_name(self, target_value):
         '''
@@ -130,13 +498,27 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
     def filter_change_cb(self, action, current):
         '''
         Called when the filter state on a page is changed. Sets the new 
-        state and triggers a refresh of the entry view.
+        state and triggers a refresh of the entry view. Choosing Discover 
+        again on a page that shows it draws a new sample.
         '''
         action.set_state(current)
         
         shell = self.object
         page = shell.props.selected_page
         self.active_filter[page] = self.target_value_to_filter_name(current)
+        if self.recorder is not None:
+            self.recorder.filter(self.active_filter[page])
+
+        if (self.active_filter[page] == 'Discover' and 
+            page in self.visited_pages):
+            [visible_filter, query_models, _] = self.visited_pages[page]
+            if visible_filter == 'Discover' and 'Discover' in query_models:
+                self.streams[query_models['Discover']].resample()
+                return
+
+        if self.get_global_filter():
+            self.settings['global-filter'] = self.active_filter[page]
+            return
         
         self.change_filter()
     
@@ -155,18 +537,36 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
             'Changing filter on ' + page.props.name
             )
 
+        self.prepare_page(page, self.active_filter[page])
+        self.refresh(page)
+
+    def prepare_page(self, page, active_filter):
+        '''
+        Makes sure the page has an up to date query model for the filter and 
+        makes the filter active on it, without refreshing the entry view.
+        '''
         t = self.get_favourites_threshold()
-        active_filter = self.active_filter[page]
         if page in self.visited_pages:
+            self.metrics.inc('cache_hits_total', (('cache', 'visited_pages'),))
             [_, query_models, t0] = self.visited_pages[page]
             if (active_filter not in query_models or 
-                (active_filter == 'Favourites' and t0 != t)):
+                (active_filter in self.threshold_filters and t0 != t)):
+                self.metrics.inc(
+                    'cache_misses_total', (('cache', 'query_models'),)
+                    )
+                if active_filter in query_models:
+                    self.discard_query_model(query_models[active_filter])
                 query_models[active_filter] = self.filter_query_model(
                     active_filter, query_models['All Ratings']
                     )
-            self.visited_pages[page] = [active_filter, query_models, t]
-            self.refresh(page)
+            else:
+                self.metrics.inc(
+                    'cache_hits_total', (('cache', 'query_models'),)
+                    )
         else:
+            self.metrics.inc(
+                'cache_misses_total', (('cache', 'visited_pages'),)
+                )
             query_models = {}
             query_model = page.get_entry_view().props.model
             query_models['All Ratings'] = self.filter_query_model(
@@ -175,25 +575,109 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
             query_models[active_filter] = self.filter_query_model(
                 active_filter, query_model
                 )
+            self.handler_ids += [
+                (page, page.connect("filter-changed", self.on_browser_change)),
+                (page, page.connect("deleted", self.on_page_delete))
+                ]
 
-            self.visited_pages[page] = [active_filter, query_models, t]
+        self.visited_pages[page] = [active_filter, query_models, t]
+
+    def get_global_filter(self):
+        '''
+        Returns the filter to apply to all pages, or None if each page has 
+        its own filter.
+        '''
+        if not self.settings['apply-to-all-pages']:
+            return None
+        filter_name = self.settings['global-filter']
+        if filter_name not in self.target_values:
+            return 'All Ratings'
+        return filter_name
+
+    def global_filter_toggle_cb(self, action, parameter):
+        '''
+        Called when Apply to All Pages is toggled in the Filter menu.
+        '''
+        self.settings['apply-to-all-pages'] = not action.get_state().unpack()
+
+    def on_global_filter_changed(self, settings, key):
+        '''
+        Applies the global filter when it is turned on or changed, and stops 
+        applying it in the background when it is turned off.
+        '''
+        self.global_action.set_state(
+            GLib.Variant.new_boolean(self.settings['apply-to-all-pages'])
+            )
+        if self.get_global_filter():
+            self.apply_global_filter()
+        else:
+            self.global_queue = []
+
+    def apply_global_filter(self):
+        '''
+        Applies the global filter to the library and every playlist. The 
+        selected page is filtered straight away; the others are filtered in 
+        the background, one per main loop iteration. The library goes first, 
+        so that the ratings it reads into the shared rating index are reused 
+        by every playlist rather than read again for each one.
+        '''
+        filter_name = self.get_global_filter()
+        if not filter_name:
+            return
+
+        self.log(
+            self.apply_global_filter.__name__, 
+            "Applying '" + filter_name + "' to all pages"
+            )
+
+        if len(self.visited_pages) == 0:
+            self.set_callbacks() # set callbacks on first run
+
+        shell = self.object
+        page = shell.props.selected_page
+        pages = list(shell.props.playlist_manager.get_playlists())
+        pages.append(shell.props.library_source)
+        self.global_queue = [p for p in pages if p != page]
+
+        if self.is_filterable(page):
+            self.active_filter[page] = filter_name
+            self.prepare_page(page, filter_name)
+            self.action.set_state(self.target_values[filter_name])
             self.refresh(page)
-    
+
+        if self.global_queue and self.global_source_id is None:
+            self.global_source_id = GLib.idle_add(self.process_global_queue)
+
+    def process_global_queue(self):
+        '''
+        Applies the global filter to the next page waiting for it. Returns 
+        True while there are pages left, so that it is called again.
+        '''
+        filter_name = self.get_global_filter()
+        while filter_name and self.global_queue:
+            page = self.global_queue.pop()
+            if self.is_filterable(page):
+                self.active_filter[page] = filter_name
+                self.prepare_page(page, filter_name)
+                return True
+        self.global_queue = []
+        self.global_source_id = None
+        return False
+
     def set_callbacks(self):
         '''
         Sets callbacks to detect UI interactions, should be called only 
         after the rating filters are first activated.
         '''
         shell = self.object
-        shell.props.display_page_tree.connect(
-            "selected", self.on_page_change
-            )
-        shell.props.selected_page.connect(
-            "filter-changed", self.on_browser_change
-            )
-        shell.props.db.connect(
-            'entry-changed', self.on_entry_change
-            )
+        display_page_tree = shell.props.display_page_tree
+        db = shell.props.db
+        self.handler_ids += [
+            (display_page_tree, 
+                display_page_tree.connect("selected", self.on_page_change)),
+            (db, db.connect('entry-changed', self.on_entry_change)),
+            (db, db.connect('entry-deleted', self.on_entry_delete))
+            ]
 
     def get_favourites_threshold(self):
         '''
@@ -214,40 +698,313 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
             'Favourites threshold changed on ' + page.props.name
             )        
         
-        if page in self.active_filter:
-            if self.active_filter[page] == 'Favourites':
+        self.schedule_menu_counts()
+        if self.get_global_filter() in self.threshold_filters:
+            self.apply_global_filter()
+        elif page in self.active_filter:
+            if self.active_filter[page] in self.threshold_filters:
                 self.change_filter()
 
+    def on_filter_setting_changed(self, settings, key):
+        '''
+        Drops the cached models of the filters that depend on a setting 
+        when it is changed, and refreshes the view if it shows one of them.
+        '''
+        shell = self.object
+        page = shell.props.selected_page
+        filter_names = self.filter_settings[key]
+
+        self.log(
+            self.on_filter_setting_changed.__name__, 
+            "Setting '" + key + "' changed on " + page.props.name
+            )
+
+        for [_, query_models, _] in self.visited_pages.values():
+            for filter_name in filter_names:
+                if filter_name in query_models:
+                    self.discard_query_model(query_models.pop(filter_name))
+
+        if self.get_global_filter() in filter_names:
+            self.apply_global_filter()
+        elif self.active_filter.get(page) in filter_names:
+            self.change_filter()
+
+    def on_filter_profiles_changed(self, settings, key):
+        '''
+        Recompiles the filter profiles and rebuilds the Filter menu when the 
+        profiles are changed. Pages showing a profile that has been changed 
+        or removed are reset.
+        '''
+        self.log(
+            self.on_filter_profiles_changed.__name__, 
+            'Filter profiles changed'
+            )
+
+        for name in self.profile_names:
+            del self.target_values[name]
+        old_rating_tables = self.rating_tables
+        self.load_filter_profiles()
+        self.build_menu()
+
+        shell = self.object
+        for page in self.visited_pages:
+            [active_filter, query_models, t] = self.visited_pages[page]
+            for filter_name in list(query_models):
+                if (filter_name in old_rating_tables and 
+                    self.rating_tables.get(filter_name) != 
+                    old_rating_tables[filter_name]):
+                    self.discard_query_model(query_models.pop(filter_name))
+            if active_filter not in self.target_values:
+                active_filter = 'All Ratings'
+                self.active_filter[page] = active_filter
+            self.visited_pages[page] = [active_filter, query_models, t]
+
+        self.on_page_change(None, shell.props.selected_page)
+
+    def on_stall_threshold_changed(self, settings, key):
+        '''
+        Starts, restarts or stops the main loop stall watchdog. Stalls 
+        recorded so far are kept.
+        '''
+        events = []
+        if self.watchdog is not None:
+            events = self.watchdog.events
+            self.watchdog.stop()
+            self.watchdog = None
+        threshold = self.settings['stall-threshold']
+        if threshold > 0:
+            self.watchdog = StallWatchdog(
+                threshold, self.on_stall, events
+                )
+
+    def on_stall(self, event):
+        '''
+        Called by the watchdog on the main loop once a stall has ended.
+        '''
+        self.log(
+            self.on_stall.__name__, 'Main loop stalled for %.3fs in %s' % (
+                event['duration'], ', '.join(event['callbacks']) or 
+                'code outside the plugin'
+                )
+            )
+
+    def dump_stalls_cb(self, action, parameter):
+        '''
+        Writes the stalls recorded by the watchdog, with a stack sample for 
+        each, to stalls.log in the plugin's cache folder.
+        '''
+        if self.watchdog is None:
+            self.log(
+                self.dump_stalls_cb.__name__, 
+                'The stall watchdog is off; set stall-threshold to enable it'
+                )
+            return
+        events = self.watchdog.dump()
+        path = self.get_cache_path('stalls.log')
+        with open(path, 'w') as log_file:
+            for event in events:
+                log_file.write('%s  %.3fs  %s\n' % (
+                    time.strftime(
+                        '%Y-%m-%d %H:%M:%S', time.localtime(event['time'])
+                        ),
+                    event['duration'], 
+                    ', '.join(event['callbacks']) or 'outside the plugin'
+                    ))
+                log_file.writelines(
+                    '    ' + line for line in event['stack']
+                    )
+                log_file.write('\n')
+        self.log(
+            self.dump_stalls_cb.__name__, 
+            'Wrote %d stalls to %s' % (len(events), path)
+            )
+
+    def profile_toggle_cb(self, action, parameter):
+        '''
+        Called when Profile Filters is toggled in the Filter menu. Starts 
+        profiling, or stops it and writes the reports.
+        '''
+        if self.profiler is None:
+            self.profiler = Profiler()
+            self.log(self.profile_toggle_cb.__name__, 'Profiling started')
+        else:
+            self.stop_profiling()
+        action.set_state(GLib.Variant.new_boolean(self.profiler is not None))
+
+    def stop_profiling(self):
+        '''
+        Stops profiling and writes the CPU profile and the allocation report 
+        to the plugin's cache folder.
+        '''
+        name = time.strftime('profile-%Y%m%d-%H%M%S')
+        stats_path = self.get_cache_path(name + '.pstats')
+        report_path = self.get_cache_path(name + '.txt')
+        self.profiler.stop(stats_path, report_path)
+        self.profiler = None
+        self.log(
+            self.stop_profiling.__name__, 
+            'Wrote profile to %s and report to %s' % (stats_path, report_path)
+            )
+
+    def on_trace_recording_changed(self, settings, key):
+        '''
+        Starts or stops recording a trace of the signals the plugin 
+        receives to a new file in the plugin's cache folder.
+        '''
+        if self.recorder is not None:
+            self.recorder.stop()
+            self.log(
+                self.on_trace_recording_changed.__name__, 
+                'Stopped recording to ' + self.recorder.path
+                )
+            self.recorder = None
+        if self.settings['trace-recording']:
+            path = self.get_cache_path(
+                time.strftime('trace-%Y%m%d-%H%M%S.jsonl')
+                )
+            self.recorder = TraceRecorder(path, self.object, self.settings)
+            self.log(
+                self.on_trace_recording_changed.__name__, 
+                'Recording to ' + path
+                )
+
+    def on_metrics_settings_changed(self, settings, key):
+        '''
+        Starts, reschedules or stops writing metrics.
+        '''
+        if self.metrics_source_id is not None:
+            GLib.source_remove(self.metrics_source_id)
+            self.metrics_source_id = None
+        interval = self.settings['metrics-interval']
+        if interval > 0:
+            self.metrics_source_id = GLib.timeout_add_seconds(
+                interval, self.write_metrics
+                )
+
+    def write_metrics(self):
+        '''
+        Writes the counters, and gauges describing each visited page, to the 
+        metrics file.
+        '''
+        start = time.monotonic()
+        gauges = [('visited_pages', (), len(self.visited_pages))]
+        for page, (_, query_models, _) in self.visited_pages.items():
+            # Page names aren't unique (two playlists can share a name), so 
+            # each page is also labelled with its identity.
+            labels = (('page', page.props.name), ('page_id', '%x' % id(page)))
+            entries = query_models['All Ratings'].iter_n_children(None)
+            rows = sum(
+                query_model.iter_n_children(None) 
+                for query_model in query_models.values()
+                )
+            size = rows * Metrics.row_size
+            page_filters = self.page_filters.get(query_models['All Ratings'])
+            if page_filters is not None:
+                size += sys.getsizeof(page_filters.cache.members) + sum(
+                    sys.getsizeof(bucket) 
+                    for bucket in page_filters.cache.buckets
+                    )
+            gauges += [
+                ('page_entries', labels, entries),
+                ('page_models', labels, len(query_models)),
+                ('page_model_rows', labels, rows),
+                ('page_memory_bytes', labels, size)
+                ]
+        path = self.settings['metrics-file'] or self.get_cache_path(
+            'rating_filters.prom'
+            )
+        try:
+            self.metrics.write(path, gauges)
+        except (IOError, OSError) as e:
+            self.log(
+                self.write_metrics.__name__, 
+                'Could not write metrics to %s: %s' % (path, e), error=True
+                )
+        self.metrics.set_duration(time.monotonic() - start)
+        return True
+
+    def get_cache_path(self, filename):
+        '''
+        Returns the path of a file in the plugin's cache folder, creating 
+        the folder if needed.
+        '''
+        path = os.path.join(RB.user_cache_dir(), 'rating-filters')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return os.path.join(path, filename)
+
     def on_entry_change(self, db, entry, changes):
         '''
-        Called when an entry in the current view is changed. If the user has 
-        changed a track's rating, and the new rating should be filtered out, 
-        then the page is refreshed.
+        Called when an entry in the database is changed. If the user has 
+        changed a track's rating, the track is added to or removed from the 
+        filtered models it now passes or fails, without rebuilding them.
         '''
-        # This isn't working like it used to: the changes object no longer 
-        # has a values property, so we can't check to see what was changed. 
-        # For now, we'll just refresh everything each time something is 
-        # changed, although this isn't ideal.
+        # The changes object no longer has a values property, so we can't 
+        # check to see what was changed. Instead, the rating index tells us 
+        # whether the entry's rating has moved to another bucket.
         
         #change = changes.values
         
         #if change.prop is RB.RhythmDBPropType.RATING:
         if True:
-            for page in self.visited_pages:
-                [active_filter, query_models, t] = self.visited_pages[page]
-                query_model = query_models['All Ratings']
-                entries = [row[0] for row in query_model]
-                if entry in entries:
-                    if "Favourites" in query_models:
-                        del query_models["Favourites"]
-                    if "Unrated" in query_models:
-                        del query_models["Unrated"]
-                    self.visited_pages[page] = [
-                        active_filter,query_models, t
-                        ]
-                        
-            shell = self.object
-            self.on_page_change(None, shell.props.selected_page)
+            self.metrics.inc('entry_changes_received_total')
+            if self.recorder is not None:
+                self.recorder.entry_changed(entry)
+            entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+            rating = get_rating_bucket(
+                entry.get_double(RB.RhythmDBPropType.RATING)
+                )
+            threshold = self.get_favourites_threshold()
+            mode = self.settings['favourite-groups-mode']
+            for filter_name, group_ratings in self.group_ratings.items():
+                self.refresh_groups(group_ratings, group_ratings.update(
+                    entry_id, self.group_filters[filter_name](entry), rating, 
+                    threshold, mode
+                    ))
+            if self.composite_index is not None:
+                self.index_entry(entry)
+            delta = self.rating_index.update(
+                entry_id, entry.get_double(RB.RhythmDBPropType.RATING)
+                )
+            if delta is not None:
+                self.metrics.inc('entry_changes_acted_on_total')
+                for page_filters in list(self.page_filters.values()):
+                    page_filters.entry_changed(entry, entry_id, delta)
+
+            for stream in list(self.streams.values()):
+                stream.entry_changed(entry)
+
+    def on_entry_delete(self, db, entry):
+        '''
+        Called when an entry is deleted from the database. Removes it from 
+        the album and artist rating aggregates and the composite index.
+        '''
+        if self.recorder is not None:
+            self.recorder.entry_deleted(entry)
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        threshold = self.get_favourites_threshold()
+        mode = self.settings['favourite-groups-mode']
+        for group_ratings in self.group_ratings.values():
+            self.refresh_groups(
+                group_ratings, group_ratings.remove(entry_id, threshold, mode)
+                )
+        if self.composite_index is not None:
+            self.composite_index.remove(entry_id)
+        self.rating_index.remove(entry_id)
+
+    def refresh_groups(self, group_ratings, groups):
+        '''
+        Shows or hides the tracks of groups that have crossed the favourites 
+        threshold in every cached model that groups them, whether or not 
+        the entry that moved them is on its page.
+        '''
+        if not groups:
+            return
+        for stream in list(self.streams.values()):
+            if (isinstance(stream, FavouriteGroupsStream) and 
+                stream.group_ratings is group_ratings):
+                for group in groups:
+                    stream.refresh_group(group)
 
     def on_browser_change(self, action):
         '''
@@ -261,22 +1018,31 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
             self.on_browser_change.__name__, 
             "Browser changed on page " + page.props.name
             )
+        if self.recorder is not None:
+            self.recorder.browse(page)
 
         query_models = {}
         query_model = page.get_entry_view().props.model
 
-        active_filter = 'All Ratings'
-        query_models[active_filter] = self.filter_query_model(
-            active_filter, query_model
+        [active_filter, old_query_models, t] = self.visited_pages[page]
+        for old_query_model in old_query_models.values():
+            self.discard_query_model(old_query_model)
+        old_page_filters = self.page_filters.pop(
+            old_query_models['All Ratings'], None
+            )
+        if old_page_filters is not None:
+            old_page_filters.stop()
+            self.get_page_filters(query_model)
+        query_models['All Ratings'] = self.filter_query_model(
+            'All Ratings', query_model
             )
-
-        [active_filter, _, t] = self.visited_pages[page]
         query_models[active_filter] = self.filter_query_model(
             active_filter, query_model
             )
 
         self.visited_pages[page] = [active_filter, query_models, t]
         self.refresh(page)
+        self.update_menu_counts()
 
     def on_page_change(self, display_page_tree, page):
         '''
@@ -287,71 +1053,244 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
             self.on_page_change.__name__, 
             "Page changed to " + page.props.name
             )
+        if self.recorder is not None:
+            self.recorder.select(page)
 
-        shell = self.object
-        t = self.get_favourites_threshold()
-        if (type(page) == RB.PlaylistSource or 
-            type(page) == RB.AutoPlaylistSource or 
-            page == shell.props.library_source):
+        if self.is_filterable(page):
+            global_filter = self.get_global_filter()
             if page in self.visited_pages:
-                [active_filter, query_models, t0] = self.visited_pages[page]
-
-                if ((active_filter == "Favourites" and t0 != t) or 
-                    active_filter not in query_models):
-                    query_models[active_filter] = self.filter_query_model(
-                        active_filter, query_models['All Ratings']
-                        )
-                    self.visited_pages[page] = [
-                        active_filter, query_models, t
-                        ]
-                    
-                self.action.set_state(self.target_values[active_filter])
+                active_filter = self.visited_pages[page][0]
+                self.prepare_page(page, global_filter or active_filter)
+                self.action.set_state(
+                    self.target_values[global_filter or active_filter]
+                    )
                 self.refresh(page)
             else:
-                query_models = {}
-                query_model = page.get_entry_view().props.model
-
-                active_filter = 'All Ratings'               
-                query_models[active_filter] = self.filter_query_model(
-                    active_filter, query_model
+                self.prepare_page(page, global_filter or 'All Ratings')
+                self.action.set_state(
+                    self.target_values[global_filter or 'All Ratings']
                     )
+                if global_filter:
+                    self.refresh(page)
+        self.update_menu_counts()
+
+    def on_page_delete(self, page):
+        '''
+        Called when a visited page is deleted. Drops its query models and 
+        disconnects from it.
+        '''
+        self.log(
+            self.on_page_delete.__name__, 
+            "Page deleted: " + page.props.name
+            )
+
+        [_, query_models, _] = self.visited_pages.pop(page)
+        self.active_filter.pop(page, None)
+        if page in self.global_queue:
+            self.global_queue.remove(page)
+        for query_model in query_models.values():
+            self.discard_query_model(query_model)
+        page_filters = self.page_filters.pop(query_models['All Ratings'], None)
+        if page_filters is not None:
+            page_filters.stop()
 
-                self.visited_pages[page] = [active_filter, query_models, t]
-                self.action.set_state(self.target_values[active_filter])
-                page.connect("filter-changed", self.on_browser_change)
+        for gobject, handler_id in self.handler_ids:
+            if gobject is page:
+                page.disconnect(handler_id)
+        self.handler_ids = [
+            (gobject, handler_id) for gobject, handler_id in self.handler_ids 
+            if gobject is not page
+            ]
+
+    def is_filterable(self, page):
+        '''
+        Returns True if the page is a source with an entry view, i.e. the 
+        library, a playlist, a device, a DAAP share or a podcast feed.
+        '''
+        return (isinstance(page, RB.Source) and 
+                page.get_entry_view() is not None)
 
     def filter_query_model(self, active_filter, query_model):
         '''
         Applies the active filter to the supplied query model and returns 
-        the result.
+        the result. Entries that are added to the supplied query model 
+        afterwards (e.g. while a large source is still loading) are 
+        streamed into the result as they arrive.
         '''
         self.log(
             self.filter_query_model.__name__, 
             "Creating new query model for " + active_filter
             )
             
+        if active_filter == 'All Ratings':
+            return query_model
+
         shell = self.object
         db = shell.props.db
         new_query_model = RB.RhythmDBQueryModel.new_empty(db)
 
-        if active_filter == 'All Ratings':
-            new_query_model = query_model
+        self.metrics.inc('filter_builds_total', (('filter', active_filter),))
+        if active_filter == 'Top Tracks':
+            self.streams[new_query_model] = TopTracksStream(
+                query_model, new_query_model, 
+                self.settings['top-tracks-size']
+                )
+        elif active_filter in self.group_filters:
+            self.streams[new_query_model] = FavouriteGroupsStream(
+                query_model, new_query_model, 
+                self.get_group_ratings(active_filter), 
+                self.group_filters[active_filter], 
+                self.get_favourites_threshold(), 
+                self.settings['favourite-groups-mode'], self.refresh_groups
+                )
+        elif active_filter in self.composite_filters:
+            self.streams[new_query_model] = CompositeStream(
+                query_model, new_query_model, self.get_composite_index(), 
+                self.get_composite_query(active_filter), self.index_entry
+                )
+        elif active_filter == 'Discover':
+            self.streams[new_query_model] = DiscoverStream(
+                query_model, new_query_model, self.settings['discover-size']
+                )
         else:
-            if active_filter == "Favourites":
-                ratings = [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
-                t = self.get_favourites_threshold()
-                ratings = ratings[t:]
-            else:
-                ratings = [0.0]
-
-            for row in query_model:
-                entry = row[0]
-                entry_rating = entry.get_double(RB.RhythmDBPropType.RATING)
-                if entry_rating in ratings:
-                    new_query_model.add_entry(entry, -1)
+            page_filters = self.get_page_filters(query_model)
+            page_filters.add_filter(
+                active_filter, self.get_rating_table(active_filter), 
+                new_query_model
+                )
+            self.rating_models[new_query_model] = (page_filters, active_filter)
+            # The page's rating cache hands over just the entries that pass.
+            self.metrics.inc(
+                'entries_scanned_total', (), 
+                new_query_model.iter_n_children(None)
+                )
+            return new_query_model
 
+        # Streams walk the whole source when they start.
+        self.metrics.inc(
+            'entries_scanned_total', (), query_model.iter_n_children(None)
+            )
         return new_query_model
 
+    def get_page_filters(self, query_model):
+        '''
+        Returns the rating filters built from a query model, starting to 
+        track its entries the first time it is needed.
+        '''
+        if query_model not in self.page_filters:
+            self.metrics.inc(
+                'entries_scanned_total', (), query_model.iter_n_children(None)
+                )
+            self.page_filters[query_model] = PageFilters(
+                query_model, self.rating_index, self.schedule_menu_counts
+                )
+        return self.page_filters[query_model]
+
+    def get_album_key(self, entry):
+        '''
+        Returns the album an entry belongs to. Albums are told apart by 
+        album artist as well as by name.
+        '''
+        artist = entry.get_string(RB.RhythmDBPropType.ALBUM_ARTIST)
+        if not artist:
+            artist = entry.get_string(RB.RhythmDBPropType.ARTIST)
+        return (artist, entry.get_string(RB.RhythmDBPropType.ALBUM))
+
+    def get_artist_key(self, entry):
+        '''
+        Returns the artist an entry belongs to.
+        '''
+        return entry.get_string(RB.RhythmDBPropType.ARTIST)
+
+    def get_group_ratings(self, filter_name):
+        '''
+        Returns the rating aggregates for a group filter, building them 
+        from the library the first time they are needed. After that they 
+        are kept up to date as entries change.
+        '''
+        if filter_name not in self.group_ratings:
+            self.log(
+                self.get_group_ratings.__name__, 
+                'Aggregating ratings for ' + filter_name
+                )
+            group_ratings = GroupRatings()
+            get_group = self.group_filters[filter_name]
+            library_source = self.object.props.library_source
+            query_model = library_source.props.base_query_model
+            self.metrics.inc(
+                'entries_scanned_total', (), query_model.iter_n_children(None)
+                )
+            for entry in get_entries(query_model):
+                group_ratings.update(
+                    entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID), 
+                    get_group(entry), 
+                    get_rating_bucket(
+                        entry.get_double(RB.RhythmDBPropType.RATING)
+                        )
+                    )
+            self.group_ratings[filter_name] = group_ratings
+        return self.group_ratings[filter_name]
+
+    def index_entry(self, entry):
+        '''
+        Adds an entry to the composite index, or updates it there.
+        '''
+        self.composite_index.update(
+            entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID), 
+            get_rating_bucket(entry.get_double(RB.RhythmDBPropType.RATING)), 
+            entry.get_ulong(RB.RhythmDBPropType.PLAY_COUNT), 
+            entry.get_ulong(RB.RhythmDBPropType.LAST_PLAYED)
+            )
+
+    def get_composite_index(self):
+        '''
+        Returns the composite index of ratings and play history, building it 
+        from the library the first time it is needed. After that it is kept 
+        up to date as entries change.
+        '''
+        if self.composite_index is None:
+            self.log(
+                self.get_composite_index.__name__, 
+                'Indexing ratings and play history'
+                )
+            self.composite_index = CompositeIndex()
+            library_source = self.object.props.library_source
+            query_model = library_source.props.base_query_model
+            self.metrics.inc(
+                'entries_scanned_total', (), query_model.iter_n_children(None)
+                )
+            for entry in get_entries(query_model):
+                self.index_entry(entry)
+        return self.composite_index
+
+    def get_composite_query(self, filter_name):
+        '''
+        Returns the composite index query for a composite filter.
+        '''
+        if filter_name == 'Forgotten Favourites':
+            table = self.get_rating_table('Favourites')
+            days = self.settings['forgotten-days']
+            return {
+                'buckets': [b for b in range(RATING_BUCKETS) if table[b]],
+                'played_before': int(time.time()) - days * 24 * 60 * 60
+                }
+        else:
+            return {
+                'buckets': [0],
+                'more_plays_than': self.settings['overplayed-count']
+                }
+
+    def discard_query_model(self, query_model):
+        '''
+        Stops streaming entries into a filtered query model that is no 
+        longer needed.
+        '''
+        if query_model in self.streams:
+            self.streams.pop(query_model).stop()
+        elif query_model in self.rating_models:
+            page_filters, filter_name = self.rating_models.pop(query_model)
+            page_filters.remove_filter(filter_name)
+
     def refresh(self, page):
         '''
         Refreshes the entry view on the specified page.
@@ -372,6 +1311,899 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
         page.props.query_model = query_model
 
 
+class StreamingFilter(object):
+    '''
+    Keeps a filtered query model in step with the query model it was 
+    built from, so that entries which arrive after the filter was first 
+    applied are filtered as they stream in, and entries which leave the 
+    source leave the filtered view too.
+    '''
+    def __init__(self, query_model, new_query_model):
+        self.query_model = query_model
+        self.new_query_model = new_query_model
+        self.handler_ids = [
+            query_model.connect('row-inserted', self.on_row_inserted),
+            query_model.connect('entry-removed', self.on_entry_removed)
+            ]
+
+    def on_row_inserted(self, query_model, path, tree_iter):
+        entry = query_model.iter_to_entry(tree_iter)
+        if entry is not None:
+            self.entry_added(entry)
+
+    def entry_added(self, entry):
+        '''
+        Called when an entry is loaded into the source after the filter was 
+        applied. Each stream adds it to the filtered model if it passes.
+        '''
+        pass
+
+    def on_entry_removed(self, query_model, entry):
+        '''
+        Removes an entry that has left the source from the filtered model.
+        '''
+        self.new_query_model.remove_entry(entry)
+
+    def entry_changed(self, entry):
+        '''
+        Called when an entry in the database changes. Streams that can 
+        update themselves incrementally override this.
+        '''
+        pass
+
+    def stop(self):
+        '''
+        Disconnects from the source query model.
+        '''
+        for handler_id in self.handler_ids:
+            self.query_model.disconnect(handler_id)
+        self.handler_ids = []
+
+
+class TopTracksStream(StreamingFilter):
+    '''
+    Keeps a query model holding the best tracks in a source, by rating, 
+    then play count, then last played, up to date as the source and its 
+    entries change.
+    '''
+    def __init__(self, query_model, new_query_model, n):
+        self.db = query_model.props.db
+        self.top = TopN(n)
+        self.entry_ids = set()
+        self.visible = set()
+        self.rebuild(query_model)
+        StreamingFilter.__init__(self, query_model, new_query_model)
+        self.update_view()
+
+    def get_sort_key(self, entry):
+        '''
+        Returns the key that top tracks are ranked by.
+        '''
+        return (
+            entry.get_double(RB.RhythmDBPropType.RATING),
+            entry.get_ulong(RB.RhythmDBPropType.PLAY_COUNT),
+            entry.get_ulong(RB.RhythmDBPropType.LAST_PLAYED)
+            )
+
+    def rebuild(self, query_model):
+        '''
+        Rescans the source. Only needed when the buffer of candidate top 
+        tracks runs dry.
+        '''
+        self.entry_ids = set()
+        items = []
+        for entry in get_entries(query_model):
+            entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+            self.entry_ids.add(entry_id)
+            items.append((entry_id, self.get_sort_key(entry)))
+        self.top.build(items)
+
+    def update_view(self):
+        '''
+        Applies the difference between the current and previous top tracks 
+        to the filtered query model.
+        '''
+        if self.top.needs_rebuild():
+            self.rebuild(self.query_model)
+        visible = self.top.top()
+        for entry_id in self.visible - visible:
+            entry = self.db.entry_lookup_by_id(entry_id)
+            if entry is not None:
+                self.new_query_model.remove_entry(entry)
+        for entry_id in visible - self.visible:
+            entry = self.db.entry_lookup_by_id(entry_id)
+            if entry is not None:
+                self.new_query_model.add_entry(entry, -1)
+        self.visible = visible
+
+    def entry_added(self, entry):
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        if entry_id not in self.entry_ids:
+            self.entry_ids.add(entry_id)
+            if self.top.add(entry_id, self.get_sort_key(entry)):
+                self.update_view()
+
+    def on_entry_removed(self, query_model, entry):
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        if entry_id in self.entry_ids:
+            self.entry_ids.discard(entry_id)
+            if self.top.remove(entry_id):
+                self.update_view()
+
+    def entry_changed(self, entry):
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        if entry_id in self.entry_ids:
+            if self.top.update(entry_id, self.get_sort_key(entry)):
+                self.update_view()
+
+
+class DiscoverStream(StreamingFilter):
+    '''
+    Keeps a query model holding a random sample of the unrated tracks in 
+    a source. Sampled tracks that get rated or leave the source are 
+    swapped for spare unrated tracks, and tracks that become unrated are 
+    offered to the sample, so the sample never needs more than O(k) 
+    memory.
+    '''
+    def __init__(self, query_model, new_query_model, k):
+        self.db = query_model.props.db
+        self.reservoir = Reservoir(k)
+        self.entry_ids = set()
+        StreamingFilter.__init__(self, query_model, new_query_model)
+        self.resample()
+
+    def is_unrated(self, entry):
+        '''
+        Returns True if the entry belongs in the unrated pool.
+        '''
+        return get_rating_bucket(
+            entry.get_double(RB.RhythmDBPropType.RATING)
+            ) == 0
+
+    def get_unrated_entry_ids(self):
+        '''
+        Yields the IDs of the unrated entries in the source, noting the ID 
+        of every entry in it.
+        '''
+        self.entry_ids = set()
+        for entry in get_entries(self.query_model):
+            entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+            self.entry_ids.add(entry_id)
+            if self.is_unrated(entry):
+                yield entry_id
+
+    def resample(self):
+        '''
+        Draws a new sample in a single pass over the source.
+        '''
+        old_sample = self.reservoir.sample
+        self.reservoir.build(self.get_unrated_entry_ids())
+        for entry_id in old_sample - self.reservoir.sample:
+            entry = self.db.entry_lookup_by_id(entry_id)
+            if entry is not None:
+                self.new_query_model.remove_entry(entry)
+        for entry_id in self.reservoir.sample - old_sample:
+            entry = self.db.entry_lookup_by_id(entry_id)
+            if entry is not None:
+                self.new_query_model.add_entry(entry, -1)
+
+    def swap_out(self, entry):
+        '''
+        Removes an entry that has left the unrated pool from the sample, 
+        replacing it with a spare if there is one.
+        '''
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        if entry_id not in self.reservoir:
+            return
+        replacement_id = self.reservoir.discard(entry_id)
+        self.new_query_model.remove_entry(entry)
+        if replacement_id is not None:
+            replacement = self.db.entry_lookup_by_id(replacement_id)
+            if replacement is not None:
+                self.new_query_model.add_entry(replacement, -1)
+        elif self.reservoir.needs_rebuild():
+            self.resample()
+
+    def offer(self, entry, entry_id):
+        '''
+        Offers an unrated entry in the source to the sample.
+        '''
+        if self.reservoir.offer(entry_id):
+            self.new_query_model.add_entry(entry, -1)
+
+    def entry_added(self, entry):
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        self.entry_ids.add(entry_id)
+        if self.is_unrated(entry):
+            self.offer(entry, entry_id)
+
+    def on_entry_removed(self, query_model, entry):
+        self.entry_ids.discard(entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID))
+        self.swap_out(entry)
+
+    def entry_changed(self, entry):
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        if entry_id not in self.entry_ids:
+            return
+        if self.is_unrated(entry):
+            self.offer(entry, entry_id)
+        else:
+            self.swap_out(entry)
+
+
+class FavouriteGroupsStream(StreamingFilter):
+    '''
+    Keeps a query model holding the tracks in a source whose album (or 
+    artist) has an average or minimum rating at or above the favourites 
+    threshold. Whole groups are added or removed as rating changes push 
+    them across the threshold.
+    '''
+    def __init__(self, query_model, new_query_model, group_ratings, 
+                 get_group, threshold, mode, groups_changed=None):
+        self.db = query_model.props.db
+        self.group_ratings = group_ratings
+        self.get_group = get_group
+        self.threshold = threshold
+        self.mode = mode
+        self.groups_changed = groups_changed or (lambda *args: None)
+        self.new_query_model = new_query_model
+        self.entry_ids = set()
+        self.shown_groups = set()
+        for entry in get_entries(query_model):
+            self.add(entry)
+        StreamingFilter.__init__(self, query_model, new_query_model)
+
+    def add(self, entry):
+        '''
+        Adds an entry in the source, showing it if its group qualifies.
+        '''
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        self.entry_ids.add(entry_id)
+        if entry_id not in self.group_ratings:
+            rating = get_rating_bucket(
+                entry.get_double(RB.RhythmDBPropType.RATING)
+                )
+            groups = self.group_ratings.update(
+                entry_id, self.get_group(entry), rating, self.threshold, 
+                self.mode
+                )
+            for group in groups:
+                self.refresh_group(group)
+            self.groups_changed(self.group_ratings, groups)
+        self.show(entry, entry_id)
+
+    def show(self, entry, entry_id):
+        '''
+        Adds or removes an entry according to whether its group is shown.
+        '''
+        group = self.group_ratings.get_group(entry_id)
+        if group not in self.shown_groups and self.qualifies(group):
+            self.refresh_group(group)
+        elif group in self.shown_groups:
+            self.new_query_model.add_entry(entry, -1)
+        else:
+            self.new_query_model.remove_entry(entry)
+
+    def qualifies(self, group):
+        '''
+        Returns True if the group meets the favourites threshold.
+        '''
+        return self.group_ratings.qualifies(group, self.threshold, self.mode)
+
+    def refresh_group(self, group):
+        '''
+        Shows or hides every track of a group in the source when the group 
+        crosses the favourites threshold.
+        '''
+        qualifies = self.qualifies(group)
+        if qualifies == (group in self.shown_groups):
+            return
+        if qualifies:
+            self.shown_groups.add(group)
+        else:
+            self.shown_groups.discard(group)
+        for entry_id in self.group_ratings.get_members(group):
+            if entry_id in self.entry_ids:
+                entry = self.db.entry_lookup_by_id(entry_id)
+                if entry is None:
+                    continue
+                if qualifies:
+                    self.new_query_model.add_entry(entry, -1)
+                else:
+                    self.new_query_model.remove_entry(entry)
+
+    def entry_added(self, entry):
+        self.add(entry)
+
+    def on_entry_removed(self, query_model, entry):
+        self.entry_ids.discard(entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID))
+        self.new_query_model.remove_entry(entry)
+
+    def entry_changed(self, entry):
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        if entry_id in self.entry_ids:
+            self.show(entry, entry_id)
+
+
+class CompositeStream(StreamingFilter):
+    '''
+    Keeps a query model holding the tracks in a source that match a query 
+    on rating and play history. Matches are looked up in the composite 
+    index, and changed entries are rechecked against it one at a time.
+    '''
+    def __init__(self, query_model, new_query_model, index, query, 
+                 index_entry):
+        self.db = query_model.props.db
+        self.index = index
+        self.query = query
+        self.index_entry = index_entry
+        self.entry_ids = set()
+        for entry in get_entries(query_model):
+            entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+            if entry_id not in index:
+                index_entry(entry)
+            self.entry_ids.add(entry_id)
+        for entry_id in index.select(**query):
+            if entry_id in self.entry_ids:
+                entry = self.db.entry_lookup_by_id(entry_id)
+                if entry is not None:
+                    new_query_model.add_entry(entry, -1)
+        StreamingFilter.__init__(self, query_model, new_query_model)
+
+    def show(self, entry, entry_id):
+        '''
+        Adds or removes an entry according to whether it matches the query.
+        '''
+        if self.index.matches(entry_id, **self.query):
+            self.new_query_model.add_entry(entry, -1)
+        else:
+            self.new_query_model.remove_entry(entry)
+
+    def entry_added(self, entry):
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        if entry_id not in self.index:
+            self.index_entry(entry)
+        self.entry_ids.add(entry_id)
+        self.show(entry, entry_id)
+
+    def on_entry_removed(self, query_model, entry):
+        self.entry_ids.discard(entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID))
+        self.new_query_model.remove_entry(entry)
+
+    def entry_changed(self, entry):
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        if entry_id in self.entry_ids:
+            self.show(entry, entry_id)
+
+
+
+class StallWatchdog(object):
+    '''
+    Detects main loop stalls and attributes them to the plugin callback 
+    that was running. A GLib timeout beats on the main loop, and a 
+    background thread that finds the heartbeat late samples the main 
+    thread's Python stack, so nothing is added to the plugin's callbacks. 
+    The most recent stalls are kept in a bounded ring.
+    '''
+    size = 50
+
+    def __init__(self, threshold, stalled, events=()):
+        self.threshold = threshold / 1000.0
+        self.interval = max(10, threshold // 4)
+        self.stalled = stalled
+        self.events = collections.deque(events, self.size)
+        self.lock = threading.Lock()
+        self.main_thread_id = threading.current_thread().ident
+        self.last_beat = time.monotonic()
+        self.stall = None
+        self.running = True
+        self.source_id = GLib.timeout_add(self.interval, self.beat)
+        self.thread = threading.Thread(
+            target=self.run, name='RatingFiltersWatchdog'
+            )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def beat(self):
+        '''
+        Records that the main loop is running, and ends the current stall 
+        if there is one.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            stall = self.stall
+            if stall is not None:
+                stall['duration'] = now - self.last_beat - self.interval / 1000.0
+                self.stall = None
+            self.last_beat = now
+        if stall is not None:
+            self.stalled(stall)
+        return True
+
+    def run(self):
+        '''
+        Samples the main thread's stack whenever the heartbeat is late by 
+        more than the threshold.
+        '''
+        while self.running:
+            time.sleep(self.interval / 2000.0)
+            late = time.monotonic() - self.last_beat - self.interval / 1000.0
+            if late < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.main_thread_id)
+            callbacks = self.get_callbacks(frame)
+            with self.lock:
+                if self.stall is None:
+                    self.stall = {
+                        'time': time.time() - late, 'duration': late,
+                        'callbacks': [], 'stack': [], 'samples': 0
+                        }
+                    self.events.append(self.stall)
+                stall = self.stall
+                stall['duration'] = late
+                stall['samples'] += 1
+                # Keep the first stack sample, or the first one that caught
+                # the plugin at work.
+                if frame is not None and (
+                    not stall['stack'] or callbacks and not stall['callbacks']
+                    ):
+                    stall['stack'] = traceback.format_stack(frame)
+                for callback in callbacks:
+                    if callback not in stall['callbacks']:
+                        stall['callbacks'].append(callback)
+            del frame
+
+    @staticmethod
+    def get_callbacks(frame):
+        '''
+        Returns the plugin callback the main loop called into, that is the 
+        outermost plugin frame on the stack, or an empty list if the stack 
+        holds no plugin code.
+        '''
+        filenames = get_plugin_files()
+        callbacks = []
+        while frame is not None:
+            code = frame.f_code
+            if code.co_filename in filenames:
+                callbacks = [getattr(code, 'co_qualname', code.co_name)]
+            frame = frame.f_back
+        return callbacks
+
+    def dump(self):
+        '''
+        Returns a copy of the recorded stalls, oldest first.
+        '''
+        with self.lock:
+            return [dict(event) for event in self.events]
+
+    def stop(self):
+        '''
+        Stops the heartbeat and the sampling thread.
+        '''
+        self.running = False
+        GLib.source_remove(self.source_id)
+        self.thread.join(1.0)
+
+
+class Metrics(object):
+    '''
+    Counters kept by the plugin, written with gauges in the Prometheus 
+    text format for node_exporter's textfile collector. Counting is a 
+    dictionary update, and the file is written atomically on a timer.
+    '''
+    prefix = 'rating_filters_'
+    descriptions = {
+        'filter_builds_total': 
+            ('counter', 'Filtered query models built, by filter, not '
+                        'counting the unfiltered All Ratings model.'),
+        'cache_hits_total': 
+            ('counter', 'Lookups that found a page or model already built.'),
+        'cache_misses_total': 
+            ('counter', 'Lookups that had to build a page or model.'),
+        'entries_scanned_total': 
+            ('counter', 'Entries walked while building filters, rating '
+                        'caches and group and play history indexes.'),
+        'entry_changes_received_total': 
+            ('counter', 'Entry changed signals received.'),
+        'entry_changes_acted_on_total': 
+            ('counter', 'Entry changes that moved an entry between filters.'),
+        'visited_pages': ('gauge', 'Pages with cached query models.'),
+        'page_entries': ('gauge', 'Entries in the page before filtering.'),
+        'page_models': ('gauge', 'Query models cached for the page.'),
+        'page_model_rows': 
+            ('gauge', 'Rows in all query models cached for the page.'),
+        'page_memory_bytes': 
+            ('gauge', 'Estimated memory held by the page\'s cached models.'),
+        'metrics_write_seconds': 
+            ('gauge', 'Time taken to collect and write the previous metrics.')
+        }
+    # Rough cost of a row in a RhythmDBQueryModel: a GSequence node and a 
+    # hash table slot.
+    row_size = 80
+
+    def __init__(self):
+        self.counters = collections.defaultdict(int)
+        self.duration = 0.0
+
+    def inc(self, name, labels=(), value=1):
+        self.counters[name, labels] += value
+
+    def set_duration(self, duration):
+        self.duration = duration
+
+    def render(self, gauges):
+        '''
+        Returns the counters and gauges in the Prometheus text format.
+        '''
+        samples = collections.defaultdict(list)
+        for (name, labels), value in self.counters.items():
+            samples[name].append((labels, value))
+        for name, labels, value in gauges:
+            samples[name].append((labels, value))
+        samples['metrics_write_seconds'].append(((), self.duration))
+        lines = []
+        for name in sorted(samples):
+            metric_type, description = self.descriptions[name]
+            lines.append('# HELP %s%s %s' % (self.prefix, name, description))
+            lines.append('# TYPE %s%s %s' % (self.prefix, name, metric_type))
+            for labels, value in sorted(samples[name]):
+                label_text = ''
+                if labels:
+                    label_text = '{%s}' % ','.join(
+                        '%s="%s"' % (key, self.escape(label)) 
+                        for key, label in labels
+                        )
+                lines.append('%s%s%s %s' % (
+                    self.prefix, name, label_text, repr(value)
+                    ))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def escape(label):
+        return (label.replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n'))
+
+    def write(self, path, gauges):
+        '''
+        Writes the metrics to a temporary file next to the path and renames 
+        it into place, so the collector never reads a partial file.
+        '''
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as metrics_file:
+            metrics_file.write(self.render(gauges))
+        os.rename(temp_path, path)
+
+
+class Profiler(object):
+    '''
+    Profiles the main thread with cProfile and traces allocations with 
+    tracemalloc from when it is created until it is stopped. Nothing is 
+    installed on any callback, so the plugin runs at full speed when it 
+    isn't profiling.
+    '''
+    frames = 10
+    top = 30
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.tracing = not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start(self.frames)
+        self.profile.enable()
+
+    def stop(self, stats_path, report_path):
+        '''
+        Stops profiling, saving the pstats to one file and writing a report 
+        of the slowest calls and the plugin's top allocations to another.
+        '''
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        if self.tracing:
+            tracemalloc.stop()
+        self.profile.dump_stats(stats_path)
+
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(True, filename) 
+            for filename in get_plugin_files()
+            ])
+        allocations = snapshot.statistics('lineno')
+        with open(report_path, 'w') as report_file:
+            report_file.write('Slowest calls by cumulative time\n\n')
+            stats = pstats.Stats(self.profile, stream=report_file)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            report_file.write(
+                'Top allocations by the plugin still held (%.1f KiB in '
+                '%d blocks)\n\n' % (
+                    sum(stat.size for stat in allocations) / 1024.0,
+                    sum(stat.count for stat in allocations)
+                    )
+                )
+            for stat in allocations[:self.top]:
+                report_file.write(str(stat) + '\n')
+
+
+class TraceRecorder(object):
+    '''
+    Writes a compact, anonymous trace of the signals the plugin receives, 
+    for bench/replay.py to play back. Each line is a JSON array holding the 
+    event type and the time in milliseconds since recording started. Tracks 
+    and pages are identified by number only: the first line lists the 
+    library's entry IDs and ratings, and a page's entry IDs are written the 
+    first time it appears. Settings holding local paths aren't recorded.
+
+    The trace is flushed every second, so a trace cut short by a crash still 
+    holds everything up to the second before it.
+    '''
+    version = 1
+    unrecorded_keys = ['metrics-file', 'trace-recording']
+    flush_interval = 1
+
+    def __init__(self, path, shell, settings):
+        self.path = path
+        self.settings = settings
+        self.page_ids = {}
+        self.start = time.monotonic()
+        self.trace_file = open(path, 'w')
+        library = shell.props.library_source.props.base_query_model
+        self.write('trace', self.version, dict(
+            (key, self.settings[key]) for key in self.settings.list_keys() 
+            if key not in self.unrecorded_keys
+            ), [self.get_entry(entry) for entry in get_entries(library)])
+        self.select(shell.props.selected_page)
+        self.handler_id = self.settings.connect(
+            'changed', self.on_setting_changed
+            )
+        self.flush_source_id = GLib.timeout_add_seconds(
+            self.flush_interval, self.flush
+            )
+
+    def write(self, event, *args):
+        '''
+        Writes an event to the trace.
+        '''
+        t = int(1000 * (time.monotonic() - self.start))
+        self.trace_file.write(
+            json.dumps([event, t] + list(args), separators=(',', ':')) + '\n'
+            )
+
+    def get_entry(self, entry):
+        return [
+            entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID),
+            entry.get_double(RB.RhythmDBPropType.RATING)
+            ]
+
+    def get_page_id(self, page):
+        '''
+        Returns the number of a page, writing its kind and the entries it 
+        shows the first time it is seen.
+        '''
+        if page not in self.page_ids:
+            self.page_ids[page] = len(self.page_ids) + 1
+            kind = 'other'
+            for page_type, name in [
+                (RB.LibrarySource, 'library'), 
+                (RB.StaticPlaylistSource, 'static'),
+                (RB.AutoPlaylistSource, 'auto')
+                ]:
+                if isinstance(page, page_type):
+                    kind = name
+                    break
+            self.write(
+                'page', self.page_ids[page], kind, self.get_entry_ids(page)
+                )
+        return self.page_ids[page]
+
+    def get_entry_ids(self, page):
+        return [
+            entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID) 
+            for entry in get_entries(page.get_entry_view().props.model)
+            ]
+
+    def select(self, page):
+        self.write('select', self.get_page_id(page))
+
+    def browse(self, page):
+        self.write('browse', self.get_page_id(page), self.get_entry_ids(page))
+
+    def filter(self, filter_name):
+        self.write('filter', filter_name)
+
+    def entry_changed(self, entry):
+        self.write('entry', *self.get_entry(entry))
+
+    def entry_deleted(self, entry):
+        self.write('delete', entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID))
+
+    def on_setting_changed(self, settings, key):
+        if key not in self.unrecorded_keys:
+            self.write('setting', key, self.settings[key])
+
+    def flush(self):
+        self.trace_file.flush()
+        return True
+
+    def stop(self):
+        '''
+        Stops recording and closes the trace.
+        '''
+        GLib.source_remove(self.flush_source_id)
+        self.settings.disconnect(self.handler_id)
+        self.trace_file.close()
+
+
+class RatingShufflePlayOrder(RB.PlayOrder):
+    '''
+    Play order that shuffles the playing source, drawing tracks with 
+    probability weighted by rating. Weights are indexed by rating bucket; 
+    unrated tracks are weighted like three star tracks.
+    '''
+    __gtype_name__ = 'RatingFiltersShufflePlayOrder'
+
+    name = 'rating-filters-shuffle'
+    description = 'Shuffle by rating'
+    weights = [6, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    favourites_only = False
+    history_length = 100
+
+    def __init__(self, **kwargs):
+        RB.PlayOrder.__init__(self, **kwargs)
+        self.sampler = WeightedSampler()
+        self.history = []
+        self.next_entry_id = None
+        self.going_back = False
+        self.db = None
+        self.db_handler_id = None
+        self.settings = Gio.Settings(
+            'org.gnome.rhythmbox.plugins.rating_filters'
+            )
+        self.settings_handler_id = None
+
+    def get_entry_weight(self, entry):
+        '''
+        Returns the sampling weight of an entry.
+        '''
+        bucket = get_rating_bucket(
+            entry.get_double(RB.RhythmDBPropType.RATING)
+            )
+        if (self.favourites_only and 
+            bucket < 2 * self.settings['favourites-threshold']):
+            return 0
+        return self.weights[bucket]
+
+    def rebuild(self):
+        '''
+        Reloads the weights of every entry in the playing query model.
+        '''
+        query_model = self.get_query_model()
+        items = []
+        if query_model is not None:
+            for entry in get_entries(query_model):
+                items.append((
+                    entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID),
+                    self.get_entry_weight(entry)
+                    ))
+        self.sampler.rebuild(items)
+        self.next_entry_id = None
+
+    def connect_handlers(self, db):
+        '''
+        Starts following rating changes in the database and changes to the 
+        favourites threshold.
+        '''
+        self.db = db
+        self.db_handler_id = db.connect('entry-changed', self.on_entry_changed)
+        self.settings_handler_id = self.settings.connect(
+            'changed::favourites-threshold', 
+            self.on_favourites_threshold_changed
+            )
+
+    def disconnect_handlers(self):
+        '''
+        Stops following the database and the settings.
+        '''
+        if self.db is not None:
+            self.db.disconnect(self.db_handler_id)
+            self.db = None
+            self.db_handler_id = None
+        if self.settings_handler_id is not None:
+            self.settings.disconnect(self.settings_handler_id)
+            self.settings_handler_id = None
+
+    def do_query_model_changed(self):
+        self.disconnect_handlers()
+        self.connect_handlers(self.get_db())
+        self.rebuild()
+
+    def do_db_changed(self, db):
+        self.disconnect_handlers()
+        if db is not None and self.get_query_model() is not None:
+            self.connect_handlers(db)
+
+    def do_dispose(self):
+        self.disconnect_handlers()
+        RB.PlayOrder.do_dispose(self)
+
+    def do_entry_added(self, entry):
+        self.sampler.set_weight(
+            entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID),
+            self.get_entry_weight(entry)
+            )
+
+    def do_entry_removed(self, entry):
+        self.sampler.remove(entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID))
+
+    def on_entry_changed(self, db, entry, changes):
+        '''
+        Reweights an entry in the playing source when it changes.
+        '''
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        if entry_id in self.sampler:
+            self.sampler.set_weight(entry_id, self.get_entry_weight(entry))
+
+    def on_favourites_threshold_changed(self, settings, key):
+        '''
+        Reweights all entries when the favourites threshold changes.
+        '''
+        if self.favourites_only:
+            self.rebuild()
+
+    def do_get_next(self):
+        if (self.next_entry_id is None or 
+            not self.sampler.get_weight(self.next_entry_id)):
+            playing_entry = self.get_playing_entry()
+            entry_id = self.sampler.sample()
+            if playing_entry is not None and len(self.sampler) > 1:
+                playing_id = playing_entry.get_ulong(
+                    RB.RhythmDBPropType.ENTRY_ID
+                    )
+                for _ in range(3):
+                    if entry_id != playing_id:
+                        break
+                    entry_id = self.sampler.sample()
+            self.next_entry_id = entry_id
+        if self.next_entry_id is None:
+            return None
+        return self.get_db().entry_lookup_by_id(self.next_entry_id)
+
+    def do_go_next(self):
+        entry = self.do_get_next()
+        self.next_entry_id = None
+        if entry is not None:
+            self.set_playing_entry(entry)
+
+    def do_get_previous(self):
+        if len(self.history) < 2:
+            return None
+        return self.get_db().entry_lookup_by_id(self.history[-2])
+
+    def do_go_previous(self):
+        entry = self.do_get_previous()
+        if entry is not None:
+            self.history.pop()
+            self.going_back = True
+            self.set_playing_entry(entry)
+            self.going_back = False
+
+    def do_playing_entry_changed(self, old_entry, new_entry):
+        if new_entry is not None and not self.going_back:
+            self.history.append(
+                new_entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+                )
+            del self.history[:-self.history_length]
+
+
+class FavouritesShufflePlayOrder(RatingShufflePlayOrder):
+    '''
+    Play order that shuffles only the favourites in the playing source, 
+    weighted by rating.
+    '''
+    __gtype_name__ = 'RatingFiltersFavouritesShufflePlayOrder'
+
+    name = 'rating-filters-favourites-shuffle'
+    description = 'Shuffle favourites by rating'
+    favourites_only = True
+
+
 class Preferences(GObject.Object, PeasGtk.Configurable):
     '''
     Preferences for the RatingFilters plugin. It holds the settings for the 
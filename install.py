@@ -32,7 +32,8 @@ plugin_files_path = {
     'dev': './dev'
 }
 common_files = [
-    'README', 'LICENSE', './common/RatingFiltersPreferences.ui'
+    'README', 'LICENSE', './common/RatingFiltersPreferences.ui',
+    './common/RatingFiltersCore.py', './common/RatingFiltersPages.py'
 ]
 glib_schema = './common/org.gnome.rhythmbox.plugins.rating_filters.gschema.xml'
 
@@ -0,0 +1,441 @@
+#!/usr/bin/python3
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#    rbfilter.py
+#
+#    Offline rating filters and statistics for a Rhythmbox library.
+#    Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Applies the plugin's filters to a Rhythmbox library without running
+Rhythmbox, and writes the tracks that pass as an M3U playlist, as CSV or as
+both, along with a histogram of the library's ratings:
+
+    python3 rbfilter.py --filter Favourites --m3u favourites.m3u --stats
+
+rhythmdb.xml is streamed with an incremental parser that discards each
+entry once it has been read, so memory use doesn't grow with the size of
+the library. Top Tracks and Discover only keep the tracks they will show,
+and Favourite Albums and Favourite Artists read the library twice, keeping
+a rating histogram per album or artist in between. Settings such as
+favourites-threshold are read with gsettings, falling back to the schema
+defaults, and can be overridden on the command line.
+"""
+from argparse import ArgumentParser
+from collections import namedtuple
+import ast
+import csv
+import heapq
+import os
+from subprocess import Popen, PIPE
+import sys
+import time
+try:
+    from urllib.parse import unquote, urlparse
+except ImportError:
+    from urllib import unquote
+    from urlparse import urlparse
+import xml.etree.ElementTree as ET
+
+COMMON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'common')
+sys.path.insert(0, COMMON_PATH)
+from RatingFiltersCore import (compile_rating_range, get_rating_bucket,
+                               GroupRatings, RATING_BUCKETS, Reservoir)
+
+SCHEMA_ID = 'org.gnome.rhythmbox.plugins.rating_filters'
+SCHEMA_PATH = os.path.join(COMMON_PATH, SCHEMA_ID + '.gschema.xml')
+RHYTHMDB_PATH = '~/.local/share/rhythmbox/rhythmdb.xml'
+
+FILTER_NAMES = [
+    'All Ratings', 'Favourites', 'Unrated', 'Top Tracks', 'Discover',
+    'Favourite Albums', 'Favourite Artists', 'Forgotten Favourites',
+    'Overplayed Unrated'
+    ]
+
+Track = namedtuple('Track', [
+    'location', 'title', 'artist', 'album', 'album_artist', 'duration',
+    'rating', 'play_count', 'last_played'
+    ])
+TRACK_FIELDS = [
+    'location', 'title', 'artist', 'album', 'album-artist', 'duration',
+    'rating', 'play-count', 'last-played'
+    ]
+CSV_HEADER = [
+    'location', 'title', 'artist', 'album', 'album artist', 'duration',
+    'rating', 'play count', 'last played'
+    ]
+
+
+def get_settings(schema_path=SCHEMA_PATH):
+    """
+    Returns the plugin settings: the user's, read with gsettings, or the
+    schema defaults where gsettings or the installed schema isn't
+    available.
+    """
+    settings = {}
+    for key in ET.parse(schema_path).iter('key'):
+        settings[key.get('name')] = parse_gvariant(key.findtext('default'))
+    try:
+        process = Popen(['gsettings', 'list-recursively', SCHEMA_ID],
+                        stdout=PIPE, stderr=PIPE)
+        output = process.communicate()[0].decode('utf-8')
+    except OSError:
+        return settings
+    if process.returncode != 0:
+        return settings
+    for line in output.splitlines():
+        fields = line.split(' ', 2)
+        if len(fields) == 3 and fields[1] in settings:
+            settings[fields[1]] = parse_gvariant(fields[2])
+    return settings
+
+
+def parse_gvariant(text):
+    """
+    Parses the text form of the GVariant values used by the plugin's
+    settings (integers, booleans, strings and arrays of tuples).
+    """
+    text = text.strip()
+    if text.startswith('@'):
+        text = text.split(' ', 1)[1]
+    if text in ('true', 'false'):
+        return text == 'true'
+    return ast.literal_eval(text)
+
+
+def get_entries(path):
+    """
+    Yields the type and fields of each entry in a rhythmdb.xml file. Each
+    entry is cleared from the tree once it has been read.
+    """
+    root = None
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if root is None:
+            root = elem
+        if event != 'end' or elem.tag != 'entry':
+            continue
+        # Read every field in one pass over the entry's children.
+        yield elem.get('type'), dict((child.tag, child.text) for child in elem)
+        elem.clear()
+        root.clear()
+
+
+def make_track(fields):
+    """
+    Returns a Track for an entry's fields.
+    """
+    get = fields.get
+    return Track(
+        get('location') or '', get('title') or '', get('artist') or '',
+        get('album') or '', get('album-artist') or '',
+        int(get('duration') or 0), float(get('rating') or 0),
+        int(get('play-count') or 0), int(get('last-played') or 0)
+        )
+
+
+def get_tracks(path, types=('song',)):
+    """
+    Yields a Track for each entry of the given types in a rhythmdb.xml
+    file.
+    """
+    for entry_type, fields in get_entries(path):
+        if entry_type in types:
+            yield make_track(fields)
+
+
+def get_album_key(track):
+    """
+    Returns the album a track belongs to, as the plugin does.
+    """
+    return (track.album_artist or track.artist, track.album)
+
+
+def get_artist_key(track):
+    """
+    Returns the artist a track belongs to.
+    """
+    return track.artist
+
+
+class LibraryFilter():
+
+    """
+    Applies one of the plugin's filters to the tracks in a rhythmdb.xml
+    file, counting the rating of every track read along the way.
+    """
+
+    group_filters = {
+        'Favourite Albums': get_album_key,
+        'Favourite Artists': get_artist_key
+        }
+
+    def __init__(self, path, filter_name, settings, types=('song',)):
+        """
+        Compiles the filter from the settings. Raises ValueError if there
+        is no filter with that name.
+        """
+        self.path = path
+        self.filter_name = filter_name
+        self.settings = settings
+        self.types = types
+        self.histogram = [0] * RATING_BUCKETS
+        self.rating_tables = {
+            'All Ratings': (True,) * RATING_BUCKETS,
+            'Unrated': compile_rating_range(0.0, 0.0),
+            'Favourites': compile_rating_range(
+                settings['favourites-threshold'], 5.0
+                )
+            }
+        for name, minimum, maximum in settings['filter-profiles']:
+            if name not in FILTER_NAMES and name not in self.rating_tables:
+                self.rating_tables[name] = compile_rating_range(
+                    minimum, maximum
+                    )
+        if (filter_name not in FILTER_NAMES and
+            filter_name not in self.rating_tables):
+            raise ValueError('No filter named ' + filter_name)
+
+    def get_filter_names(self):
+        """
+        Returns the names of the built in filters and filter profiles.
+        """
+        return FILTER_NAMES + sorted(
+            name for name in self.rating_tables if name not in FILTER_NAMES
+            )
+
+    def read(self):
+        """
+        Yields every track in the library, counting its rating.
+        """
+        histogram = [0] * RATING_BUCKETS
+        self.histogram = histogram
+        for track in get_tracks(self.path, self.types):
+            histogram[get_rating_bucket(track.rating)] += 1
+            yield track
+
+    def select(self, table, tracks):
+        """
+        Yields the tracks whose rating bucket is set in a table.
+        """
+        for track in tracks:
+            if table[get_rating_bucket(track.rating)]:
+                yield track
+
+    def __iter__(self):
+        """
+        Yields the tracks that pass the filter. Top Tracks are yielded best
+        first; other filters keep library order.
+        """
+        filter_name = self.filter_name
+        if filter_name in self.rating_tables:
+            return self.select(self.rating_tables[filter_name], self.read())
+        elif filter_name == 'Top Tracks':
+            return iter(heapq.nlargest(
+                self.settings['top-tracks-size'], self.read(),
+                key=lambda track: (
+                    track.rating, track.play_count, track.last_played
+                    )
+                ))
+        elif filter_name == 'Discover':
+            reservoir = Reservoir(self.settings['discover-size'], reserve=0)
+            reservoir.build(self.select(self.rating_tables['Unrated'],
+                                        self.read()))
+            return iter(reservoir.sample)
+        elif filter_name in self.group_filters:
+            return self.select_groups(self.group_filters[filter_name])
+        elif filter_name == 'Forgotten Favourites':
+            played_before = (int(time.time()) -
+                             self.settings['forgotten-days'] * 24 * 60 * 60)
+            return (
+                track for track in self.select(
+                    self.rating_tables['Favourites'], self.read()
+                    )
+                if track.last_played < played_before
+                )
+        else:
+            overplayed_count = self.settings['overplayed-count']
+            return (
+                track for track in self.select(
+                    self.rating_tables['Unrated'], self.read()
+                    )
+                if track.play_count > overplayed_count
+                )
+
+    def select_groups(self, get_group):
+        """
+        Yields the tracks in albums or artists that meet the favourites
+        threshold. The first pass over the library only fills in the rating
+        histogram of each group, which is all GroupRatings needs to read a
+        group's average and minimum, so tracks aren't kept as members.
+        """
+        group_ratings = GroupRatings()
+        histograms = group_ratings.histograms
+        for track in get_tracks(self.path, self.types):
+            group = get_group(track)
+            if group not in histograms:
+                histograms[group] = [0] * RATING_BUCKETS
+            histograms[group][get_rating_bucket(track.rating)] += 1
+        threshold = self.settings['favourites-threshold']
+        mode = self.settings['favourite-groups-mode']
+        qualified = set(
+            group for group in histograms
+            if group_ratings.qualifies(group, threshold, mode)
+            )
+        histograms.clear()
+        for track in self.read():
+            if get_group(track) in qualified:
+                yield track
+
+
+def get_path(location):
+    """
+    Returns the local path of a file URI, or the location unchanged if it
+    isn't one.
+    """
+    uri = urlparse(location)
+    if uri.scheme != 'file':
+        return location
+    return unquote(uri.path)
+
+
+def write_tracks(tracks, m3u=None, csv_output=None, paths=False):
+    """
+    Writes tracks as an extended M3U playlist, as CSV with a header row,
+    or both, in a single pass. Returns the number of tracks written.
+    """
+    if m3u is not None:
+        m3u.write('#EXTM3U\n')
+    if csv_output is not None:
+        writer = csv.writer(csv_output)
+        writer.writerow(CSV_HEADER)
+    count = 0
+    for track in tracks:
+        if m3u is not None:
+            title = track.title
+            if track.artist:
+                title = track.artist + ' - ' + title
+            location = get_path(track.location) if paths else track.location
+            m3u.write('#EXTINF:%d,%s\n%s\n' % (
+                track.duration, title, location
+                ))
+        if csv_output is not None:
+            writer.writerow(track)
+        count += 1
+    return count
+
+
+def print_histogram(histogram, output):
+    """
+    Prints the number and share of tracks with each rating, in half star
+    steps.
+    """
+    total = sum(histogram)
+    output.write('%-10s%10s%9s\n' % ('Rating', 'Tracks', ''))
+    for bucket in range(RATING_BUCKETS):
+        label = 'Unrated' if bucket == 0 else '%.1f' % (bucket / 2.0)
+        share = 100.0 * histogram[bucket] / total if total else 0
+        output.write('%-10s%10d%8.1f%%\n' % (label, histogram[bucket], share))
+    output.write('%-10s%10d\n' % ('Total', total))
+
+
+def open_output(path):
+    """
+    Opens an output file for writing, or returns stdout for '-'.
+    """
+    if path == '-':
+        return sys.stdout
+    return open(path, 'w', newline='', encoding='utf-8')
+
+
+def main():
+    settings = get_settings()
+    parser = ArgumentParser(
+        description='Filters a Rhythmbox library by rating as the ' \
+                    'RatingFilters plugin does, without running Rhythmbox.')
+    parser.add_argument(
+        '-f', '--filter', default='Favourites',
+        help = 'filter to apply (default: Favourites)')
+    parser.add_argument(
+        '-d', '--db', default=RHYTHMDB_PATH,
+        help = 'rhythmdb.xml file to read (default: %(default)s)')
+    parser.add_argument(
+        '--m3u', help = 'write the filtered tracks to an M3U file, or - for ' \
+                        'stdout')
+    parser.add_argument(
+        '--csv', help = 'write the filtered tracks to a CSV file, or - for ' \
+                        'stdout')
+    parser.add_argument(
+        '--paths', action='store_true',
+        help = 'write local paths rather than file URIs to the M3U file')
+    parser.add_argument(
+        '-s', '--stats', action='store_true',
+        help = 'print a histogram of the library\'s ratings')
+    parser.add_argument(
+        '-t', '--threshold', type=float,
+        help = 'favourites threshold in stars (default: %d, from ' \
+               'favourites-threshold)' % settings['favourites-threshold'])
+    parser.add_argument(
+        '--type', action='append',
+        help = 'entry type to read, e.g. podcast-post (default: song)')
+    parser.add_argument(
+        '-l', '--list', action='store_true',
+        help = 'list the available filters')
+    args = parser.parse_args()
+
+    if args.threshold is not None:
+        settings['favourites-threshold'] = args.threshold
+    path = os.path.expanduser(args.db)
+    try:
+        library_filter = LibraryFilter(
+            path, args.filter, settings, tuple(args.type or ['song'])
+            )
+    except ValueError as e:
+        parser.error(str(e))
+    if args.list:
+        print('\n'.join(library_filter.get_filter_names()))
+        return
+    if not (args.m3u or args.csv):
+        args.stats = True
+    if args.m3u == '-' and args.csv == '-':
+        parser.error('only one of --m3u and --csv can be written to stdout')
+    if not os.path.exists(path):
+        parser.error(path + ' does not exist')
+
+    count = None
+    if args.m3u or args.csv:
+        outputs = [open_output(args.m3u) if args.m3u else None,
+                   open_output(args.csv) if args.csv else None]
+        try:
+            count = write_tracks(library_filter, outputs[0], outputs[1],
+                                 args.paths)
+        finally:
+            for output in outputs:
+                if output not in (None, sys.stdout):
+                    output.close()
+    else:
+        for _ in library_filter.read():
+            pass
+
+    # Keep stdout for the playlist if it is being written there.
+    report = sys.stderr if '-' in (args.m3u, args.csv) else sys.stdout
+    if args.stats:
+        print_histogram(library_filter.histogram, report)
+    if count is not None:
+        report.write('%d tracks passed the %s filter\n' % (count, args.filter))
+
+if __name__ == "__main__":
+    main()
@@ -20,11 +20,23 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+import copy
+import ctypes
+import ctypes.util
+import hashlib
+import glob
+import json
 import logging
 import os
+import re
+import runpy
+import select
 import shutil
-from subprocess import call
-from gi.repository import RB
+import struct
+from subprocess import call, Popen, PIPE
+import sys
+import time
 
 class RBPluginInstaller():
     
@@ -34,12 +46,68 @@ class RBPluginInstaller():
     
     PLUGINS_PATH = '~/.local/share/rhythmbox/plugins/'
     GLIB_PATH = '/usr/share/glib-2.0/schemas/'
+    USER_GLIB_PATH = '~/.local/share/glib-2.0/schemas/'
+    MANIFEST_FILE = '.rbpi-manifest'
+    VERSION_CACHE = '~/.cache/rbpi/rhythmbox-versions.json'
+    TYPELIB_PATHS = ['/usr/lib/girepository-1.0', 
+                     '/usr/lib/*/girepository-1.0', 
+                     '/usr/lib64/girepository-1.0', 
+                     '/usr/local/lib/girepository-1.0', 
+                     '/usr/local/lib/*/girepository-1.0']
+    PEAS_LOADER_PATHS = ['/usr/lib/libpeas-1.0/loaders', 
+                         '/usr/lib/*/libpeas-1.0/loaders', 
+                         '/usr/lib64/libpeas-1.0/loaders', 
+                         '/usr/local/lib/libpeas-1.0/loaders', 
+                         '/usr/local/lib/*/libpeas-1.0/loaders']
+    
+    # The libpeas loader library for each Loader in a .plugin file, and the 
+    # interpreter to use when the library can't be found.
+    PEAS_LOADERS = {'python3': ('libpython3loader.so', 'python3'), 
+                    'python': ('libpythonloader.so', 'python2')}
+    
+    # Newest first: the first class member or RB name that exists gives the 
+    # version.
+    VERSION_PROBES = [('3.0.1', 'DeviceSource', 'default_eject'), 
+                      ('3.0', None, 'ListModel'), 
+                      ('2.99', None, 'Application'), 
+                      ('2.98', 'RhythmDBImportJob', 'get_processed'), 
+                      ('2.97', None, 'RhythmDBQueryResultList'), 
+                      ('2.96', None, 'ChunkLoader'), 
+                      ('2.95', None, 'Player')] # untested
+    
+    # Run by the plugin's interpreter to check that it will load the 
+    # bytecode for each source file given, rather than compile the source.
+    VERIFY_BYTECODE = '''
+import os, struct, sys
+try:
+    from importlib.util import cache_from_source, MAGIC_NUMBER
+except ImportError:
+    import imp
+    MAGIC_NUMBER = imp.get_magic()
+    cache_from_source = lambda path: path + 'c'
+offset = 8 if sys.version_info >= (3, 7) else 4
+unused = 0
+for path in sys.argv[1:]:
+    try:
+        with open(cache_from_source(path), 'rb') as f:
+            header = f.read(offset + 4)
+    except IOError:
+        header = b''
+    mtime = struct.pack('<I', int(os.stat(path).st_mtime) & 0xFFFFFFFF)
+    hashed = offset == 8 and header[4:8] != b'\\0\\0\\0\\0'
+    if header[:4] != MAGIC_NUMBER or not (hashed or 
+                                          header[offset:] == mtime):
+        sys.stderr.write('Bytecode will not be used for %s\\n' % path)
+        unused += 1
+sys.exit(1 if unused else 0)
+'''
     
     def __init__(self, plugin_name, plugin_files_path, common_files=[], 
                  install_folder=None, glib_schema=None, cleanup_files=[], 
-                 old_install_folders=[]):
+                 old_install_folders=[], parse_args=True):
         """
-        Parse command line options and set paths.
+        Parse command line options and set paths. With parse_args=False, 
+        only set paths, so that a batch install can drive the installer.
         """
         logging.basicConfig(level=logging.DEBUG, 
                             format='%(asctime)s %(levelname)-8s %(message)s', 
@@ -50,8 +118,12 @@ class RBPluginInstaller():
         self.common_files = common_files
         self.install_folder = install_folder if install_folder else plugin_name
         self.glib_schema = glib_schema
-        self.cleanup_files = cleanup_files
-        self.old_install_folders = old_install_folders
+        self.cleanup_files = list(cleanup_files)
+        self.old_install_folders = list(old_install_folders)
+        self.incremental = True
+        
+        if not parse_args:
+            return
         
         parser = ArgumentParser(
             description='Installs the ' + plugin_name + \
@@ -68,7 +140,20 @@ class RBPluginInstaller():
         parser.add_argument(
             '-v', '--version', 
             help = 'force the installation of a specific plugin version')
+        parser.add_argument(
+            '-i', '--incremental', action='store_true', 
+            help = 'copy only changed files and install the settings ' \
+                   'schema for this user, without sudo')
+        parser.add_argument(
+            '-w', '--watch', action='store_true', 
+            help = 'install the plugin as symlinks and run Rhythmbox in ' \
+                   'debug mode, restarting it when the plugin changes')
         args = parser.parse_args()
+        self.incremental = args.incremental
+        
+        if args.watch:
+            self.watch(args.version or self.guess_rb_version())
+            return
         
         if args.uninstall:
             self.uninstall()
@@ -114,6 +199,10 @@ class RBPluginInstaller():
         """
         Install the specified version of the plugin.
         """
+        if self.incremental:
+            self.incremental_install(version)
+            return
+
         self.uninstall()
         
         logging.debug('Installing %s for Rhythmbox %s...' % \
@@ -129,6 +218,11 @@ class RBPluginInstaller():
         for f in self.common_files:
             shutil.copy(f, install_path)
         
+        # Compile bytecode, so that Rhythmbox doesn't have to
+        interpreter = self.get_plugin_interpreter(install_path)
+        if interpreter:
+            self.compile_bytecode(install_path, interpreter)
+        
         # Install GLib scehema, if appropriate
         if self.glib_schema:
             logging.info('Need sudo permissions to install ' \
@@ -138,27 +232,577 @@ class RBPluginInstaller():
         
         self.cleanup()
     
+    def incremental_install(self, version, compile_schema=True):
+        """
+        Install the specified version of the plugin, copying only the files 
+        that have changed since the last incremental install. The settings 
+        schema is installed for this user only, and recompiled only when it 
+        changes, so no sudo permissions are needed. Return True if the 
+        schema was copied and needs compiling; if compile_schema is False, 
+        compiling it is left to the caller.
+        """
+        if version not in self.plugin_files_path:
+            raise ValueError('no plugin files for Rhythmbox %s' % version)
+        if not os.path.isdir(self.plugin_files_path[version]):
+            raise ValueError('plugin files path %s is not valid' % \
+                             self.plugin_files_path[version])
+        
+        logging.debug('Installing %s for Rhythmbox %s incrementally...' % \
+                      (self.plugin_name, version))
+        
+        for folder in self.old_install_folders:
+            if folder != self.install_folder:
+                path = os.path.expanduser(os.path.join(self.PLUGINS_PATH, 
+                                                       folder))
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+        
+        install_path = os.path.expanduser(os.path.join(self.PLUGINS_PATH,
+                                                       self.install_folder))
+        manifest = self.load_manifest(install_path)
+        old_records = manifest.get('files', {})
+        records = {}
+        copied = 0
+        
+        # Install plugin and common files that have changed
+        for name, source in sorted(self.get_source_files(version).items()):
+            old_record = old_records.get(name)
+            record = self.get_file_record(source, old_record)
+            path = os.path.join(install_path, name)
+            if (old_record is None or old_record['sha1'] != record['sha1'] 
+                or not os.path.exists(path) or os.path.islink(path)):
+                if os.path.islink(path):
+                    os.remove(path) # left behind by --watch
+                if not os.path.isdir(os.path.dirname(path)):
+                    self.make_folder(os.path.dirname(path))
+                shutil.copy2(source, path)
+                copied += 1
+            records[name] = record
+        
+        # Remove files that are no longer part of the plugin, and any 
+        # Python 2 bytecode for them, which would still be importable
+        for name in set(old_records) - set(records):
+            path = os.path.join(install_path, name)
+            for path in [path, path + 'c']:
+                if os.path.isfile(path):
+                    os.remove(path)
+        
+        # Compile bytecode for files that have changed
+        interpreter = self.get_plugin_interpreter(install_path)
+        bytecode = manifest.get('bytecode')
+        if interpreter and (copied or bytecode != interpreter):
+            bytecode = None
+            if self.compile_bytecode(install_path, interpreter):
+                bytecode = interpreter
+        
+        # Install GLib schema, if it has changed
+        schema_sha1 = None
+        schema_copied = False
+        if self.glib_schema:
+            schema_sha1, schema_copied = self.copy_user_schema(
+                manifest.get('schema'))
+            if (schema_copied and compile_schema and 
+                not self.compile_user_schemas()):
+                schema_sha1 = None
+        
+        self.save_manifest(install_path, {
+            'version': version, 'files': records, 'schema': schema_sha1, 
+            'bytecode': bytecode
+        })
+        logging.debug('%d of %d files changed' % (copied, len(records)))
+        
+        self.cleanup()
+        return schema_copied and not compile_schema
+    
+    def get_source_files(self, version):
+        """
+        Return a dict mapping each file to install, relative to the install 
+        folder, to its source path. Bytecode is left out.
+        """
+        source_path = self.plugin_files_path[version]
+        files = {}
+        for root, folders, names in os.walk(source_path):
+            folders[:] = [f for f in folders if f != '__pycache__']
+            for name in names:
+                if not name.endswith(('.pyc', '.pyo')):
+                    path = os.path.join(root, name)
+                    files[os.path.relpath(path, source_path)] = path
+        for f in self.common_files:
+            files[os.path.basename(f)] = f
+        return files
+    
+    @staticmethod
+    def make_folder(path):
+        """
+        Create a folder and any missing parents. Installs running in 
+        parallel may create the same folders, so the folder already 
+        existing isn't an error.
+        """
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    
+    @staticmethod
+    def hash_file(path):
+        """
+        Return the SHA-1 digest of a file's contents.
+        """
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+    
+    def get_file_record(self, path, old_record=None):
+        """
+        Return the manifest record for a source file. The file is only 
+        hashed if its size or modification time differ from the old record.
+        """
+        stat = os.stat(path)
+        if (old_record and old_record.get('source') == path and 
+            old_record.get('size') == stat.st_size and 
+            old_record.get('mtime') == stat.st_mtime):
+            return old_record
+        return {'source': path, 'size': stat.st_size, 
+                'mtime': stat.st_mtime, 'sha1': self.hash_file(path)}
+    
+    def load_manifest(self, install_path):
+        """
+        Return the manifest of the last incremental install, or an empty 
+        one if there isn't a readable manifest.
+        """
+        try:
+            with open(os.path.join(install_path, self.MANIFEST_FILE)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+    
+    def save_manifest(self, install_path, manifest):
+        """
+        Write the manifest atomically, so that an interrupted install never 
+        leaves a manifest that doesn't match the installed files.
+        """
+        path = os.path.join(install_path, self.MANIFEST_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+    
+    def install_user_schema(self, old_sha1=None):
+        """
+        Install the GLib schema in the user's schema directory and compile 
+        it, unless it is unchanged and already compiled. Return the digest 
+        of the installed schema, or None if compiling it failed.
+        """
+        sha1, copied = self.copy_user_schema(old_sha1)
+        if copied and not self.compile_user_schemas():
+            return None
+        return sha1
+    
+    def copy_user_schema(self, old_sha1=None):
+        """
+        Copy the GLib schema to the user's schema directory, unless it is 
+        unchanged and already compiled. Return the digest of the schema and 
+        whether it was copied.
+        """
+        schema_path = os.path.expanduser(self.USER_GLIB_PATH)
+        path = os.path.join(schema_path, os.path.basename(self.glib_schema))
+        sha1 = self.hash_file(self.glib_schema)
+        if (sha1 == old_sha1 and os.path.exists(path) and 
+            os.path.exists(os.path.join(schema_path, 'gschemas.compiled'))):
+            return sha1, False
+        
+        if not os.path.isdir(schema_path):
+            self.make_folder(schema_path)
+        shutil.copy(self.glib_schema, schema_path)
+        return sha1, True
+    
+    def compile_user_schemas(self):
+        """
+        Compile the user's schema directory. Return True on success.
+        """
+        schema_path = os.path.expanduser(self.USER_GLIB_PATH)
+        logging.debug('Compiling the settings schema in ' + schema_path)
+        if call(['glib-compile-schemas', schema_path]) != 0:
+            logging.error('Could not compile the settings schema.')
+            return False
+        return True
+    
+    @classmethod
+    def get_plugin_interpreter(cls, path):
+        """
+        Return the Python interpreter that Rhythmbox will load the plugin 
+        in, or None if it isn't a Python plugin or that interpreter isn't 
+        installed. The Loader line of the plugin's .plugin file names the 
+        libpeas loader, and the interpreter is the one whose libpython the 
+        loader is linked against, which needn't be the python3 or python2 
+        on the PATH. If the loader can't be found, those are used instead.
+        """
+        loader = None
+        for plugin_file in glob.glob(os.path.join(path, '*.plugin')):
+            with open(plugin_file) as f:
+                for line in f:
+                    if line.startswith('Loader='):
+                        loader = line.split('=', 1)[1].strip()
+                        break
+            if loader:
+                break
+        if loader not in cls.PEAS_LOADERS:
+            return None
+        library, fallback = cls.PEAS_LOADERS[loader]
+        for pattern in cls.PEAS_LOADER_PATHS:
+            for folder in glob.glob(pattern):
+                python = cls.get_linked_python(os.path.join(folder, library))
+                if not python:
+                    continue
+                if not cls.find_program(python):
+                    logging.warning('Rhythmbox loads plugins in %s, ' \
+                                    'which is not installed' % python)
+                    return None
+                return python
+        logging.debug('Could not find the %s loader, assuming %s' % \
+                      (loader, fallback))
+        return fallback
+    
+    @staticmethod
+    def get_linked_python(library):
+        """
+        Return the name of the interpreter whose libpython a library is 
+        linked against (e.g. python3.11), or None if it can't be read.
+        """
+        try:
+            with open(library, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        match = re.search(br'\0libpython(\d+\.\d+)[a-z]*\.so', data)
+        if not match:
+            return None
+        return 'python' + match.group(1).decode('ascii')
+    
+    @classmethod
+    def compile_bytecode(cls, path, interpreter):
+        """
+        Compile the plugin's Python files with the interpreter Rhythmbox 
+        will load them in, so that Rhythmbox doesn't compile them each time 
+        it starts when the plugin folder isn't writable. Return True if the 
+        interpreter will use the bytecode.
+        """
+        sources = [os.path.join(root, name) 
+                   for root, _, names in os.walk(path) 
+                   for name in names if name.endswith('.py')]
+        if not sources:
+            return True
+        try:
+            if (call([interpreter, '-m', 'compileall', '-q', path]) != 0 or 
+                call([interpreter, '-c', cls.VERIFY_BYTECODE] + sources) != 0):
+                logging.warning('Rhythmbox will have to compile the ' \
+                                'plugin itself.')
+                return False
+        except OSError as e:
+            logging.warning('Could not compile bytecode with %s (%s)' % \
+                            (interpreter, e))
+            return False
+        logging.debug('Compiled bytecode for %s' % interpreter)
+        return True
+    
+    def link_install(self, version):
+        """
+        Install the specified version of the plugin as symlinks to its 
+        source files, so that edits take effect as soon as Rhythmbox is 
+        restarted. Return the names of the linked files.
+        """
+        self.uninstall()
+        
+        logging.debug('Linking %s for Rhythmbox %s...' % \
+                      (self.plugin_name, version))
+        
+        install_path = os.path.expanduser(os.path.join(self.PLUGINS_PATH,
+                                                       self.install_folder))
+        files = self.get_source_files(version)
+        for name, source in files.items():
+            path = os.path.join(install_path, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                self.make_folder(os.path.dirname(path))
+            os.symlink(os.path.abspath(source), path)
+        return set(files)
+    
+    def watch(self, version):
+        """
+        Link the plugin into place and run Rhythmbox in debug mode, then 
+        restart Rhythmbox whenever a plugin file changes. The settings 
+        schema is only recompiled when the schema itself changes, and the 
+        plugin is only relinked when files are added or removed. Runs until 
+        interrupted.
+        """
+        names = self.link_install(version)
+        if self.glib_schema:
+            self.install_user_schema()
+        watcher = self.get_watcher(version)
+        rhythmbox = self.start_rhythmbox()
+        try:
+            while True:
+                changed = watcher.wait()
+                files = self.get_source_files(version)
+                relink = set(files) != names
+                if relink:
+                    names = self.link_install(version)
+                    watcher.close()
+                    watcher = self.get_watcher(version)
+                sources = set(os.path.abspath(f) for f in files.values())
+                schema_changed = (self.glib_schema and 
+                                  os.path.abspath(self.glib_schema) in changed)
+                if schema_changed:
+                    self.install_user_schema()
+                if relink or schema_changed or changed & sources:
+                    logging.debug('Plugin changed, restarting Rhythmbox...')
+                    self.stop_rhythmbox(rhythmbox)
+                    rhythmbox = self.start_rhythmbox()
+        except KeyboardInterrupt:
+            logging.debug('Stopped watching')
+        finally:
+            watcher.close()
+            self.stop_rhythmbox(rhythmbox)
+    
+    def get_watcher(self, version):
+        """
+        Return a watcher for the folders holding the plugin's source files 
+        and schema, using inotify where it is available and polling 
+        otherwise.
+        """
+        paths = list(self.get_source_files(version).values())
+        if self.glib_schema:
+            paths.append(self.glib_schema)
+        folders = sorted(set(os.path.dirname(os.path.abspath(p)) 
+                             for p in paths))
+        try:
+            return InotifyWatcher(folders)
+        except (OSError, AttributeError) as e:
+            logging.debug('Polling for changes, inotify is unavailable ' \
+                          '(%s)' % e)
+            return PollingWatcher(folders)
+    
+    def start_rhythmbox(self):
+        """
+        Start Rhythmbox in debug mode for the plugin. Return the process, 
+        or None if Rhythmbox couldn't be started.
+        """
+        try:
+            return Popen(['rhythmbox', '-D', self.plugin_name])
+        except OSError as e:
+            logging.error('Could not start Rhythmbox (%s)' % e)
+            return None
+    
+    def stop_rhythmbox(self, process, timeout=5):
+        """
+        Stop a Rhythmbox process, killing it if it doesn't quit in time.
+        """
+        if process is None or process.poll() is not None:
+            return
+        process.terminate()
+        deadline = time.time() + timeout
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    
     def guess_rb_version(self):
         """
-        Return the installed version of Rhythmbox.
-        """
-        if 'default_eject' in dir(RB.DeviceSource):
-            version = '3.0.1'
-        elif 'ListModel' in dir(RB):
-            version = '3.0'
-        elif 'Application' in dir(RB):
-            version = '2.99'
-        elif 'get_processed' in dir(RB.RhythmDBImportJob):
-            version = '2.98'
-        elif 'RhythmDBQueryResultList' in dir(RB):
-            version = '2.97'
-        elif 'ChunkLoader' in dir(RB):
-            version = '2.96'
-        elif 'Player' in dir(RB): # untested
-            version = '2.95'
-        else:
-            version = None
+        Return the installed version of Rhythmbox. The version is read from 
+        the RB typelib or from 'rhythmbox --version', and cached against the 
+        Rhythmbox binary's path and modification time. Importing RB through 
+        GI is slow and fails without a display, so it is only a fallback.
+        """
+        binary = self.find_rhythmbox()
+        mtime = os.stat(binary).st_mtime if binary else None
+        cache = self.load_version_cache()
+        if binary in cache and cache[binary]['mtime'] == mtime:
+            return cache[binary]['version']
+        
+        version = (self.guess_rb_version_from_typelib() or 
+                   self.guess_rb_version_from_binary(binary) or 
+                   self.guess_rb_version_from_gi())
+        
+        if binary and version:
+            cache[binary] = {'mtime': mtime, 'version': version}
+            self.save_version_cache(cache)
         return version
+    
+    def find_rhythmbox(self):
+        """
+        Return the path of the Rhythmbox binary, or None if it isn't on the 
+        PATH.
+        """
+        return self.find_program('rhythmbox')
+    
+    @staticmethod
+    def find_program(name):
+        """
+        Return the real path of a program on the PATH, or None if it isn't 
+        there.
+        """
+        for folder in os.environ.get('PATH', '').split(os.pathsep):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return os.path.realpath(path)
+        return None
+    
+    def load_version_cache(self):
+        """
+        Return the cached Rhythmbox versions, by binary path.
+        """
+        try:
+            with open(os.path.expanduser(self.VERSION_CACHE)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+    
+    def save_version_cache(self, cache):
+        """
+        Save the cached Rhythmbox versions. Failing to do so isn't an error.
+        """
+        path = os.path.expanduser(self.VERSION_CACHE)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                self.make_folder(os.path.dirname(path))
+            with open(path + '.tmp', 'w') as f:
+                json.dump(cache, f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            logging.debug('Could not cache the Rhythmbox version (%s)' % e)
+    
+    def guess_rb_version_from_typelib(self):
+        """
+        Return the installed version of Rhythmbox by looking for the probe 
+        names among the RB typelib's own entries and their methods, without 
+        loading it. Names the typelib only refers to, from other namespaces 
+        or as the members of other classes, don't count.
+        """
+        folders = os.environ.get('GI_TYPELIB_PATH', '').split(os.pathsep)
+        for pattern in self.TYPELIB_PATHS:
+            folders.extend(glob.glob(pattern))
+        for folder in folders:
+            path = os.path.join(folder, 'RB-3.0.typelib')
+            if folder and os.path.isfile(path):
+                names = self.read_typelib_names(path, 'RB')
+                if names is None:
+                    logging.debug('Could not read %s' % path)
+                    continue
+                for version, class_name, name in self.VERSION_PROBES:
+                    if class_name:
+                        found = name in names.get(class_name, ())
+                    else:
+                        found = name in names
+                    if found:
+                        logging.debug('Found Rhythmbox %s in %s' % \
+                                      (version, path))
+                        return version
+        return None
+    
+    @staticmethod
+    def read_typelib_names(path, namespace):
+        """
+        Return the names of the entries a typelib defines in a namespace, 
+        mapped to the names of their methods for classes and interfaces, or 
+        None if the file isn't a typelib for that namespace. Entries it 
+        imports from other namespaces are left out.
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            
+            def string(offset):
+                return data[offset:data.index(b'\0', offset)].decode('utf-8')
+            
+            header = struct.unpack_from('=16sBBHHHIIIIIIIII18H', data)
+            if not header[0].startswith(b'GOBJ\nMETADATA'):
+                return None
+            n_local_entries, directory = header[5], header[6]
+            if string(header[11]) != namespace:
+                return None
+            (function_size, callback_size, property_size, field_size, 
+             object_size, interface_size) = [header[15 + i] 
+                                             for i in (1, 2, 6, 7, 15, 16)]
+            names = {}
+            for i in range(n_local_entries):
+                blob_type, _, name, offset = struct.unpack_from(
+                    '=HHII', data, directory + i * header[15])
+                if blob_type == 7: # object
+                    counts = struct.unpack_from('=10H', data, offset + 16)
+                    n_interfaces, n_fields, n_properties, n_methods = \
+                        counts[2:6]
+                    methods = (offset + object_size + 
+                               (n_interfaces + n_interfaces % 2) * 2 + 
+                               n_fields * field_size + 
+                               counts[9] * callback_size + 
+                               n_properties * property_size)
+                elif blob_type == 8: # interface
+                    counts = struct.unpack_from('=4H', data, offset + 16)
+                    n_prerequisites, n_properties, n_methods = counts[1:]
+                    methods = (offset + interface_size + 
+                               (n_prerequisites + n_prerequisites % 2) * 2 + 
+                               n_properties * property_size)
+                else:
+                    n_methods = 0
+                names[string(name)] = set(
+                    string(struct.unpack_from(
+                        '=I', data, methods + j * function_size + 4)[0])
+                    for j in range(n_methods))
+            return names
+        except (IOError, OSError, ValueError, UnicodeDecodeError, 
+                struct.error):
+            return None
+    
+    def guess_rb_version_from_binary(self, binary):
+        """
+        Return the installed version of Rhythmbox from the output of 
+        'rhythmbox --version', as the newest plugin version it supports.
+        """
+        if not binary:
+            return None
+        try:
+            process = Popen([binary, '--version'], stdout=PIPE, stderr=PIPE)
+            output = process.communicate()[0].decode('utf-8', 'replace')
+        except OSError:
+            return None
+        match = re.search(r'(\d+)\.(\d+)(?:\.(\d+))?', output)
+        if not match:
+            return None
+        installed = tuple(int(part or 0) for part in match.groups())
+        version = None
+        for candidate in self.plugin_files_path:
+            try:
+                numbers = tuple(int(part) for part in candidate.split('.'))
+            except ValueError:
+                continue # e.g. dev
+            numbers += (0,) * (3 - len(numbers))
+            if numbers <= installed and (version is None or 
+                                         numbers > version[0]):
+                version = (numbers, candidate)
+        if version:
+            logging.debug('Found Rhythmbox %s with %s --version' % \
+                          (match.group(0), binary))
+            return version[1]
+        return None
+    
+    def guess_rb_version_from_gi(self):
+        """
+        Return the installed version of Rhythmbox by probing the RB 
+        namespace through GI.
+        """
+        try:
+            from gi.repository import RB
+        except ImportError:
+            return None
+        for version, class_name, name in self.VERSION_PROBES:
+            if class_name:
+                if name in dir(getattr(RB, class_name, None)):
+                    return version
+            elif name in dir(RB):
+                return version
+        return None
 
     def manual_install(self, error=False):
         """
@@ -204,7 +848,8 @@ class RBPluginInstaller():
         """
         logging.debug('Cleaning up...')
         for f in self.cleanup_files:
-            path = os.path.join(self.PLUGINS_PATH, self.install_folder, f)
+            path = os.path.expanduser(os.path.join(self.PLUGINS_PATH, 
+                                                   self.install_folder, f))
             if os.path.exists(path):
                 if os.path.isdir(path):
                     shutil.rmtree(path)
@@ -213,3 +858,302 @@ class RBPluginInstaller():
                 else:
                     logging.warning(path + ' is not a valid file or ' \
                                     'directory and cannot be removed')
+
+
+def load_batch_plugin(entry, base_path):
+    """
+    Return an installer for a plugin in a batch manifest. An entry names 
+    the plugin and either its install.py, whose settings are used, or the 
+    settings themselves. Relative paths are relative to the install.py, or 
+    to the manifest.
+    """
+    settings = {}
+    if 'installer' in entry:
+        installer = os.path.join(base_path, entry['installer'])
+        base_path = os.path.dirname(os.path.abspath(installer))
+        sys.path.insert(0, base_path)
+        try:
+            settings = runpy.run_path(installer, run_name='rbpi_batch')
+        finally:
+            sys.path.remove(base_path)
+    settings.update(entry)
+    
+    def resolve(path):
+        return os.path.join(base_path, path) if path else path
+    
+    return RBPluginInstaller(
+        settings['name'], 
+        dict((version, resolve(path)) for version, path 
+             in settings['plugin_files_path'].items()), 
+        common_files=[resolve(f) for f in settings.get('common_files', [])], 
+        install_folder=settings.get('install_folder'), 
+        glib_schema=resolve(settings.get('glib_schema')), 
+        cleanup_files=settings.get('cleanup_files', []), 
+        old_install_folders=settings.get('old_install_folders', []), 
+        parse_args=False)
+
+
+def compile_schema_folders(folders):
+    """
+    Compile each schema folder. Folders holding identical schemas are 
+    compiled once, and the result copied to the others. Return a dict 
+    mapping each folder to an error message, or None on success.
+    """
+    groups = {}
+    for folder in folders:
+        key = tuple(sorted(
+            (name, RBPluginInstaller.hash_file(os.path.join(folder, name))) 
+            for name in os.listdir(folder) 
+            if name.endswith(('.gschema.xml', '.gschema.override', 
+                              '.enums.xml'))))
+        groups.setdefault(key, []).append(folder)
+    
+    errors = {}
+    for group in groups.values():
+        logging.debug('Compiling schemas in %s for %d profile(s)' % \
+                      (group[0], len(group)))
+        error = None
+        if call(['glib-compile-schemas', group[0]]) != 0:
+            error = 'glib-compile-schemas failed'
+        for folder in group[1:]:
+            if error is None:
+                shutil.copy(os.path.join(group[0], 'gschemas.compiled'), 
+                            folder)
+        for folder in group:
+            errors[folder] = error
+    return errors
+
+
+def batch_install(manifest_path, jobs=4):
+    """
+    Install every plugin in a manifest into every profile in it, without 
+    prompting, and print a report. Installs run in parallel, and each 
+    profile's schemas are compiled once, after all installs have finished. 
+    Return the number of failures.
+    
+    The manifest is a JSON object, e.g.
+    
+        {"version": "3.0",
+         "profiles": ["/home/alice", "/home/bob"],
+         "plugins": [{"name": "RatingFilters", 
+                      "installer": "rating-filters/install.py"}]}
+    
+    If no version is given, the installed version of Rhythmbox is used. 
+    A plugin entry may also give its own version.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    base_path = os.path.dirname(os.path.abspath(manifest_path))
+    profiles = [os.path.expanduser(p) for p in manifest['profiles']]
+    
+    failures = []
+    plugins = []
+    for entry in manifest['plugins']:
+        try:
+            plugins.append((entry, load_batch_plugin(entry, base_path)))
+        except Exception as e:
+            failures.append((entry.get('name', '?'), '*', 
+                             'cannot load plugin: %s' % e))
+    
+    version = manifest.get('version')
+    if not version and plugins:
+        version = plugins[0][1].guess_rb_version()
+    
+    def install(task):
+        entry, installer, profile = task
+        installer.PLUGINS_PATH = os.path.join(
+            profile, '.local/share/rhythmbox/plugins/')
+        installer.USER_GLIB_PATH = os.path.join(
+            profile, '.local/share/glib-2.0/schemas/')
+        try:
+            plugin_version = entry.get('version', version)
+            if not plugin_version:
+                raise ValueError('could not determine the Rhythmbox version')
+            schema_copied = installer.incremental_install(
+                plugin_version, compile_schema=False)
+            return task, schema_copied, None
+        except Exception as e:
+            return task, False, str(e) or e.__class__.__name__
+    
+    # Each task gets its own installer, since paths are set per profile
+    tasks = [(entry, copy.copy(installer), profile) 
+             for entry, installer in plugins for profile in profiles]
+    pool = ThreadPool(max(1, jobs))
+    try:
+        results = pool.map(install, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    
+    schema_folders = {}
+    installed = []
+    for (entry, installer, profile), schema_copied, error in results:
+        if error:
+            failures.append((installer.plugin_name, profile, error))
+            continue
+        installed.append((installer.plugin_name, profile))
+        if schema_copied:
+            folder = os.path.expanduser(installer.USER_GLIB_PATH)
+            schema = os.path.join(folder, 
+                                  os.path.basename(installer.glib_schema))
+            schema_folders.setdefault(folder, []).append(
+                (installer.plugin_name, profile, schema))
+    
+    for folder, error in compile_schema_folders(schema_folders).items():
+        if error:
+            for name, profile, schema in schema_folders[folder]:
+                # Removing the schema makes the next run compile it again
+                os.remove(schema)
+                failures.append((name, profile, error))
+                installed.remove((name, profile))
+    
+    print('\nInstalled %d of %d plugin(s) for Rhythmbox %s, compiled ' \
+          '%d schema folder(s):' % (len(installed), 
+                                    len(installed) + len(failures), 
+                                    version, len(schema_folders)))
+    for name, profile in installed:
+        print('  ok      %s -> %s' % (name, profile))
+    for name, profile, error in failures:
+        print('  FAILED  %s -> %s: %s' % (name, profile, error))
+    return len(failures)
+
+
+def main():
+    parser = ArgumentParser(
+        description='Installs Rhythmbox plugins into user profiles from a ' \
+                    'manifest, without prompting.')
+    parser.add_argument('manifest', help='JSON manifest of plugins and profiles')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=4, 
+        help = 'number of installs to run in parallel')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG, 
+                        format='%(asctime)s %(levelname)-8s %(message)s', 
+                        datefmt='%H:%M:%S')
+    sys.exit(1 if batch_install(args.manifest, args.jobs) else 0)
+
+
+class InotifyWatcher():
+    
+    """
+    Watches folders for changes to the files in them using inotify.
+    """
+    
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    EVENT_SIZE = struct.calcsize('iIII')
+    
+    def __init__(self, folders, settle_time=0.2):
+        """
+        Start watching the folders. Raises OSError if inotify is unavailable.
+        """
+        self.settle_time = settle_time
+        self.folders = {}
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        mask = (self.IN_MODIFY | self.IN_ATTRIB | self.IN_CLOSE_WRITE | 
+                self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | 
+                self.IN_DELETE)
+        for folder in folders:
+            wd = libc.inotify_add_watch(self.fd, folder.encode('utf-8'), mask)
+            if wd < 0:
+                self.close()
+                raise OSError(ctypes.get_errno(), 'cannot watch ' + folder)
+            self.folders[wd] = folder
+    
+    def wait(self):
+        """
+        Block until something changes, then return the paths that changed. 
+        Events are collected until the folders have been quiet for the 
+        settle time, so that an editor saving a file counts as one change.
+        """
+        select.select([self.fd], [], [])
+        changed = set()
+        while select.select([self.fd], [], [], self.settle_time)[0]:
+            data = os.read(self.fd, 65536)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + self.EVENT_SIZE:
+                            offset + self.EVENT_SIZE + length]
+                offset += self.EVENT_SIZE + length
+                if mask & self.IN_Q_OVERFLOW:
+                    changed.update(self.get_all_files())
+                elif wd in self.folders:
+                    name = name.rstrip(b'\0').decode('utf-8', 'replace')
+                    changed.add(os.path.join(self.folders[wd], name))
+        return changed
+    
+    def get_all_files(self):
+        """
+        Return every file in the watched folders.
+        """
+        return set(os.path.join(folder, name) 
+                   for folder in self.folders.values() 
+                   for name in os.listdir(folder))
+    
+    def close(self):
+        """
+        Stop watching.
+        """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher():
+    
+    """
+    Watches folders for changes to the files in them by polling their 
+    modification times.
+    """
+    
+    def __init__(self, folders, interval=0.5):
+        self.folders = folders
+        self.interval = interval
+        self.mtimes = self.scan()
+    
+    def scan(self):
+        """
+        Return the modification time of every file in the watched folders.
+        """
+        mtimes = {}
+        for folder in self.folders:
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                try:
+                    mtimes[path] = os.stat(path).st_mtime
+                except OSError:
+                    pass
+        return mtimes
+    
+    def wait(self):
+        """
+        Block until something changes, then return the paths that changed.
+        """
+        while True:
+            time.sleep(self.interval)
+            mtimes = self.scan()
+            changed = set(path for path in set(mtimes) | set(self.mtimes) 
+                          if mtimes.get(path) != self.mtimes.get(path))
+            self.mtimes = mtimes
+            if changed:
+                return changed
+    
+    def close(self):
+        """
+        Stop watching.
+        """
+        pass
+
+
+if __name__ == "__main__":
+    main()
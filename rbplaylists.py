@@ -0,0 +1,600 @@
+#!/usr/bin/python3
+# -*- Mode: python; coding: utf-8; tab-width: 4; indent-tabs-mode: nil; -*-
+#
+#    rbplaylists.py
+#
+#    Offline rating filtered exports of Rhythmbox playlists.
+#    Copyright (C) 2014 Donagh Horgan <donagh.horgan@gmail.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Writes a rating filtered copy of every static and automatic playlist in
+playlists.xml, one M3U (or CSV) file per playlist, without running
+Rhythmbox:
+
+    python3 rbplaylists.py --filter Favourites --output ~/car-stereo
+
+The library is read from rhythmdb.xml once, into an index file holding the
+rating bucket and the fields the playlists need of every entry. Playlists
+are then filtered in a process pool whose workers map the index read only,
+so the index is shared between them rather than copied into each, and
+more cores means more playlists filtered at once.
+
+Automatic playlists are evaluated as Rhythmbox would: their queries,
+sort order and limits are applied first and the rating filter last. A
+playlist using a query the tool doesn't know is skipped and reported.
+"""
+from argparse import ArgumentParser
+from multiprocessing import Pool
+import datetime
+import hashlib
+import heapq
+import json
+import mmap
+import operator
+import os
+import struct
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+COMMON_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'common')
+sys.path.insert(0, COMMON_PATH)
+from RatingFiltersCore import get_rating_bucket
+from rbfilter import (get_entries, get_settings, LibraryFilter, make_track,
+                      RHYTHMDB_PATH, TRACK_FIELDS, write_tracks)
+
+PLAYLISTS_PATH = '~/.local/share/rhythmbox/playlists.xml'
+
+NUMERIC_PROPS = set([
+    'track-number', 'disc-number', 'duration', 'file-size', 'mtime',
+    'first-seen', 'last-seen', 'rating', 'play-count', 'last-played',
+    'bitrate', 'date', 'beats-per-minute', 'status'
+    ])
+OPERATORS = set([
+    'equals', 'not-equal', 'like', 'not-like', 'prefix', 'suffix',
+    'fuzzy-match', 'greater', 'less', 'current-time-within',
+    'current-time-not-within', 'year-equals', 'year-greater', 'year-less'
+    ])
+SORT_KEYS = {
+    'Track': ['album', 'disc-number', 'track-number'],
+    'Title': ['title'],
+    'Artist': ['artist', 'album', 'disc-number', 'track-number'],
+    'Album': ['album', 'disc-number', 'track-number'],
+    'Genre': ['genre', 'artist', 'album', 'disc-number', 'track-number'],
+    'Composer': ['composer'],
+    'Time': ['duration'],
+    'Year': ['date'],
+    'Quality': ['bitrate'],
+    'Rating': ['rating'],
+    'PlayCount': ['play-count'],
+    'LastPlayed': ['last-played'],
+    'FirstSeen': ['first-seen'],
+    'LastSeen': ['last-seen'],
+    'Location': ['location'],
+    'BPM': ['beats-per-minute']
+    }
+SKIPPED_TYPES = set(['ignore', 'import-error'])
+
+
+class LibraryIndex():
+
+    """
+    A read only, memory mapped index of the library. After a header, the
+    file holds one line per entry, starting with the entry's rating bucket
+    as a hex digit and followed by the entry's fields as JSON, and then a
+    table of (location hash, line offset) pairs sorted by hash, so that
+    an entry can be found by location with a binary search.
+    """
+
+    MAGIC = b'RFI1'
+    HEADER = struct.Struct('<4sQQ')
+    SLOT = struct.Struct('<QQ')
+
+    def __init__(self, path):
+        """
+        Maps an index file.
+        """
+        with open(path, 'rb') as index_file:
+            self.map = mmap.mmap(index_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        magic, self.count, self.table = self.HEADER.unpack_from(self.map)
+        if magic != self.MAGIC:
+            raise ValueError(path + ' is not a library index')
+
+    @staticmethod
+    def get_hash(location):
+        """
+        Returns the 64 bit hash a location is looked up by.
+        """
+        return struct.unpack('<Q', hashlib.blake2b(
+            location.encode('utf-8'), digest_size=8
+            ).digest())[0]
+
+    @classmethod
+    def write(cls, path, entries, props):
+        """
+        Writes an index of entries, given as (type, fields) pairs, keeping
+        only the given fields. Returns the number of entries indexed.
+        """
+        slots = []
+        with open(path, 'wb') as index_file:
+            index_file.write(cls.HEADER.pack(cls.MAGIC, 0, 0))
+            offset = cls.HEADER.size
+            for entry_type, fields in entries:
+                location = fields.get('location')
+                if entry_type in SKIPPED_TYPES or not location:
+                    continue
+                row = dict((prop, fields[prop]) for prop in props
+                           if fields.get(prop) is not None)
+                row['type'] = entry_type
+                line = b'%x%s\n' % (
+                    get_rating_bucket(float(fields.get('rating') or 0)),
+                    json.dumps(row, separators=(',', ':')).encode('ascii')
+                    )
+                index_file.write(line)
+                slots.append((cls.get_hash(location), offset))
+                offset += len(line)
+            slots.sort()
+            for slot in slots:
+                index_file.write(cls.SLOT.pack(*slot))
+            index_file.seek(0)
+            index_file.write(cls.HEADER.pack(cls.MAGIC, len(slots), offset))
+        return len(slots)
+
+    def close(self):
+        self.map.close()
+
+    def get_line(self, offset):
+        """
+        Returns the line at an offset, without its newline.
+        """
+        return self.map[offset:self.map.find(b'\n', offset)]
+
+    def lookup(self, location):
+        """
+        Returns the line for a location, or None if it isn't in the
+        library.
+        """
+        key = self.get_hash(location)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.SLOT.unpack_from(
+                self.map, self.table + middle * self.SLOT.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        # Check the location too, in case two locations share a hash.
+        for slot in range(low, self.count):
+            slot_key, offset = self.SLOT.unpack_from(
+                self.map, self.table + slot * self.SLOT.size
+                )
+            if slot_key != key:
+                break
+            if self.get_row(offset)['location'] == location:
+                return self.get_line(offset)
+        return None
+
+    def __iter__(self):
+        """
+        Yields the offset and line of every entry, in library order.
+        """
+        offset = self.HEADER.size
+        while offset < self.table:
+            end = self.map.find(b'\n', offset)
+            yield offset, self.map[offset:end]
+            offset = end + 1
+
+    def get_row(self, offset):
+        """
+        Returns the fields of the entry at an offset.
+        """
+        return json.loads(self.get_line(offset)[1:].decode('ascii'))
+
+
+def parse_query(conjunction, props):
+    """
+    Parses a serialized Rhythmbox query into a list of alternatives, each
+    a list of (op, prop, value) criteria that must all hold, and
+    adds the props it uses to props. Raises ValueError for anything the
+    tool can't evaluate.
+    """
+    alternatives = [[]]
+    for child in conjunction:
+        if child.tag == 'disjunction':
+            alternatives.append([])
+        elif child.tag == 'subquery':
+            subquery = child.find('conjunction')
+            if subquery is None:
+                raise ValueError('empty subquery')
+            alternatives[-1].append(
+                ('subquery', None, parse_query(subquery, props))
+                )
+        elif child.tag in OPERATORS:
+            prop = child.get('prop')
+            if prop is None:
+                raise ValueError('no property for ' + child.tag)
+            value = child.text or ''
+            if prop in NUMERIC_PROPS or child.tag.startswith('current-time'):
+                value = float(value)
+            elif child.tag not in ('equals', 'not-equal'):
+                value = value.casefold()
+            props.add(prop)
+            alternatives[-1].append((child.tag, prop, value))
+        else:
+            raise ValueError('unsupported query element ' + child.tag)
+    return alternatives
+
+
+def get_year(julian_day):
+    """
+    Returns the year of a GLib Julian day number.
+    """
+    if julian_day < 1:
+        return 0
+    return datetime.date.fromordinal(int(julian_day)).year
+
+
+def test(row, op, prop, value, now):
+    """
+    Returns True if an entry meets a single query criterion.
+    """
+    if op == 'subquery':
+        return matches(row, value, now)
+    field = row.get(prop)
+    if prop in NUMERIC_PROPS or op.startswith('current-time'):
+        number = float(field or 0)
+        if op == 'equals':
+            return number == value
+        elif op == 'not-equal':
+            return number != value
+        elif op == 'greater':
+            return number > value
+        elif op == 'less':
+            return number < value
+        elif op == 'current-time-within':
+            return number >= now - value
+        elif op == 'current-time-not-within':
+            return number < now - value
+        elif op == 'year-equals':
+            return get_year(number) == get_year(value)
+        elif op == 'year-greater':
+            return get_year(number) > get_year(value)
+        elif op == 'year-less':
+            return get_year(number) < get_year(value)
+        field = str(field or '')
+    else:
+        field = field or ''
+    if op == 'equals':
+        return field == value
+    elif op == 'not-equal':
+        return field != value
+    field = field.casefold()
+    if op == 'like':
+        return value in field
+    elif op == 'not-like':
+        return value not in field
+    elif op == 'prefix':
+        return field.startswith(value)
+    elif op == 'suffix':
+        return field.endswith(value)
+    elif op == 'fuzzy-match':
+        return all(word in field for word in value.split())
+    elif op == 'greater':
+        return field > value
+    elif op == 'less':
+        return field < value
+    return False
+
+
+def matches(row, query, now):
+    """
+    Returns True if an entry matches a parsed query.
+    """
+    for alternative in query:
+        for op, prop, value in alternative:
+            if not test(row, op, prop, value, now):
+                break
+        else:
+            return True
+    return False
+
+
+def get_sort_key(props):
+    """
+    Returns a function giving the sort key of an entry for a list of
+    props.
+    """
+    def sort_key(row):
+        return tuple(
+            float(row.get(prop) or 0) if prop in NUMERIC_PROPS
+            else (row.get(prop) or '').casefold()
+            for prop in props
+            )
+    return sort_key
+
+
+def apply_limits(rows, limits):
+    """
+    Yields rows, in order, until the first one that would take the
+    playlist past its count, size (in MB) or time (in seconds) limit.
+    """
+    count = size = duration = 0
+    for row in rows:
+        count += 1
+        size += int(row.get('file-size') or 0)
+        duration += int(row.get('duration') or 0)
+        if ((limits['limit-count'] and count > limits['limit-count']) or
+            (limits['limit-size'] and
+             size > limits['limit-size'] * 1024 * 1024) or
+            (limits['limit-time'] and duration > limits['limit-time'])):
+            return
+        yield row
+
+
+def parse_playlists(path):
+    """
+    Returns the static and automatic playlists in a playlists.xml file as
+    dictionaries that can be sent to the workers, the playlists that
+    can't be exported with the reason why, and the props the automatic
+    playlists use.
+    """
+    playlists = []
+    skipped = []
+    props = set()
+    for node in ET.parse(path).getroot().iter('playlist'):
+        playlist = {'name': node.get('name') or '', 'type': node.get('type')}
+        if playlist['type'] == 'static':
+            playlist['locations'] = [
+                location.text for location in node.iter('location')
+                if location.text
+                ]
+        elif playlist['type'] == 'automatic':
+            conjunction = node.find('conjunction')
+            used = set()
+            try:
+                if conjunction is None:
+                    raise ValueError('no query')
+                playlist['query'] = parse_query(conjunction, used)
+                for limit in ['limit-count', 'limit-size', 'limit-time']:
+                    playlist[limit] = int(node.get(limit) or 0)
+            except ValueError as e:
+                skipped.append((playlist['name'], str(e)))
+                continue
+            sort_props = SORT_KEYS.get(node.get('sort-key'), [])
+            playlist['sort'] = sort_props
+            playlist['reverse'] = node.get('sort-direction') == '1'
+            props.update(used, sort_props)
+            if playlist['limit-size']:
+                props.add('file-size')
+        else:
+            continue
+        playlists.append(playlist)
+    return playlists, skipped, props
+
+
+def get_output_names(playlists, extension):
+    """
+    Returns a file name for each playlist that is safe to write and
+    different from the others.
+    """
+    names = []
+    taken = set()
+    for playlist in playlists:
+        base = playlist['name'].replace(os.sep, '_').replace('\0', '')
+        base = base.strip().lstrip('.') or 'Playlist'
+        name = base + extension
+        number = 1
+        while name.casefold() in taken:
+            number += 1
+            name = '%s (%d)%s' % (base, number, extension)
+        taken.add(name.casefold())
+        names.append(name)
+    return names
+
+
+# The index each worker maps, and the rating table it filters with.
+index = None
+table = None
+
+
+def init_worker(index_path, rating_table):
+    global index, table
+    index = LibraryIndex(index_path)
+    table = rating_table
+
+
+def export_playlist(job):
+    """
+    Filters a playlist against the index and writes it. Runs in a worker
+    process. Returns the playlist name, the number of tracks written and
+    the number in the playlist, and an error message or None.
+    """
+    playlist, output_path, options = job
+    try:
+        total, tracks = filter_playlist(playlist, options['now'])
+        with open(output_path, 'w', newline='', encoding='utf-8') as output:
+            if options['format'] == 'csv':
+                count = write_tracks(tracks, csv_output=output)
+            else:
+                count = write_tracks(tracks, output, paths=options['paths'])
+    except Exception as e:
+        return playlist['name'], 0, 0, '%s: %s' % (type(e).__name__, e)
+    return playlist['name'], count, total, None
+
+
+def filter_playlist(playlist, now):
+    """
+    Returns the number of entries in a playlist that are in the library
+    (or None if the playlist has no limits, as counting them would mean
+    reading every entry the rating filter drops), and a generator of the
+    tracks that pass the rating filter. Only the offsets of the entries
+    are kept, so an automatic playlist matching most of the library
+    doesn't hold all of it in memory, and one limited by count only
+    keeps no more entries than its limit.
+    """
+    if playlist['type'] == 'static':
+        lines = [index.lookup(location) for location in playlist['locations']]
+        lines = [line for line in lines if line is not None]
+        return len(lines), (
+            make_track(json.loads(line[1:].decode('ascii')))
+            for line in lines if table[int(line[:1], 16)]
+            )
+
+    query = playlist['query']
+    limited = (playlist['limit-count'] or playlist['limit-size'] or
+               playlist['limit-time'])
+    sort_key = get_sort_key(playlist['sort']) if playlist['sort'] else None
+    found = find_entries(query, now, sort_key, limited)
+    if sort_key and limited == playlist['limit-count']:
+        # Only the first limit-count entries in sort order can be kept.
+        select = heapq.nlargest if playlist['reverse'] else heapq.nsmallest
+        found = select(limited, found, key=operator.itemgetter(0))
+    elif sort_key:
+        found = sorted(found, key=operator.itemgetter(0),
+                       reverse=playlist['reverse'])
+    rows = (index.get_row(offset) for _, offset in found)
+    if not limited:
+        return None, (make_track(row) for row in rows)
+    rows = list(apply_limits(rows, playlist))
+    return len(rows), (
+        make_track(row) for row in rows
+        if table[get_rating_bucket(float(row.get('rating') or 0))]
+        )
+
+
+def find_entries(query, now, sort_key, limited):
+    """
+    Yields the sort key (or None) and offset of each entry that matches
+    a query, in library order.
+    """
+    for offset, line in index:
+        # Without limits, whether an entry is in the playlist doesn't
+        # depend on the others, so entries the rating filter drops needn't
+        # be decoded.
+        if not limited and not table[int(line[:1], 16)]:
+            continue
+        row = json.loads(line[1:].decode('ascii'))
+        if matches(row, query, now):
+            yield sort_key(row) if sort_key else None, offset
+
+
+def main():
+    settings = get_settings()
+    parser = ArgumentParser(
+        description='Writes a rating filtered copy of every Rhythmbox ' \
+                    'playlist, without running Rhythmbox.')
+    parser.add_argument(
+        '-o', '--output', required=True,
+        help = 'folder to write the playlists to')
+    parser.add_argument(
+        '-f', '--filter', default='Favourites',
+        help = 'rating filter to apply (default: Favourites)')
+    parser.add_argument(
+        '-d', '--db', default=RHYTHMDB_PATH,
+        help = 'rhythmdb.xml file to read (default: %(default)s)')
+    parser.add_argument(
+        '-p', '--playlists', default=PLAYLISTS_PATH,
+        help = 'playlists.xml file to read (default: %(default)s)')
+    parser.add_argument(
+        '--csv', action='store_true',
+        help = 'write CSV files rather than M3U playlists')
+    parser.add_argument(
+        '--paths', action='store_true',
+        help = 'write local paths rather than file URIs to M3U playlists')
+    parser.add_argument(
+        '-t', '--threshold', type=float,
+        help = 'favourites threshold in stars (default: %d, from ' \
+               'favourites-threshold)' % settings['favourites-threshold'])
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count() or 1,
+        help = 'number of playlists to filter in parallel (default: the ' \
+               'number of CPUs)')
+    args = parser.parse_args()
+
+    if args.threshold is not None:
+        settings['favourites-threshold'] = args.threshold
+    db_path = os.path.expanduser(args.db)
+    playlists_path = os.path.expanduser(args.playlists)
+    library_filter = LibraryFilter(db_path, 'All Ratings', settings)
+    if args.filter not in library_filter.rating_tables:
+        parser.error('%s is not a rating filter; choose one of %s' % (
+            args.filter, ', '.join(sorted(library_filter.rating_tables))
+            ))
+    for path in [db_path, playlists_path]:
+        if not os.path.exists(path):
+            parser.error(path + ' does not exist')
+
+    start = time.time()
+    playlists, skipped, props = parse_playlists(playlists_path)
+    output = os.path.expanduser(args.output)
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    names = get_output_names(playlists, '.csv' if args.csv else '.m3u')
+    options = {
+        'format': 'csv' if args.csv else 'm3u',
+        'paths': args.paths,
+        'now': time.time()
+        }
+    jobs = [(playlist, os.path.join(output, name), options)
+            for playlist, name in zip(playlists, names)]
+    # Large playlists first, so that a big one isn't left until last.
+    jobs.sort(key=lambda job: -len(job[0].get('locations', ())))
+
+    index_file = tempfile.NamedTemporaryFile(
+        prefix='rbplaylists-', suffix='.index', delete=False
+        )
+    index_file.close()
+    failed = 0
+    try:
+        count = LibraryIndex.write(index_file.name, get_entries(db_path),
+                                   props.union(TRACK_FIELDS))
+        sys.stdout.write('Indexed %d entries in %.1fs\n' % (
+            count, time.time() - start
+            ))
+        pool = Pool(
+            args.jobs, init_worker,
+            (index_file.name, library_filter.rating_tables[args.filter])
+            )
+        try:
+            for name, count, total, error in pool.imap_unordered(
+                export_playlist, jobs):
+                if error is not None:
+                    failed += 1
+                    sys.stdout.write('%s: failed: %s\n' % (name, error))
+                elif total is None:
+                    sys.stdout.write('%s: %d tracks\n' % (name, count))
+                else:
+                    sys.stdout.write('%s: %d of %d tracks\n' % (
+                        name, count, total
+                        ))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        os.remove(index_file.name)
+
+    for name, reason in skipped:
+        sys.stdout.write('%s: skipped: %s\n' % (name, reason))
+    sys.stdout.write('Exported %d playlists in %.1fs\n' % (
+        len(jobs) - failed, time.time() - start
+        ))
+    sys.exit(1 if failed or skipped else 0)
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,9 @@
 from gi.repository import GObject, RB, Peas, Gtk, GLib, Gio, PeasGtk
 import rb
 
+from RatingFiltersCore import compile_rating_range, RatingIndex
+from RatingFiltersPages import PageFilters
+
 ui_str = '''
 <ui>
   <toolbar name="LibrarySourceToolBar">
@@ -94,6 +97,9 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
 
         # Class variables
         self.visited_pages = {}
+        self.rating_index = RatingIndex()
+        self.page_filters = {}
+        self.rating_models = {}
         self.radioactions = {"All": self.radioaction_all, "Favourites": self.radioaction_favourites, "Unrated": self.radioaction_unrated}
 
         self.settings = Gio.Settings('org.gnome.rhythmbox.plugins.rating_filters')
@@ -119,10 +125,10 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
         '''
         Unlinks UI elements and resets entry views.
         '''
-        for page in self.visited_pages:
-            [_, query_models, t] = self.visited_pages[page]
-            self.visited_pages[page] = ["All", query_models, t]
-            self.refresh(page)
+        self.restore_pages()
+
+        for query_model in list(self.rating_models):
+            self.discard_query_model(query_model)
 
         shell = self.object
 
@@ -132,28 +138,40 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
         manager.ensure_update()
 
 
+    def restore_pages(self):
+        '''
+        Puts every visited page back on its unfiltered query model. Only the selected 
+        page is refreshed; the others just have their model swapped, since the 
+        unfiltered model is still in the order the view was sorted by.
+        '''
+        selected_page = self.object.props.selected_page
+        for page, (_, query_models, t) in self.visited_pages.items():
+            query_model = query_models["All"]
+            entry_view = page.get_entry_view()
+            if entry_view.props.model is query_model:
+                continue
+            if page is selected_page:
+                self.visited_pages[page] = ["All", query_models, t]
+                self.refresh(page)
+            else:
+                entry_view.props.model = query_model
+                page.props.query_model = query_model
+
+
     def on_entry_change(self, db, entry, changes):
         '''
-        Called when an entry in the current view is changed. If the user has changed 
-        a track's rating, and the new rating should be filtered out, then the page
-        is refreshed.
+        Called when an entry in the database is changed. If the user has changed 
+        a track's rating, the track is added to or removed from the filtered models 
+        it now passes or fails, without rebuilding them.
         '''
         change = changes.values
 
         if change.prop is RB.RhythmDBPropType.RATING:
-            for page in self.visited_pages:
-                [active_filter, query_models, t] = self.visited_pages[page]
-                query_model = query_models["All"]
-                entries = [row[0] for row in query_model]
-                if entry in entries:
-                    if "Favourites" in query_models:
-                        del query_models["Favourites"]
-                    if "Unrated" in query_models:
-                        del query_models["Unrated"]
-                    self.visited_pages[page] = [active_filter, query_models, t]
-
-            shell = self.object
-            self.on_page_change(None, shell.props.selected_page)
+            entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+            delta = self.rating_index.update(entry_id, entry.get_double(RB.RhythmDBPropType.RATING))
+            if delta is not None:
+                for page_filters in list(self.page_filters.values()):
+                    page_filters.entry_changed(entry, entry_id, delta)
 
 
     def on_button_change(self, action, current):
@@ -172,6 +190,8 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
         if page in self.visited_pages:
             [_, query_models, t0] = self.visited_pages[page]
             if active_filter not in query_models or (active_filter == "Favourites" and t0 != t):
+                if active_filter in query_models:
+                    self.discard_query_model(query_models[active_filter])
                 query_models[active_filter] = self.filter_query_model(active_filter, query_models["All"])
             self.visited_pages[page] = [active_filter, query_models, t]
             self.refresh(page)
@@ -205,6 +225,10 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
         query_models = {}
         query_model = page.get_entry_view().props.model
 
+        [_, old_query_models, _] = self.visited_pages[page]
+        for old_query_model in old_query_models.values():
+            self.discard_query_model(old_query_model)
+
         active_filter = "All"
         query_models[active_filter] = self.filter_query_model(active_filter, query_model)
 
@@ -230,6 +254,8 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
                 [active_filter, query_models, t0] = self.visited_pages[page]
 
                 if (active_filter == "Favourites" and t0 != t) or active_filter not in query_models:
+                    if active_filter in query_models:
+                        self.discard_query_model(query_models[active_filter])
                     query_models[active_filter] = self.filter_query_model(active_filter, query_models["All"])
                     self.visited_pages[page] = [active_filter, query_models, t]
 
@@ -247,9 +273,19 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
                 page.connect("filter-changed", self.on_browser_change)
 
 
+    def get_rating_table(self, active_filter):
+        '''
+        Returns the compiled rating table for a filter.
+        '''
+        if active_filter == "Favourites":
+            return compile_rating_range(self.settings['favourites-threshold'], 5.0)
+        return compile_rating_range(0.0, 0.0)
+
+
     def filter_query_model(self, active_filter, query_model):
         '''
-        Applies the active filter to the supplied query model and returns the result.
+        Applies the active filter to the supplied query model and returns the result, 
+        which is kept up to date as entries are added, removed and rated.
         '''
         print "Creating new query model for " + active_filter
 
@@ -260,22 +296,27 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
         if active_filter == "All":
             new_query_model = query_model
         else:
-            if active_filter == "Favourites":
-                ratings = [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
-                t = self.settings['favourites-threshold']
-                ratings = ratings[t:]
-            else:
-                ratings = [0.0]
-
-            for row in query_model:
-                entry = row[0]
-                entry_rating = entry.get_double(RB.RhythmDBPropType.RATING)
-                if entry_rating in ratings:
-                    new_query_model.add_entry(entry, -1)
+            if query_model not in self.page_filters:
+                self.page_filters[query_model] = PageFilters(query_model, self.rating_index)
+            page_filters = self.page_filters[query_model]
+            page_filters.add_filter(active_filter, self.get_rating_table(active_filter), new_query_model)
+            self.rating_models[new_query_model] = (page_filters, active_filter)
 
         return new_query_model
 
 
+    def discard_query_model(self, query_model):
+        '''
+        Stops keeping a filtered query model that is no longer needed up to date.
+        '''
+        if query_model in self.rating_models:
+            page_filters, filter_name = self.rating_models.pop(query_model)
+            page_filters.remove_filter(filter_name)
+            if not page_filters.new_query_models:
+                page_filters.stop()
+                del self.page_filters[page_filters.query_model]
+
+
     def refresh(self, page):
         '''
         Refreshes the entry view on the specified page.
@@ -34,6 +34,9 @@ from gi.repository import PeasGtk
 
 import rb
 
+from RatingFiltersCore import compile_rating_range, RatingIndex
+from RatingFiltersPages import PageFilters
+
 class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
     '''
     Main class for the RatingFilters plugin. Contains functions for setting 
@@ -80,6 +83,9 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
         self.locations = ['library-toolbar', 'playlist-toolbar']
         self.visited_pages = {}
         self.active_filter = {}
+        self.rating_index = RatingIndex()
+        self.page_filters = {}
+        self.rating_models = {}
         
         action_name = 'rating-filters'
         self.action = Gio.SimpleAction.new_stateful(
@@ -111,15 +117,35 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
         '''
         self.log(self.do_deactivate.__name__, 'Deactivating plugin...')
         
-        for page in self.visited_pages:
-            [_, query_models, t] = self.visited_pages[page]
-            self.visited_pages[page] = ['All Ratings', query_models, t]
-            self.refresh(page)
+        self.restore_pages()
+
+        for query_model in list(self.rating_models):
+            self.discard_query_model(query_model)
 
         app = Gio.Application.get_default()
         for location in self.locations:
             app.remove_plugin_menu_item(location, self.app_id)
 
+    def restore_pages(self):
+        '''
+        Puts every visited page back on its unfiltered query model. Only the 
+        selected page is refreshed; the others just have their model 
+        swapped, since the unfiltered model is still in the order the view 
+        was sorted by.
+        '''
+        selected_page = self.object.props.selected_page
+        for page, (_, query_models, t) in self.visited_pages.items():
+            query_model = query_models['All Ratings']
+            entry_view = page.get_entry_view()
+            if entry_view.props.model is query_model:
+                continue
+            if page is selected_page:
+                self.visited_pages[page] = ['All Ratings', query_models, t]
+                self.refresh(page)
+            else:
+                entry_view.props.model = query_model
+                page.props.query_model = query_model
+
     def target_value_to_filter_name(self, target_value):
         '''
         Converts target values to filter names.
@@ -161,6 +187,8 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
             [_, query_models, t0] = self.visited_pages[page]
             if (active_filter not in query_models or 
                 (active_filter == 'Favourites' and t0 != t)):
+                if active_filter in query_models:
+                    self.discard_query_model(query_models[active_filter])
                 query_models[active_filter] = self.filter_query_model(
                     active_filter, query_models['All Ratings']
                     )
@@ -220,34 +248,20 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
 
     def on_entry_change(self, db, entry, changes):
         '''
-        Called when an entry in the current view is changed. If the user has 
-        changed a track's rating, and the new rating should be filtered out, 
-        then the page is refreshed.
+        Called when an entry in the database is changed. If the user has 
+        changed a track's rating, the track is added to or removed from the 
+        filtered models it now passes or fails, without rebuilding them.
         '''
-        # This isn't working like it used to: the changes object no longer 
-        # has a values property, so we can't check to see what was changed. 
-        # For now, we'll just refresh everything each time something is 
-        # changed, although this isn't ideal.
-        
-        #change = changes.values
-        
-        #if change.prop is RB.RhythmDBPropType.RATING:
-        if True:
-            for page in self.visited_pages:
-                [active_filter, query_models, t] = self.visited_pages[page]
-                query_model = query_models['All Ratings']
-                entries = [row[0] for row in query_model]
-                if entry in entries:
-                    if "Favourites" in query_models:
-                        del query_models["Favourites"]
-                    if "Unrated" in query_models:
-                        del query_models["Unrated"]
-                    self.visited_pages[page] = [
-                        active_filter,query_models, t
-                        ]
-                        
-            shell = self.object
-            self.on_page_change(None, shell.props.selected_page)
+        # The changes object no longer has a values property, so we can't 
+        # check to see what was changed. Instead, the rating index tells us 
+        # whether the entry's rating has moved to another bucket.
+        entry_id = entry.get_ulong(RB.RhythmDBPropType.ENTRY_ID)
+        delta = self.rating_index.update(
+            entry_id, entry.get_double(RB.RhythmDBPropType.RATING)
+            )
+        if delta is not None:
+            for page_filters in list(self.page_filters.values()):
+                page_filters.entry_changed(entry, entry_id, delta)
 
     def on_browser_change(self, action):
         '''
@@ -265,6 +279,10 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
         query_models = {}
         query_model = page.get_entry_view().props.model
 
+        [_, old_query_models, _] = self.visited_pages[page]
+        for old_query_model in old_query_models.values():
+            self.discard_query_model(old_query_model)
+
         active_filter = 'All Ratings'
         query_models[active_filter] = self.filter_query_model(
             active_filter, query_model
@@ -298,6 +316,8 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
 
                 if ((active_filter == "Favourites" and t0 != t) or 
                     active_filter not in query_models):
+                    if active_filter in query_models:
+                        self.discard_query_model(query_models[active_filter])
                     query_models[active_filter] = self.filter_query_model(
                         active_filter, query_models['All Ratings']
                         )
@@ -320,10 +340,19 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
                 self.action.set_state(self.target_values[active_filter])
                 page.connect("filter-changed", self.on_browser_change)
 
+    def get_rating_table(self, active_filter):
+        '''
+        Returns the compiled rating table for a filter.
+        '''
+        if active_filter == 'Favourites':
+            return compile_rating_range(self.get_favourites_threshold(), 5.0)
+        return compile_rating_range(0.0, 0.0)
+
     def filter_query_model(self, active_filter, query_model):
         '''
         Applies the active filter to the supplied query model and returns 
-        the result.
+        the result, which is kept up to date as entries are added, removed 
+        and rated.
         '''
         self.log(
             self.filter_query_model.__name__, 
@@ -337,21 +366,31 @@ class RatingFiltersPlugin (GObject.Object, Peas.Activatable):
         if active_filter == 'All Ratings':
             new_query_model = query_model
         else:
-            if active_filter == "Favourites":
-                ratings = [0.0, 1.0, 2.0, 3.0, 4.0, 5.0]
-                t = self.get_favourites_threshold()
-                ratings = ratings[t:]
-            else:
-                ratings = [0.0]
-
-            for row in query_model:
-                entry = row[0]
-                entry_rating = entry.get_double(RB.RhythmDBPropType.RATING)
-                if entry_rating in ratings:
-                    new_query_model.add_entry(entry, -1)
+            if query_model not in self.page_filters:
+                self.page_filters[query_model] = PageFilters(
+                    query_model, self.rating_index
+                    )
+            page_filters = self.page_filters[query_model]
+            page_filters.add_filter(
+                active_filter, self.get_rating_table(active_filter), 
+                new_query_model
+                )
+            self.rating_models[new_query_model] = (page_filters, active_filter)
 
         return new_query_model
 
+    def discard_query_model(self, query_model):
+        '''
+        Stops keeping a filtered query model that is no longer needed up to 
+        date.
+        '''
+        if query_model in self.rating_models:
+            page_filters, filter_name = self.rating_models.pop(query_model)
+            page_filters.remove_filter(filter_name)
+            if not page_filters.new_query_models:
+                page_filters.stop()
+                del self.page_filters[page_filters.query_model]
+
     def refresh(self, page):
         '''
         Refreshes the entry view on the specified page.